@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Архивация журнала аудита в сжатые сегменты
+
+Записи audit_logs старше AUDIT_RETENTION_DAYS порциями по AUDIT_ARCHIVE_BATCH_SIZE
+переносятся в файлы AUDIT_ARCHIVE_DIR/audit-<первый id>-<последний id>-<время архивации>.ndjson.gz
+(по строке JSON на запись, в порядке id) и удаляются из таблицы. Сегменты только
+добавляются и не изменяются. SQLite может повторно выдать id удаленных строк, поэтому
+диапазон id не делает имя уникальным: к занятому имени добавляется номер. index.json
+хранит для каждого сегмента диапазон id, диапазон времени и число строк, поэтому при
+чтении нужные сегменты выбираются без распаковки остальных.
+
+Порядок шагов - сегмент, индекс, удаление из таблицы. Если процесс прервется после
+записи индекса, следующий запуск сначала удалит уже заархивированные строки
+последнего сегмента, поэтому дубликатов не будет. Одновременный запуск из
+нескольких процессов исключает файловая блокировка.
+
+    python audit_archive.py            # из cron/systemd-таймера
+"""
+import fcntl
+import gzip
+import json
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session, joinedload
+
+from models import AuditLog
+
+AUDIT_ARCHIVE_DIR = Path(os.getenv('AUDIT_ARCHIVE_DIR', 'audit_archive'))
+AUDIT_RETENTION_DAYS = int(os.getenv('AUDIT_RETENTION_DAYS', '180'))
+AUDIT_ARCHIVE_BATCH_SIZE = int(os.getenv('AUDIT_ARCHIVE_BATCH_SIZE', '5000'))
+INDEX_NAME = "index.json"
+
+
+class ArchiveBusy(Exception):
+    pass
+
+
+def _index_path() -> Path:
+    return AUDIT_ARCHIVE_DIR / INDEX_NAME
+
+
+def load_index() -> List[dict]:
+    path = _index_path()
+    if not path.exists():
+        return []
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    tmp.replace(path)
+
+
+@contextmanager
+def _archive_lock():
+    AUDIT_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(AUDIT_ARCHIVE_DIR / ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ArchiveBusy("Audit log archival is already running")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _segment_name(first_id: int, last_id: int, archived_at: datetime, index: List[dict]) -> str:
+    """Свободное имя сегмента: не занято ни файлом в каталоге, ни записью индекса"""
+    taken = {segment["file"] for segment in index}
+    stem = f"audit-{first_id:010d}-{last_id:010d}-{archived_at:%Y%m%dT%H%M%S}"
+    name = f"{stem}.ndjson.gz"
+    suffix = 1
+    while name in taken or (AUDIT_ARCHIVE_DIR / name).exists():
+        name = f"{stem}-{suffix}.ndjson.gz"
+        suffix += 1
+    return name
+
+
+def log_record(log: AuditLog) -> dict:
+    return {
+        "id": log.id,
+        "user_id": log.user_id,
+        "username": log.user.username if log.user else None,
+        "action": log.action,
+        "timestamp": log.timestamp.isoformat(),
+        "record_type": log.record_type,
+        "record_id": log.record_id,
+        "details": log.details,
+    }
+
+
+def _delete_segment_rows(db: Session, segment: dict) -> int:
+    # Строки сегмента: его диапазон id и время не позже последней заархивированной записи
+    result = db.execute(delete(AuditLog).where(
+        AuditLog.id.between(segment["min_id"], segment["max_id"]),
+        AuditLog.timestamp <= datetime.fromisoformat(segment["max_ts"]),
+    ))
+    db.commit()
+    return result.rowcount
+
+
+def archive(db: Session, retention_days: int = AUDIT_RETENTION_DAYS,
+            batch_size: int = AUDIT_ARCHIVE_BATCH_SIZE, now: Optional[datetime] = None) -> dict:
+    """Переносит записи старше retention_days в сегменты; возвращает число сегментов и строк"""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    stats = {"segments": 0, "archived": 0, "cutoff": cutoff}
+    with _archive_lock():
+        index = load_index()
+        if index:
+            # Удаление после прошлого запуска могло не выполниться
+            _delete_segment_rows(db, index[-1])
+
+        while True:
+            logs = db.query(AuditLog).options(joinedload(AuditLog.user)) \
+                .filter(AuditLog.timestamp < cutoff).order_by(AuditLog.id).limit(batch_size).all()
+            if not logs:
+                break
+            records = [log_record(log) for log in logs]
+            name = _segment_name(records[0]["id"], records[-1]["id"], datetime.utcnow(), index)
+            payload = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            _write_atomic(AUDIT_ARCHIVE_DIR / name, gzip.compress(payload.encode("utf-8")))
+
+            segment = {
+                "file": name,
+                "min_id": records[0]["id"],
+                "max_id": records[-1]["id"],
+                "min_ts": min(record["timestamp"] for record in records),
+                "max_ts": max(record["timestamp"] for record in records),
+                "rows": len(records),
+            }
+            index.append(segment)
+            _write_atomic(_index_path(), json.dumps(index, ensure_ascii=False, indent=1).encode("utf-8"))
+            db.expunge_all()
+            _delete_segment_rows(db, segment)
+
+            stats["segments"] += 1
+            stats["archived"] += len(records)
+    return stats
+
+
+def read_segment(segment: dict) -> List[dict]:
+    with gzip.open(AUDIT_ARCHIVE_DIR / segment["file"], "rt", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _overlaps(segment: dict, date_from: Optional[datetime], date_to: Optional[datetime]) -> bool:
+    if date_from and segment["max_ts"] < date_from.isoformat():
+        return False
+    if date_to and segment["min_ts"] >= date_to.isoformat():
+        return False
+    return True
+
+
+def _inside(segment: dict, date_from: Optional[datetime], date_to: Optional[datetime]) -> bool:
+    return (not date_from or segment["min_ts"] >= date_from.isoformat()) and \
+        (not date_to or segment["max_ts"] < date_to.isoformat())
+
+
+def iter_archived(date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                  skip: int = 0) -> Iterator[dict]:
+    """Архивные записи от новых к старым (date_to не включается); первые skip пропускаются.
+
+    Сегменты вне интервала не читаются, а целиком попадающие в интервал пропускаются
+    по числу строк из индекса без распаковки.
+    """
+    for segment in reversed(load_index()):
+        if not _overlaps(segment, date_from, date_to):
+            continue
+        if skip >= segment["rows"] and _inside(segment, date_from, date_to):
+            skip -= segment["rows"]
+            continue
+        for record in reversed(read_segment(segment)):
+            if date_from and record["timestamp"] < date_from.isoformat():
+                continue
+            if date_to and record["timestamp"] >= date_to.isoformat():
+                continue
+            if skip:
+                skip -= 1
+                continue
+            yield record
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    if AUDIT_RETENTION_DAYS <= 0:
+        print("AUDIT_RETENTION_DAYS=0: archival disabled")
+        sys.exit(0)
+    session = SessionLocal()
+    try:
+        result = archive(session)
+    except ArchiveBusy as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+    finally:
+        session.close()
+    print(f"✓ Archived {result['archived']} audit log entries older than {result['cutoff']:%Y-%m-%d} "
+          f"into {result['segments']} segment(s) in {AUDIT_ARCHIVE_DIR}")
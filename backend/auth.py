@@ -2,18 +2,25 @@
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from database import get_db
 from models import User
+from metrics import current_request
 import os
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production-1234567890')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 480  # 8 hours
+# Билет для EventSource передается в URL (попадает в журналы прокси), поэтому живет недолго
+STREAM_TICKET_EXPIRE_SECONDS = int(os.getenv('STREAM_TICKET_EXPIRE_SECONDS', '60'))
+STREAM_TICKET_PURPOSE = "events"
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -25,20 +32,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
+def create_stream_ticket(user: User) -> str:
+    """Короткоживущий билет на подключение к ленте изменений (EventSource не передает заголовки)"""
+    return create_access_token(
+        {"sub": user.username, "purpose": STREAM_TICKET_PURPOSE},
+        expires_delta=timedelta(seconds=STREAM_TICKET_EXPIRE_SECONDS),
+    )
+
+def _user_from_token(token: str, db: Session, purpose: Optional[str] = None) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        # Билет ленты не заменяет токен доступа, и наоборот
+        if username is None or payload.get("purpose") != purpose:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
@@ -46,8 +57,35 @@ def get_current_user(
     user = db.query(User).filter(User.username == username, User.is_active == True).first()
     if user is None:
         raise credentials_exception
+    
+    # Атрибуция запроса для метрик и журнала медленных запросов
+    stats = current_request.get()
+    if stats is not None:
+        stats.user_id = user.id
     return user
 
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    return _user_from_token(credentials.credentials, db)
+
+def get_stream_user(
+    ticket: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db: Session = Depends(get_db)
+) -> User:
+    """Лента изменений: билет из POST /api/events/ticket в параметре ticket либо токен в заголовке"""
+    if ticket:
+        return _user_from_token(ticket, db, purpose=STREAM_TICKET_PURPOSE)
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return _user_from_token(credentials.credentials, db)
+
 def require_admin(current_user: User = Depends(get_current_user)) -> User:
     if current_user.role != 'admin':
         raise HTTPException(
@@ -55,3 +93,25 @@ def require_admin(current_user: User = Depends(get_current_user)) -> User:
             detail="Admin privileges required"
         )
     return current_user
+
+def is_local_request(request: Request) -> bool:
+    # За nginx все запросы приходят с 127.0.0.1, поэтому проксированные запросы локальными не считаются
+    if request.headers.get("x-forwarded-for") or request.headers.get("x-real-ip"):
+        return False
+    return request.client is not None and request.client.host in LOCAL_HOSTS
+
+def require_admin_or_local(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db: Session = Depends(get_db)
+) -> Optional[User]:
+    """Служебные эндпоинты: локальный скрейпер без токена либо администратор"""
+    if is_local_request(request):
+        return None
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return require_admin(get_current_user(credentials, db))
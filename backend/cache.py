@@ -0,0 +1,373 @@
+"""
+Внутрипроцессные кэши редко меняющихся данных
+
+При работе в несколько процессов (WEB_CONCURRENCY > 1) кэши согласуются через
+таблицу cache_generations: запись увеличивает поколение кэша в БД, а каждый
+запрос сверяет поколения одним запросом к маленькой таблице и сбрасывает
+устаревшие локальные кэши.
+"""
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import metrics
+from models import Institution, Dictionary, CacheGeneration
+
+# Сверка поколений нужна только при нескольких процессах-воркерах
+CACHE_SYNC_ENABLED = int(os.getenv('WEB_CONCURRENCY', '1')) > 1 or os.getenv('CACHE_SYNC', '0') == '1'
+# Число карточек пациентов в кэше GET /api/patients/{id} (0 - выключен)
+PATIENT_CACHE_SIZE = int(os.getenv('PATIENT_CACHE_SIZE', '2000'))
+
+
+class CacheCoordinator:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._callbacks: Dict[str, List[Tuple[Callable[[], None], bool]]] = {}
+        self._seen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, invalidate: Callable[[], None], local: bool = True):
+        """local=False - сброс только по записи другого воркера (свои записи кэш сбрасывает точечно)"""
+        self._callbacks.setdefault(name, []).append((invalidate, local))
+
+    def _invalidate_local(self, name: str, remote: bool = False):
+        for callback, local in self._callbacks.get(name, []):
+            if local or remote:
+                callback()
+
+    def ensure_rows(self, db: Session):
+        """Создает строки поколений для всех зарегистрированных кэшей"""
+        existing = {row.name for row in db.query(CacheGeneration.name).all()}
+        for name in self._callbacks:
+            if name not in existing:
+                db.add(CacheGeneration(name=name, generation=0))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Строки одновременно создал другой воркер
+            db.rollback()
+
+    def invalidate(self, name: str, db: Optional[Session] = None):
+        """Сбрасывает кэш в этом процессе и, если нужно, сообщает остальным воркерам"""
+        self._invalidate_local(name)
+        if self.enabled and db is not None:
+            generation = db.execute(
+                update(CacheGeneration)
+                .where(CacheGeneration.name == name)
+                .values(generation=CacheGeneration.generation + 1)
+                .returning(CacheGeneration.generation)
+            ).scalar()
+            db.commit()
+            with self._lock:
+                # Свое увеличение поколения без чужих между ними: sync не должен сбрасывать кэш повторно
+                if generation is not None and self._seen.get(name) == generation - 1:
+                    self._seen[name] = generation
+
+    def sync(self, db: Session):
+        """Сбрасывает локальные кэши, поколение которых изменил другой воркер"""
+        if not self.enabled:
+            return
+        generations = db.query(CacheGeneration.name, CacheGeneration.generation).all()
+        with self._lock:
+            for name, generation in generations:
+                seen = self._seen.get(name)
+                if seen is not None and seen != generation:
+                    self._invalidate_local(name, remote=True)
+                self._seen[name] = generation
+
+
+class InstitutionNameCache:
+    """Кэш id -> название учреждения.
+
+    Загружается целиком одним запросом при первом обращении и сбрасывается
+    при создании, изменении или удалении учреждения. Таблица загружается целиком,
+    поэтому отсутствующий id (удаленное учреждение) тоже ответ: до сброса кэша
+    он не перечитывает таблицу.
+    """
+
+    def __init__(self):
+        self._names: Optional[Dict[int, str]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, institution_id: Optional[int]) -> str:
+        if institution_id is None:
+            return ""
+        names = self._names
+        if names is None:
+            names = self._load(db)
+        return names.get(institution_id, "")
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._names = None
+
+    def _load(self, db: Session) -> Dict[int, str]:
+        generation = self._generation
+        # Неактивные учреждения тоже нужны: на них ссылаются старые пациенты и пользователи
+        names = {row.id: row.name for row in db.query(Institution.id, Institution.name).all()}
+        with self._lock:
+            # Не сохраняем результат, если кэш сбросили во время загрузки
+            if generation == self._generation:
+                self._names = names
+        return names
+
+
+WORD_SPLIT = re.compile(r"[\s,.;:()/\\-]+")
+
+
+def normalize_term(text: str) -> str:
+    return text.casefold().replace("ё", "е")
+
+
+class CategoryIndex:
+    """Активные записи одной категории и отсортированный массив ключей для поиска по префиксу"""
+
+    __slots__ = ("entries", "keys", "haystacks")
+
+    def __init__(self, entries: List[dict]):
+        self.entries = sorted(entries, key=lambda entry: (entry["sort_order"] or 0, entry["id"]))
+        keys = set()
+        for position, entry in enumerate(self.entries):
+            value = normalize_term(entry["value_ru"])
+            # Префикс кода, всего названия и каждого слова названия
+            terms = {normalize_term(entry["code"]), value}
+            terms.update(word for word in WORD_SPLIT.split(value) if word)
+            keys.update((term, position) for term in terms)
+        self.keys: List[Tuple[str, int]] = sorted(keys)
+        self.haystacks = [normalize_term(f"{entry['code']}\x00{entry['value_ru']}") for entry in self.entries]
+
+    def search(self, query: str, limit: int) -> List[dict]:
+        if not query:
+            return self.entries[:limit]
+
+        prefix_hits = set()
+        keys = self.keys
+        index = bisect_left(keys, (query,))
+        while index < len(keys) and keys[index][0].startswith(query):
+            prefix_hits.add(keys[index][1])
+            index += 1
+        # Позиции уже упорядочены по sort_order
+        ranked = sorted(prefix_hits)[:limit]
+
+        if len(ranked) < limit:
+            for position, haystack in enumerate(self.haystacks):
+                if position not in prefix_hits and query in haystack:
+                    ranked.append(position)
+                    if len(ranked) == limit:
+                        break
+        return [self.entries[position] for position in ranked]
+
+
+class DictionarySearchIndex:
+    """Поисковый индекс справочников в памяти.
+
+    Строится одним запросом при первом поиске и сбрасывается при изменении справочников.
+    """
+
+    def __init__(self):
+        self._categories: Optional[Dict[str, CategoryIndex]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def search(self, db: Session, category: str, query: str, limit: int) -> List[dict]:
+        categories = self._categories
+        if categories is None:
+            categories = self._load(db)
+        index = categories.get(category)
+        if index is None:
+            return []
+        return index.search(normalize_term(query.strip()), limit)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._categories = None
+
+    def _load(self, db: Session) -> Dict[str, CategoryIndex]:
+        generation = self._generation
+        grouped: Dict[str, List[dict]] = {}
+        rows = db.query(
+            Dictionary.id, Dictionary.category, Dictionary.code, Dictionary.value_ru,
+            Dictionary.sort_order, Dictionary.parent, Dictionary.is_active, Dictionary.created_at,
+        ).filter(Dictionary.is_active == True)
+        for row in rows:
+            grouped.setdefault(row.category, []).append(dict(row._mapping))
+        categories = {category: CategoryIndex(entries) for category, entries in grouped.items()}
+        with self._lock:
+            if generation == self._generation:
+                self._categories = categories
+        return categories
+
+
+class PatientEntry(NamedTuple):
+    institution_id: int
+    updated_at: Optional[datetime]
+    body: bytes  # JSON PatientResponse
+
+
+class PatientRecordCache:
+    """LRU готовых JSON-ответов GET /api/patients/{id}: id -> учреждение, версия (updated_at), тело.
+
+    Запись пациента сбрасывает его элемент, переименование учреждения - весь кэш.
+    Запись другого воркера только помечает элементы непроверенными: перед отдачей
+    такой элемент сверяется с updated_at строки пациента (stale в get) и сбрасывается,
+    лишь если пациент изменился. Элемент, прочитанный из БД до сброса, не сохраняется.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # id -> (элемент, эпоха последней сверки с БД)
+        self._entries: "OrderedDict[int, Tuple[PatientEntry, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidations = 0
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+    def get(self, patient_id: int) -> Tuple[Optional[PatientEntry], bool]:
+        """Элемент и признак stale: после записи другого воркера его нужно сверить с БД"""
+        with self._lock:
+            cached = self._entries.get(patient_id)
+            if cached is None:
+                self.misses += 1
+                return None, False
+            self.hits += 1
+            self._entries.move_to_end(patient_id)
+            entry, epoch = cached
+            return entry, epoch != self._epoch
+
+    def epoch(self) -> int:
+        """Берется до сверочного запроса и передается в confirm"""
+        return self._epoch
+
+    def confirm(self, patient_id: int, epoch: int):
+        """Элемент совпал с БД: до следующей чужой записи сверять его не нужно"""
+        with self._lock:
+            self.revalidations += 1
+            cached = self._entries.get(patient_id)
+            if cached is not None:
+                self._entries[patient_id] = (cached[0], max(cached[1], epoch))
+
+    def mark_stale(self):
+        """Запись другого воркера: все элементы сверяются с БД при следующем чтении"""
+        with self._lock:
+            self._epoch += 1
+
+    def token(self) -> int:
+        """Берется до чтения из БД и передается в put"""
+        return self._invalidations
+
+    def put(self, patient_id: int, token: int, entry: PatientEntry, epoch: int):
+        """epoch - значение epoch() до чтения пациента из БД"""
+        with self._lock:
+            if self.maxsize <= 0 or token != self._invalidations:
+                return
+            self._entries[patient_id] = (entry, epoch)
+            self._entries.move_to_end(patient_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, patient_id: int):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(patient_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+    def render(self) -> list:
+        with self._lock:
+            return [
+                "# HELP registry_patient_cache_hits_total Patient card requests served from the in-process cache.",
+                "# TYPE registry_patient_cache_hits_total counter",
+                f"registry_patient_cache_hits_total {self.hits}",
+                "# HELP registry_patient_cache_misses_total Patient card requests loaded from the database.",
+                "# TYPE registry_patient_cache_misses_total counter",
+                f"registry_patient_cache_misses_total {self.misses}",
+                "# HELP registry_patient_cache_evictions_total Entries evicted by the LRU size limit.",
+                "# TYPE registry_patient_cache_evictions_total counter",
+                f"registry_patient_cache_evictions_total {self.evictions}",
+                "# HELP registry_patient_cache_revalidations_total Entries confirmed against updated_at after another worker's write.",
+                "# TYPE registry_patient_cache_revalidations_total counter",
+                f"registry_patient_cache_revalidations_total {self.revalidations}",
+                "# HELP registry_patient_cache_entries Cached patient cards.",
+                "# TYPE registry_patient_cache_entries gauge",
+                f"registry_patient_cache_entries {len(self._entries)}",
+                "# HELP registry_patient_cache_capacity Configured cache size (PATIENT_CACHE_SIZE).",
+                "# TYPE registry_patient_cache_capacity gauge",
+                f"registry_patient_cache_capacity {self.maxsize}",
+            ]
+
+
+class DataVersion:
+    """Версия данных пациентов в этом процессе: увеличивается при каждой записи"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+
+
+class VersionedResultCache:
+    """LRU результатов расчетов; запись действительна, пока не изменилась версия данных"""
+
+    def __init__(self, version: DataVersion, maxsize: int = 128):
+        self.version = version
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        version = self.version.value
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        # Расчет вне блокировки; если данные изменились во время расчета,
+        # результат сохранится со старой версией и не будет использован
+        result = compute()
+        with self._lock:
+            self._entries[key] = (version, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+
+caches = CacheCoordinator(CACHE_SYNC_ENABLED)
+
+institution_names = InstitutionNameCache()
+caches.register("institutions", institution_names.invalidate)
+
+dictionary_index = DictionarySearchIndex()
+caches.register("dictionaries", dictionary_index.invalidate)
+
+# Кэши аналитики привязаны к версии данных пациентов
+patient_data_version = DataVersion()
+caches.register("patients", patient_data_version.bump)
+
+# Карточки пациентов: свои записи сбрасывают элемент пациента, чужие (другой воркер)
+# помечают элементы для сверки с updated_at
+patient_records = PatientRecordCache(PATIENT_CACHE_SIZE)
+caches.register("patients", patient_records.mark_stale, local=False)
+caches.register("institutions", patient_records.clear)
+metrics.registry.gauge_sources.append(patient_records.render)
@@ -0,0 +1,92 @@
+"""
+Индекс кодов из JSON-списков клинической записи
+
+Мультивыборы (comorbidities, metastases_sites, ...) хранятся JSON-массивами, и фильтр
+по ним требует разбора JSON в каждой строке. Таблица clinical_record_codes
+(record_id, field, code) с индексом (field, code) превращает такой фильтр в поиск
+по индексу. Таблица обновляется в after_flush любой сессии ORM, поэтому ее не
+нужно поддерживать в каждом эндпоинте (создание, обновление, автосохранение).
+Данные, вставленные в обход ORM, восстанавливаются через rebuild().
+"""
+from sqlalchemy import delete, event, insert, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from models import ClinicalRecord, ClinicalRecordCode, clinical_record_columns, join_record_extensions
+
+# Поля-списки кодов справочников (JSON-массивы строк)
+CODE_LIST_FIELDS = (
+    'comorbidities', 'alk_methods', 'previous_therapy_types', 'metastases_sites',
+    'progression_sites', 'after_alectinib_progression_sites', 'next_line_treatments',
+    'next_line_progression_sites',
+)
+REBUILD_CHUNK_SIZE = 5000
+
+
+def record_fields(record) -> list:
+    """Поля-списки, которые есть у записи данного регистра"""
+    return [field for field in CODE_LIST_FIELDS if hasattr(type(record), field)]
+
+
+def code_rows(record_id: int, field: str, value) -> list:
+    if not isinstance(value, list):
+        return []
+    codes = {item for item in value if isinstance(item, str) and item}
+    return [{"record_id": record_id, "field": field, "code": code} for code in sorted(codes)]
+
+
+@event.listens_for(Session, "after_flush")
+def _sync_code_index(session, flush_context):
+    rows, stale = [], []
+    for obj in session.new:
+        if isinstance(obj, ClinicalRecord):
+            for field in record_fields(obj):
+                rows.extend(code_rows(obj.id, field, getattr(obj, field)))
+    for obj in session.dirty:
+        if isinstance(obj, ClinicalRecord):
+            for field in record_fields(obj):
+                # История атрибутов еще доступна в after_flush
+                if get_history(obj, field).has_changes():
+                    stale.append((obj.id, field))
+                    rows.extend(code_rows(obj.id, field, getattr(obj, field)))
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, ClinicalRecord)]
+
+    if not (rows or stale or deleted):
+        return
+    connection = session.connection()
+    for record_id, field in stale:
+        connection.execute(delete(ClinicalRecordCode).where(
+            ClinicalRecordCode.record_id == record_id, ClinicalRecordCode.field == field
+        ))
+    if deleted:
+        connection.execute(delete(ClinicalRecordCode).where(ClinicalRecordCode.record_id.in_(deleted)))
+    if rows:
+        connection.execute(insert(ClinicalRecordCode), rows)
+
+
+def rebuild(connection):
+    """Полностью перестраивает индекс по clinical_records (одна транзакция вызывающего кода)"""
+    connection.execute(delete(ClinicalRecordCode))
+    by_name = {column.key: column for column in clinical_record_columns()}
+    # Колонки таблиц расширений выбираются через LEFT JOIN по ключу записи
+    columns = [ClinicalRecord.id] + [by_name[field] for field in CODE_LIST_FIELDS]
+    statement = join_record_extensions(select(*columns).select_from(ClinicalRecord), *columns)
+    rows, total = [], 0
+    for record in connection.execute(statement).all():
+        for field, value in zip(CODE_LIST_FIELDS, record[1:]):
+            rows.extend(code_rows(record[0], field, value))
+        if len(rows) >= REBUILD_CHUNK_SIZE:
+            connection.execute(insert(ClinicalRecordCode), rows)
+            total += len(rows)
+            rows = []
+    if rows:
+        connection.execute(insert(ClinicalRecordCode), rows)
+        total += len(rows)
+    return total
+
+
+def needs_rebuild(connection) -> bool:
+    """Индекс пуст, а клинические записи есть (новая таблица или массовая вставка без ORM)"""
+    has_codes = connection.execute(select(ClinicalRecordCode.record_id).limit(1)).first() is not None
+    has_records = connection.execute(select(ClinicalRecord.id).limit(1)).first() is not None
+    return has_records and not has_codes
@@ -0,0 +1,258 @@
+"""
+Конструктор когорт: JSON-дерево фильтров -> один SQL-запрос
+
+Узлы дерева:
+    {"and": [узел, ...]}, {"or": [узел, ...]}, {"not": узел}
+    {"field": "ecog_at_start", "op": "lte", "value": 1}
+
+Операторы по типу поля:
+    строки      eq, ne, in, not_in, is_null, not_null
+    числа       eq, ne, lt, lte, gt, gte, between, in, not_in, is_null, not_null
+    флаги       eq, ne, is_null, not_null
+    даты        eq, lt, lte, gt, gte, between, is_null, not_null (значения - ISO-строки;
+                дата без времени означает весь день: lte 2021-01-31 включает 31 января)
+    списки кодов contains (любой из), contains_all, not_contains, is_null, not_null (пустой список)
+
+Доступны только поля из FIELDS. Дерево компилируется в одно условие WHERE,
+сравнения идут по колонкам, поэтому используются индексы; списки кодов
+проверяются по таблице clinical_record_codes (code_index.py).
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, JSON, String, and_, func, not_, or_, select
+from sqlalchemy.orm import Session
+
+from cache import VersionedResultCache, patient_data_version
+from code_index import CODE_LIST_FIELDS
+from models import Patient, ClinicalRecord, ClinicalRecordCode, clinical_record_columns, join_record_extensions
+
+MAX_DEPTH = 10
+MAX_NODES = 200
+MAX_VALUES = 500
+
+# Идентифицирующие и служебные поля в фильтрах недоступны
+EXCLUDED_FIELDS = {'id', 'patient_id', 'patient_code', 'birth_date', 'date_filled', 'created_at', 'updated_at'}
+
+OPERATORS = {
+    'string': {'eq', 'ne', 'in', 'not_in', 'is_null', 'not_null'},
+    'number': {'eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'between', 'in', 'not_in', 'is_null', 'not_null'},
+    'boolean': {'eq', 'ne', 'is_null', 'not_null'},
+    'date': {'eq', 'lt', 'lte', 'gt', 'gte', 'between', 'is_null', 'not_null'},
+    'codes': {'contains', 'contains_all', 'not_contains', 'is_null', 'not_null'},
+}
+
+
+class CohortFilterError(ValueError):
+    pass
+
+
+def _field_kind(column) -> Optional[str]:
+    if column.key in CODE_LIST_FIELDS:
+        return 'codes'
+    column_type = column.type
+    if isinstance(column_type, JSON):
+        return None
+    if isinstance(column_type, Boolean):
+        return 'boolean'
+    if isinstance(column_type, DateTime):
+        return 'date'
+    if isinstance(column_type, (Integer, Float)):
+        return 'number'
+    # Text - подкласс String: свободный текст в фильтрах не участвует
+    if isinstance(column_type, String) and column_type.length is not None:
+        return 'string'
+    return None
+
+
+def _build_fields() -> Dict[str, tuple]:
+    fields = {'institution_id': (Patient.institution_id, 'number')}
+    # Колонки расширений ALK/ROS1 входят в полиморфный JOIN клинической записи
+    for column in clinical_record_columns():
+        kind = _field_kind(column)
+        if kind and column.key not in EXCLUDED_FIELDS:
+            fields[column.key] = (column, kind)
+    return fields
+
+
+FIELDS = _build_fields()
+
+
+def _parse_date(value):
+    """Возвращает (datetime, только_дата)"""
+    if not isinstance(value, str):
+        raise CohortFilterError(f"Expected ISO date string, got {value!r}")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise CohortFilterError(f"Invalid date: {value!r}")
+    return parsed, len(value) == 10
+
+
+def _scalar(kind: str, value):
+    if kind == 'number':
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise CohortFilterError(f"Expected number, got {value!r}")
+    elif kind == 'boolean':
+        if not isinstance(value, bool):
+            raise CohortFilterError(f"Expected true/false, got {value!r}")
+    elif not isinstance(value, str):
+        raise CohortFilterError(f"Expected string, got {value!r}")
+    return value
+
+
+def _value_list(kind: str, value, allow_scalar: bool = False) -> list:
+    if allow_scalar and not isinstance(value, list):
+        value = [value]
+    if not isinstance(value, list) or not value:
+        raise CohortFilterError("Expected a non-empty list of values")
+    if len(value) > MAX_VALUES:
+        raise CohortFilterError(f"Too many values (max {MAX_VALUES})")
+    return [_scalar(kind, item) for item in value]
+
+
+def codes_condition(field: str, codes: Optional[list] = None):
+    """Есть ли в списке field хотя бы один из кодов (без codes - есть ли хоть один код).
+
+    Поиск идет по индексу clinical_record_codes, а не разбором JSON в каждой строке.
+    """
+    records = select(ClinicalRecordCode.record_id).where(ClinicalRecordCode.field == field)
+    if codes is not None:
+        records = records.where(ClinicalRecordCode.code.in_(codes))
+    return ClinicalRecord.id.in_(records)
+
+
+def _date_condition(column, op: str, value):
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise CohortFilterError("between expects [from, to]")
+        return and_(_date_condition(column, 'gte', value[0]), _date_condition(column, 'lte', value[1]))
+
+    moment, whole_day = _parse_date(value)
+    next_day = moment + timedelta(days=1)
+    if op == 'eq':
+        return and_(column >= moment, column < next_day) if whole_day else column == moment
+    if op == 'lt':
+        return column < moment
+    if op == 'gte':
+        return column >= moment
+    if op == 'lte':
+        return column < next_day if whole_day else column <= moment
+    # gt
+    return column >= next_day if whole_day else column > moment
+
+
+def _leaf(node: dict):
+    name = node.get('field')
+    op = node.get('op')
+    if name not in FIELDS:
+        raise CohortFilterError(f"Unknown or unsupported field: {name!r}")
+    column, kind = FIELDS[name]
+    if op not in OPERATORS[kind]:
+        raise CohortFilterError(f"Operator {op!r} is not allowed for {kind} field {name!r}")
+    value = node.get('value')
+
+    if kind == 'codes':
+        if op == 'is_null':
+            return not_(codes_condition(name))
+        if op == 'not_null':
+            return codes_condition(name)
+        codes = _value_list('string', value, allow_scalar=True)
+        if op == 'contains':
+            return codes_condition(name, codes)
+        if op == 'contains_all':
+            return and_(*(codes_condition(name, [code]) for code in codes))
+        return not_(codes_condition(name, codes))
+
+    if op == 'is_null':
+        return column.is_(None)
+    if op == 'not_null':
+        return column.isnot(None)
+    if kind == 'date':
+        return _date_condition(column, op, value)
+    if op in ('in', 'not_in'):
+        values = _value_list(kind, value)
+        return column.in_(values) if op == 'in' else column.notin_(values)
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise CohortFilterError("between expects [from, to]")
+        return column.between(_scalar(kind, value[0]), _scalar(kind, value[1]))
+
+    value = _scalar(kind, value)
+    return {
+        'eq': lambda: column == value,
+        'ne': lambda: column != value,
+        'lt': lambda: column < value,
+        'lte': lambda: column <= value,
+        'gt': lambda: column > value,
+        'gte': lambda: column >= value,
+    }[op]()
+
+
+def compile_filter(node: Any, depth: int = 0, counter: Optional[list] = None):
+    """Компилирует дерево в SQL-условие; ошибки - CohortFilterError"""
+    counter = counter if counter is not None else [0]
+    counter[0] += 1
+    if depth > MAX_DEPTH or counter[0] > MAX_NODES:
+        raise CohortFilterError(f"Filter is too large (max depth {MAX_DEPTH}, max {MAX_NODES} nodes)")
+    if not isinstance(node, dict):
+        raise CohortFilterError("Filter node must be an object")
+
+    for key, combine in (('and', and_), ('or', or_)):
+        if key in node:
+            children = node[key]
+            if not isinstance(children, list) or not children:
+                raise CohortFilterError(f"'{key}' expects a non-empty list")
+            return combine(*(compile_filter(child, depth + 1, counter) for child in children))
+    if 'not' in node:
+        return not_(compile_filter(node['not'], depth + 1, counter))
+    return _leaf(node)
+
+
+def normalize_filter(node: Any) -> Any:
+    """Каноническая форма для ключа кэша: порядок ветвей and/or и значений in не важен"""
+    if isinstance(node, dict):
+        for key in ('and', 'or'):
+            if key in node and isinstance(node[key], list):
+                children = [normalize_filter(child) for child in node[key]]
+                return {key: sorted(children, key=lambda child: json.dumps(child, sort_keys=True))}
+        normalized = {key: normalize_filter(value) for key, value in node.items()}
+        if normalized.get('op') in ('in', 'not_in', 'contains', 'contains_all', 'not_contains') \
+                and isinstance(normalized.get('value'), list):
+            normalized['value'] = sorted(normalized['value'], key=lambda value: json.dumps(value))
+        return normalized
+    return node
+
+
+def filter_hash(node: Any) -> str:
+    canonical = json.dumps(normalize_filter(node), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+cohort_cache = VersionedResultCache(patient_data_version, maxsize=256)
+
+
+def run_cohort_query(db: Session, tree: dict, institution_id: Optional[int],
+                     include_ids: bool, offset: int, limit: int) -> dict:
+    """institution_id ограничивает когорту учреждением пользователя (не для администратора)"""
+    condition = compile_filter(tree)
+    digest = filter_hash(tree)
+    key = (digest, institution_id, include_ids, offset if include_ids else None, limit if include_ids else None)
+
+    def compute():
+        def scoped(query):
+            query = join_record_extensions(query.select_from(Patient).join(ClinicalRecord), condition)
+            query = query.filter(Patient.is_active == True, condition)
+            if institution_id is not None:
+                query = query.filter(Patient.institution_id == institution_id)
+            return query
+
+        result = {"filter_hash": digest, "count": scoped(db.query(func.count(Patient.id))).scalar()}
+        if include_ids:
+            ids = scoped(db.query(Patient.id)).order_by(Patient.id).offset(offset).limit(limit)
+            result.update(ids=[row.id for row in ids], offset=offset, limit=limit)
+        return result
+
+    return cohort_cache.get_or_compute(key, compute)
@@ -0,0 +1,198 @@
+"""
+Заполненность всех полей клинической записи по учреждениям и регистрам
+
+Один агрегатный запрос с группировкой по (учреждение, регистр) считает для каждой
+колонки число записей, где поле ожидается (знаменатель), и число записей, где оно
+заполнено. Поле ожидается во всех записях своего регистра, а уточняющие поля - только
+при условии из CONDITIONS (те же правила, что в форме и calculate_completion_percentage:
+"Уточните иное" - при выборе OTHER, даты операции - если операция была и т.д.).
+Заполненность считается как в форме: пустая строка и пустой список не учитываются.
+Результат кэшируется до следующего изменения данных пациентов.
+"""
+from typing import Dict, Optional
+
+from sqlalchemy import JSON, String, Text, and_, case, func, type_coerce
+from sqlalchemy.orm import Session
+
+from cache import VersionedResultCache, patient_data_version, institution_names
+from cohorts import codes_condition
+from models import Patient, ClinicalRecord, RECORD_CLASSES, clinical_record_columns, join_record_extensions
+
+EXCLUDED_FIELDS = {'id', 'patient_id', 'registry_type'}
+# Пустые значения JSON (списки линий терапии фронтенд присылает строкой JSON)
+EMPTY_JSON = ('[]', 'null', '""', '', '"[]"')
+
+heatmap_cache = VersionedResultCache(patient_data_version, maxsize=16)
+
+_columns = {column.key: column for column in clinical_record_columns()}
+
+
+def _true(name):
+    return _columns[name] == True
+
+
+def _equals(name, value):
+    return _columns[name] == value
+
+
+def _contains(name, code):
+    return codes_condition(name, [code])
+
+
+def filled(column):
+    """SQL-условие "поле заполнено" (как is_filled в calculate_completion_percentage)"""
+    if isinstance(column.type, JSON):
+        return and_(column.isnot(None), type_coerce(column, String).notin_(EMPTY_JSON))
+    if isinstance(column.type, (String, Text)):
+        return and_(column.isnot(None), func.trim(column) != '')
+    return column.isnot(None)
+
+
+def _build_conditions() -> Dict[str, object]:
+    radical = _true('radical_treatment_conducted')
+    surgery = and_(radical, _true('radical_surgery_conducted'))
+    crt = and_(radical, _true('radical_crt_conducted'))
+    consolidation = and_(crt, _true('radical_crt_consolidation'))
+    progression = and_(filled(_columns['progression_during_alectinib']), _columns['progression_during_alectinib'] != 'NONE')
+    stopped = func.lower(_columns['alectinib_therapy_status']) == 'stopped'
+    next_line = and_(stopped, filled(_columns['next_line_treatments']))
+    next_line_progression = and_(next_line, _true('progression_on_next_line'))
+
+    conditions = {
+        # Общие
+        'comorbidities_other_text': _contains('comorbidities', 'OTHER'),
+        'histology_other': _equals('histology', 'OTHER'),
+
+        # ROS1
+        'pdl1_tps': _columns['pdl1_status'].in_(['TPS_LESS_1', 'TPS_1_49', 'TPS_MORE_50']),
+        'radical_surgery_conducted': radical,
+        'radical_crt_conducted': radical,
+        'radical_perioperative_therapy': radical,
+        'radical_treatment_outcome': radical,
+        'radical_surgery_date': surgery,
+        'radical_surgery_type': surgery,
+        'radical_surgery_type_other': and_(surgery, _equals('radical_surgery_type', 'OTHER')),
+        'radical_crt_start_date': crt,
+        'radical_crt_end_date': crt,
+        'radical_crt_consolidation': crt,
+        'radical_crt_consolidation_drug': consolidation,
+        'radical_crt_consolidation_end_date': consolidation,
+        'relapse_date': and_(radical, _equals('radical_treatment_outcome', 'RELAPSE')),
+
+        # ALK
+        'previous_therapy_types_other': _contains('previous_therapy_types', 'OTHER'),
+        'previous_therapy_stop_reason_other': _equals('previous_therapy_stop_reason', 'OTHER'),
+        'metastases_sites_other_text': _contains('metastases_sites', 'OTHER'),
+        'progression_sites_other_text': _contains('progression_sites', 'OTHER'),
+        'alectinib_stop_reason_other': and_(stopped, _equals('alectinib_stop_reason', 'OTHER')),
+        'interruption_reason': and_(stopped, _true('had_treatment_interruption')),
+        'interruption_duration_months': and_(stopped, _true('had_treatment_interruption')),
+        'after_alectinib_progression_sites_other_text': _contains('after_alectinib_progression_sites', 'OTHER'),
+        'next_line_treatments_other_text': _contains('next_line_treatments', 'OTHER'),
+        'next_line_progression_sites_other_text': _contains('next_line_progression_sites', 'OTHER'),
+    }
+    for field in ('previous_therapy_types', 'previous_therapy_start_date', 'previous_therapy_end_date',
+                  'previous_therapy_response', 'previous_therapy_stop_reason'):
+        conditions[field] = _true('had_previous_therapy')
+    for field in ('cns_measurable', 'cns_symptomatic', 'cns_radiotherapy', 'intracranial_response'):
+        conditions[field] = _true('cns_metastases')
+    for field in ('local_treatment_at_progression', 'progression_date', 'continued_after_progression', 'progression_sites'):
+        conditions[field] = progression
+    for field in ('alectinib_end_date', 'alectinib_stop_reason', 'had_treatment_interruption', 'had_dose_reduction',
+                  'next_line_treatments', 'after_alectinib_progression_type', 'after_alectinib_progression_sites',
+                  'after_alectinib_progression_date'):
+        conditions[field] = stopped
+    for field in ('next_line_start_date', 'next_line_end_date', 'progression_on_next_line', 'total_lines_after_alectinib'):
+        conditions[field] = next_line
+    for field in ('progression_on_next_line_date', 'next_line_progression_type', 'next_line_progression_sites'):
+        conditions[field] = next_line_progression
+    return conditions
+
+
+CONDITIONS = _build_conditions()
+
+
+def registry_fields() -> Dict[str, list]:
+    """Поля тепловой карты по регистрам: общие, затем поля расширения регистра"""
+    core = [column.key for column in ClinicalRecord.__table__.columns if column.key not in EXCLUDED_FIELDS]
+    return {
+        registry_type: core + [column.key for column in record_class.__table__.columns if column.key != 'id']
+        for registry_type, record_class in RECORD_CLASSES.items()
+    }
+
+
+def _rate(filled_count: int, expected: int) -> Optional[float]:
+    return round(filled_count / expected * 100, 1) if expected else None
+
+
+def compute_heatmap(db: Session, registry_type: Optional[str] = None, institution_id: Optional[int] = None) -> dict:
+    key = (registry_type, institution_id)
+
+    def compute():
+        fields = [name for name in _columns if name not in EXCLUDED_FIELDS]
+        aggregates = [func.count(ClinicalRecord.id)]
+        for name in fields:
+            condition = CONDITIONS.get(name)
+            if condition is not None:
+                aggregates.append(func.sum(case((condition, 1), else_=0)))
+                aggregates.append(func.sum(case((and_(condition, filled(_columns[name])), 1), else_=0)))
+            else:
+                aggregates.append(func.sum(case((filled(_columns[name]), 1), else_=0)))
+
+        query = db.query(Patient.institution_id, ClinicalRecord.registry_type, *aggregates) \
+            .select_from(Patient).join(ClinicalRecord).filter(Patient.is_active == True)
+        query = join_record_extensions(query)
+        if registry_type:
+            query = query.filter(ClinicalRecord.registry_type == registry_type)
+        if institution_id is not None:
+            query = query.filter(Patient.institution_id == institution_id)
+        rows = query.group_by(Patient.institution_id, ClinicalRecord.registry_type) \
+            .order_by(Patient.institution_id, ClinicalRecord.registry_type).all()
+
+        layout = registry_fields()
+        groups, totals = [], {}
+        for row in rows:
+            inst_id, registry, records = row[0], row[1], row[2]
+            values = iter(row[3:])
+            counts = {}
+            for name in fields:
+                if name in CONDITIONS:
+                    expected, filled_count = next(values), next(values)
+                else:
+                    expected, filled_count = records, next(values)
+                counts[name] = (expected or 0, filled_count or 0)
+
+            registry_total = totals.setdefault(registry, {"records": 0, "counts": {}})
+            registry_total["records"] += records
+            group_fields = {}
+            for name in layout.get(registry, []):
+                expected, filled_count = counts[name]
+                total_expected, total_filled = registry_total["counts"].get(name, (0, 0))
+                registry_total["counts"][name] = (total_expected + expected, total_filled + filled_count)
+                group_fields[name] = {"expected": expected, "filled": filled_count, "rate": _rate(filled_count, expected)}
+            groups.append({
+                "institution_id": inst_id,
+                "institution_name": institution_names.get(db, inst_id),
+                "registry_type": registry,
+                "records": records,
+                "fields": group_fields,
+            })
+
+        return {
+            "filters": {"registry_type": registry_type, "institution_id": institution_id},
+            "fields": {registry: names for registry, names in layout.items() if registry in totals},
+            "groups": groups,
+            "totals": [
+                {
+                    "registry_type": registry,
+                    "records": total["records"],
+                    "fields": {
+                        name: {"expected": expected, "filled": filled_count, "rate": _rate(filled_count, expected)}
+                        for name, (expected, filled_count) in total["counts"].items()
+                    },
+                }
+                for registry, total in totals.items()
+            ],
+        }
+
+    return heatmap_cache.get_or_compute(key, compute)
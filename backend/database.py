@@ -1,21 +1,233 @@
-
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+import json
+import logging
 import os
+import threading
+import time
+from pathlib import Path
+
+from metrics import current_request, InstrumentedQueuePool
+from cache import caches
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./alectinib_registry.db')
 
+# Журнал медленных запросов: порог в миллисекундах (0 - выключено)
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+BACKEND_DIR = Path(__file__).resolve().parent
+
+# Относительный путь отсчитывается от backend/, а не от текущего каталога:
+# иначе запуск из корня репозитория и из backend/ пишет в разные файлы
+# (и logrotate видит только один из них)
+SLOW_QUERY_LOG_PATH = os.getenv('SLOW_QUERY_LOG_PATH', 'slow_queries.log')
+if SLOW_QUERY_LOG_PATH:
+    SLOW_QUERY_LOG_PATH = str(BACKEND_DIR / SLOW_QUERY_LOG_PATH)
+SLOW_QUERY_BUFFER_SIZE = 500
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Несколько процессов gunicorn пишут в один журнал (см. SlowQueryLog)
+MULTIPROCESS = int(os.getenv('WEB_CONCURRENCY', '1')) > 1
+
+# Режим журнала SQLite (например, WAL для нескольких воркеров); пусто - по умолчанию
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', '')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Пул соединений (для SQLite в памяти SQLAlchemy использует собственный пул без этих настроек)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+
+pool_args = {}
+if ':memory:' not in DATABASE_URL and DATABASE_URL.rstrip('/') != 'sqlite:':
+    pool_args = dict(
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith('sqlite') else {}
+    connect_args={"check_same_thread": False} if DATABASE_URL.startswith('sqlite') else {},
+    **pool_args
 )
 
+if DATABASE_URL.startswith('sqlite'):
+    @event.listens_for(engine, "connect")
+    def _configure_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        if SQLITE_JOURNAL_MODE:
+            cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def get_db():
     """Dependency for getting DB session"""
+    # Первая синхронная зависимость запроса: время до нее - ожидание свободного потока
+    stats = current_request.get()
+    if stats is not None and stats.threadpool_wait is None:
+        stats.threadpool_wait = time.perf_counter() - stats.started
     db = SessionLocal()
     try:
+        # Согласование кэшей между воркерами (no-op в однопроцессном режиме)
+        caches.sync(db)
         yield db
     finally:
         db.close()
+
+def ensure_table(table):
+    """CREATE TABLE при старте; воркеры gunicorn стартуют одновременно и могут создавать таблицу параллельно"""
+    try:
+        table.create(bind=engine, checkfirst=True)
+    except OperationalError:
+        # Таблицу (или ее индекс) успел создать другой воркер
+        if not inspect(engine).has_table(table.name):
+            raise
+
+# ==================== SLOW QUERY LOG ====================
+
+def _tail_lines(path: str, limit: int) -> list:
+    """Последние limit строк файла (чтение блоками с конца)"""
+    with open(path, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= limit:
+            step = min(TAIL_BLOCK_SIZE, position)
+            position -= step
+            file.seek(position)
+            data = file.read(step) + data
+    return data.decode("utf-8", errors="replace").splitlines()[-limit:]
+
+
+class SlowQueryLog:
+    """Медленные SQL-запросы: последние записи в памяти и файл JSON lines.
+
+    Один процесс ротирует файл сам (RotatingFileHandler). Ротация из нескольких
+    воркеров gunicorn затирала бы записи, поэтому тогда файл открывается через
+    WatchedFileHandler (ротацию выполняет logrotate, config/alectinib-registry.logrotate),
+    а последние записи читаются из общего файла, а не из памяти воркера.
+    """
+
+    def __init__(self, threshold_ms: float, path: str, buffer_size: int, multiprocess: bool = False):
+        self.threshold = threshold_ms / 1000.0
+        self.path = path
+        self.multiprocess = multiprocess
+        self.entries = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger("registry.slow_queries")
+        self.logger.propagate = False
+        if threshold_ms > 0 and path and not self.logger.handlers:
+            self.logger.addHandler(self._handler())
+            self.logger.setLevel(logging.INFO)
+
+    def _handler(self) -> logging.Handler:
+        if self.multiprocess:
+            handler = WatchedFileHandler(self.path, encoding="utf-8")
+        else:
+            handler = RotatingFileHandler(self.path, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        return handler
+
+    def reopen(self):
+        """Вызывается в воркере после fork: у каждого процесса свой дескриптор файла"""
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+            self.logger.addHandler(self._handler())
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def record(self, entry: dict):
+        with self._lock:
+            self.entries.append(entry)
+        self.logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+    def recent(self, limit: int = 100) -> list:
+        if self.multiprocess and self.logger.handlers:
+            # Записи всех воркеров есть только в общем файле
+            try:
+                lines = _tail_lines(self.path, limit)
+            except FileNotFoundError:
+                return []
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # строка, дописываемая другим воркером
+            return entries[::-1]
+        with self._lock:
+            return list(self.entries)[-limit:][::-1]
+
+
+def redact_parameters(parameters, max_rows: int = 3):
+    """Оставляет только целые числа и флаги (id, limit/offset); строки, даты и дроби могут содержать ПДн"""
+    if isinstance(parameters, dict):
+        return {key: redact_parameters(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        # executemany: достаточно первых строк
+        return [redact_parameters(value) for value in parameters[:max_rows]]
+    if parameters is None or isinstance(parameters, (bool, int)):
+        return parameters
+    return f"<{type(parameters).__name__}>"
+
+
+def explain_query_plan(cursor, statement, parameters):
+    # Отдельный курсор на том же соединении, чтобы не вызывать события движка повторно
+    try:
+        plan_cursor = cursor.connection.cursor()
+        try:
+            plan_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return [row[-1] for row in plan_cursor.fetchall()]
+        finally:
+            plan_cursor.close()
+    except Exception as e:
+        return [f"unavailable: {e}"]
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_LOG_PATH, SLOW_QUERY_BUFFER_SIZE, MULTIPROCESS)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _slow_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _slow_query_check(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["slow_query_start"].pop()
+    if not slow_query_log.enabled or elapsed < slow_query_log.threshold:
+        return
+
+    stats = current_request.get()
+    plan = None
+    if conn.dialect.name == "sqlite" and not executemany and statement.lstrip().upper().startswith("SELECT"):
+        plan = explain_query_plan(cursor, statement, parameters)
+
+    slow_query_log.record({
+        "timestamp": datetime.utcnow().isoformat(timespec="milliseconds"),
+        "duration_ms": round(elapsed * 1000, 2),
+        "method": stats.method if stats else None,
+        "route": stats.route if stats else None,
+        "user_id": stats.user_id if stats else None,
+        "statement": statement,
+        "parameters": redact_parameters(parameters),
+        "executemany": executemany,
+        "plan": plan,
+    })
+
+
+@event.listens_for(engine, "handle_error")
+def _slow_query_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("slow_query_start"):
+        conn.info["slow_query_start"].pop()
@@ -0,0 +1,60 @@
+"""
+Инкрементальная выгрузка пациентов по updated_at
+
+GET /api/export/patients?since=<курсор|ISO-время> отдает только пациентов, чья запись
+изменилась после курсора (изменение клинической записи обновляет Patient.updated_at),
+включая мягко удаленных - строкой-надгробием. Выборка идет по индексу updated_at
+в порядке (updated_at, id); курсор - закодированная пара последней отданной строки,
+поэтому пациенты с одинаковым updated_at не теряются и не повторяются между порциями.
+
+Изменения последних DELTA_LAG_SECONDS в выгрузку не попадают: updated_at ставится до
+коммита, и запись, закоммиченная чуть позже, иначе могла бы оказаться за курсором.
+"""
+import base64
+import binascii
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, or_
+
+from models import Patient
+
+DELTA_LAG_SECONDS = 30
+
+Key = Tuple[datetime, int]
+
+
+def encode_cursor(key: Key) -> str:
+    updated_at, patient_id = key
+    return base64.urlsafe_b64encode(f"{updated_at.isoformat()}|{patient_id}".encode()).decode().rstrip("=")
+
+
+def parse_since(value: str) -> Key:
+    """Момент времени ISO 8601 (UTC) или курсор из X-Export-Cursor; ошибки - ValueError"""
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        pass
+    else:
+        if moment.tzinfo is not None:
+            moment = (moment - moment.utcoffset()).replace(tzinfo=None)
+        return moment, 0
+    try:
+        stamp, patient_id = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode().split("|")
+        return datetime.fromisoformat(stamp), int(patient_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid since value: {value}")
+
+
+def upper_bound(now: Optional[datetime] = None) -> datetime:
+    return (now or datetime.utcnow()) - timedelta(seconds=DELTA_LAG_SECONDS)
+
+
+def changed_since(query, since: Key, until: datetime):
+    """Пациенты (включая неактивных) с (updated_at, id) > since и updated_at < until"""
+    updated_at, patient_id = since
+    return query.filter(
+        Patient.updated_at >= updated_at,
+        or_(Patient.updated_at > updated_at, and_(Patient.updated_at == updated_at, Patient.id > patient_id)),
+        Patient.updated_at < until,
+    ).order_by(Patient.updated_at, Patient.id)
@@ -0,0 +1,142 @@
+"""
+Распределения показателей когорты
+
+    числовые поля    гистограмма с фиксированной шириной интервала и сводка
+                     (n, пропуски, среднее, минимум, квартили, медиана, максимум)
+    категориальные   число записей по каждому коду (по убыванию) и пропуски
+
+Нужные колонки когорты выбираются одним запросом в массивы NumPy, распределения
+считаются векторно. Когорта задается деревом фильтров конструктора когорт
+(cohorts.py) и фильтрами учреждения/регистра; group_by разбивает ее на группы.
+Результаты кэшируются по когорте и версии данных пациентов.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from cache import VersionedResultCache, patient_data_version, institution_names
+from cohorts import compile_filter, filter_hash
+from models import Patient, ClinicalRecord, clinical_record_columns, join_record_extensions
+
+# Поле -> ширина интервала гистограммы
+NUMERIC_FIELDS = {
+    'age_at_diagnosis': 5,
+    'ecog_at_start': 1,
+    'pdl1_tps': 10,
+}
+CATEGORICAL_FIELDS = ('tnm_stage', 'histology', 'alk_fusion_variant', 'maximum_response')
+GROUP_BY_FIELDS = ('institution', 'registry_type')
+QUANTILES = (25, 50, 75)
+
+distribution_cache = VersionedResultCache(patient_data_version, maxsize=64)
+
+
+def numeric_distribution(values: np.ndarray, width: float) -> dict:
+    present = values[~np.isnan(values)]
+    summary = {"n": int(present.size), "missing": int(values.size - present.size)}
+    if not present.size:
+        return dict(summary, mean=None, min=None, q25=None, median=None, q75=None, max=None, histogram=[])
+
+    q25, median, q75 = np.percentile(present, QUANTILES)
+    starts, counts = np.unique(np.floor(present / width) * width, return_counts=True)
+    return dict(
+        summary,
+        mean=round(float(present.mean()), 2),
+        min=float(present.min()),
+        q25=round(float(q25), 2),
+        median=round(float(median), 2),
+        q75=round(float(q75), 2),
+        max=float(present.max()),
+        histogram=[
+            {"from": float(start), "to": float(start + width), "count": int(count)}
+            for start, count in zip(starts, counts)
+        ],
+    )
+
+
+def categorical_distribution(values: np.ndarray) -> dict:
+    present = values[values != None]  # noqa: E711 - поэлементное сравнение NumPy
+    codes, counts = np.unique(present.astype(str), return_counts=True) if present.size else ([], [])
+    order = sorted(zip(codes, counts), key=lambda item: (-item[1], item[0]))
+    return {
+        "n": int(present.size),
+        "missing": int(values.size - present.size),
+        "counts": [{"code": str(code), "count": int(count)} for code, count in order],
+    }
+
+
+def extract_columns(db: Session, tree: Optional[dict], registry_type: Optional[str],
+                    institution_id: Optional[int]) -> Dict[str, np.ndarray]:
+    """Один запрос по когорте; колонки расширений ALK/ROS1 - через LEFT JOIN их таблиц"""
+    by_name = {column.key: column for column in clinical_record_columns()}
+    fields = list(NUMERIC_FIELDS) + list(CATEGORICAL_FIELDS)
+    selected = [by_name[field] for field in fields]
+    condition = compile_filter(tree) if tree is not None else None
+    query = db.query(*selected, Patient.institution_id, ClinicalRecord.registry_type) \
+        .select_from(Patient).join(ClinicalRecord).filter(Patient.is_active == True)
+    query = join_record_extensions(query, *selected, *([condition] if condition is not None else []))
+
+    if condition is not None:
+        query = query.filter(condition)
+    if registry_type:
+        query = query.filter(ClinicalRecord.registry_type == registry_type)
+    if institution_id is not None:
+        query = query.filter(Patient.institution_id == institution_id)
+
+    rows = query.all()
+    columns = list(zip(*rows)) if rows else [()] * (len(fields) + 2)
+    result = {
+        field: np.array(column, dtype=float if field in NUMERIC_FIELDS else object)
+        for field, column in zip(fields, columns)
+    }
+    result["institution"] = np.array(columns[-2], dtype=object)
+    result["registry_type"] = np.array(columns[-1], dtype=object)
+    return result
+
+
+def compute_distributions(db: Session, tree: Optional[dict] = None, registry_type: Optional[str] = None,
+                          institution_id: Optional[int] = None, group_by: Optional[str] = None) -> dict:
+    """Ошибки дерева фильтров - CohortFilterError"""
+    digest = filter_hash(tree) if tree is not None else None
+    key = (digest, registry_type, institution_id, group_by)
+
+    def compute():
+        columns = extract_columns(db, tree, registry_type, institution_id)
+        if group_by:
+            values = columns[group_by]
+            groups = sorted(set(values.tolist()), key=lambda value: (value is None, value if value is not None else 0))
+            masks = [(value, values == value) for value in groups]
+        else:
+            masks = [(None, np.ones(columns["registry_type"].size, dtype=bool))]
+
+        cohorts: List[dict] = []
+        for value, mask in masks:
+            if group_by == "institution":
+                label = institution_names.get(db, value)
+            else:
+                label = value if group_by else "Все пациенты"
+            cohorts.append({
+                "group": label,
+                "group_value": value,
+                "patients": int(mask.sum()),
+                "numeric": {
+                    field: numeric_distribution(columns[field][mask], width)
+                    for field, width in NUMERIC_FIELDS.items()
+                },
+                "categorical": {
+                    field: categorical_distribution(columns[field][mask]) for field in CATEGORICAL_FIELDS
+                },
+            })
+
+        return {
+            "filters": {
+                "filter_hash": digest,
+                "registry_type": registry_type,
+                "institution_id": institution_id,
+            },
+            "group_by": group_by,
+            "cohorts": cohorts,
+        }
+
+    return distribution_cache.get_or_compute(key, compute)
@@ -0,0 +1,219 @@
+"""
+Лента изменений пациентов и справочников (Server-Sent Events)
+
+Обработчики записи вызывают publish() перед коммитом: событие (пациент, учреждение,
+измененные поля, версия) записывается в таблицу change_events тем же коммитом, id
+строки служит номером события. Так лента общая для всех воркеров gunicorn: каждый процесс держит
+один опрашивающий таск, который читает новые строки (сразу после publish в этом
+процессе или раз в EVENTS_POLL_INTERVAL_SECONDS) и раздает их подписчикам.
+
+У каждого подписчика своя очередь на EVENTS_QUEUE_SIZE событий. Медленный клиент не
+задерживает остальных: при переполнении его очередь очищается и он получает событие
+resync (перечитать данные целиком). Клиент, переподключившийся с Last-Event-ID,
+получает пропущенные события, если они еще хранятся (последние EVENTS_RETENTION).
+Пользователь, кроме администратора, получает события только своего учреждения.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Optional, Set
+
+import anyio
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.orm import Session
+
+from database import engine
+from models import ChangeEvent
+
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '100'))
+EVENTS_POLL_INTERVAL_SECONDS = float(os.getenv('EVENTS_POLL_INTERVAL_SECONDS', '1'))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', '15'))
+EVENTS_RETENTION = int(os.getenv('EVENTS_RETENTION', '10000'))
+FETCH_BATCH_SIZE = 500
+PRUNE_INTERVAL_SECONDS = 60
+
+
+def publish(db: Session, kind: str, action: str, audience: Optional[int], **payload):
+    """Добавляет событие в сессию: оно фиксируется тем же коммитом, что и изменение.
+
+    audience - учреждение, пользователям которого видно событие (None - всем)
+    """
+    db.add(ChangeEvent(kind=kind, action=action, institution_id=audience, payload=payload))
+    db.info["change_events"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_after_commit(session):
+    if session.info.pop("change_events", False):
+        broker.notify()
+
+
+def patient_event(db: Session, action: str, patient, fields=()):
+    publish(
+        db, "patient", action, patient.institution_id,
+        patient_id=patient.id,
+        institution_id=patient.institution_id,
+        fields=sorted(fields),
+        version=patient.updated_at.isoformat() if patient.updated_at else None,
+    )
+
+
+def dictionary_event(db: Session, action: str, entry, fields=()):
+    publish(
+        db, "dictionary", action, None,
+        dictionary_id=entry.id,
+        category=entry.category,
+        code=entry.code,
+        fields=sorted(fields),
+    )
+
+
+def format_event(event_id: int, kind: str, data: dict) -> str:
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class Subscriber:
+    def __init__(self, institution_id: Optional[int], after: int):
+        # institution_id None - администратор, видит все события
+        self.institution_id = institution_id
+        self.after = after
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+
+    def visible(self, row) -> bool:
+        return self.institution_id is None or row.institution_id is None or row.institution_id == self.institution_id
+
+    def resync(self, position: int):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.after = position
+        self.queue.put_nowait(format_event(position, "resync", {"id": position}))
+
+
+def _latest_id() -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(func.max(ChangeEvent.id))).scalar() or 0
+
+
+def _oldest_id() -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(func.min(ChangeEvent.id))).scalar() or 0
+
+
+def _prune():
+    with engine.begin() as connection:
+        latest = connection.execute(select(func.max(ChangeEvent.id))).scalar() or 0
+        connection.execute(delete(ChangeEvent).where(ChangeEvent.id <= latest - EVENTS_RETENTION))
+
+
+def _fetch_after(after: int, limit: int) -> list:
+    columns = (ChangeEvent.id, ChangeEvent.kind, ChangeEvent.action, ChangeEvent.institution_id, ChangeEvent.payload)
+    with engine.connect() as connection:
+        return connection.execute(
+            select(*columns).where(ChangeEvent.id > after).order_by(ChangeEvent.id).limit(limit)
+        ).all()
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers: Set[Subscriber] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """Вызывается из рабочих потоков обработчиков"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def subscribe(self, institution_id: Optional[int], last_event_id: Optional[int]) -> Subscriber:
+        latest = await anyio.to_thread.run_sync(_latest_id)
+        subscriber = Subscriber(institution_id, latest)
+        if last_event_id is not None and last_event_id < latest:
+            oldest = await anyio.to_thread.run_sync(_oldest_id)
+            if last_event_id + 1 >= oldest:
+                # Пропущенные события дочитает опрашивающий таск
+                subscriber.after = last_event_id
+                self._wakeup.set()
+            else:
+                subscriber.resync(latest)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+    async def _poll(self):
+        pruned = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), EVENTS_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if self._loop.time() - pruned > PRUNE_INTERVAL_SECONDS:
+                    pruned = self._loop.time()
+                    await anyio.to_thread.run_sync(_prune)
+                if not self._subscribers:
+                    continue
+                start = min(subscriber.after for subscriber in self._subscribers)
+                rows = await anyio.to_thread.run_sync(_fetch_after, start, FETCH_BATCH_SIZE)
+            except Exception:
+                continue  # БД временно недоступна - повторим на следующем шаге
+            for row in rows:
+                self._fanout(row)
+            if len(rows) == FETCH_BATCH_SIZE:
+                self._wakeup.set()
+
+    def _fanout(self, row):
+        message = None
+        for subscriber in list(self._subscribers):
+            if row.id <= subscriber.after:
+                continue
+            subscriber.after = row.id
+            if not subscriber.visible(row):
+                continue
+            if message is None:
+                message = format_event(row.id, row.kind, dict(row.payload, id=row.id, action=row.action))
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                subscriber.resync(row.id)
+
+
+broker = EventBroker()
+
+
+async def stream(subscriber: Subscriber):
+    """Тело ответа text/event-stream; при отключении клиента подписка снимается"""
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(subscriber.queue.get(), EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                yield f": keepalive {datetime.utcnow().isoformat(timespec='seconds')}\n\n"
+                continue
+            yield message
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,290 @@
+"""
+Фоновые выгрузки пациентов в CSV
+
+POST /api/export/jobs ставит выгрузку в очередь пула EXPORT_WORKERS потоков и сразу
+возвращает id задания. Задание пишет CSV (по желанию сжатый gzip) в EXPORT_DIR,
+раз в PROGRESS_INTERVAL_SECONDS сохраняет прогресс в export_jobs, а готовый файл
+отдается с поддержкой Range (докачка прерванной загрузки). Состояние хранится в БД,
+поэтому статус виден из любого воркера gunicorn; файлы лежат в общем каталоге.
+
+Завершенные задания (вместе с файлами) удаляются через EXPORT_RETENTION_HOURS:
+фоновым потоком раз в EXPORT_PURGE_INTERVAL_SECONDS, при постановке нового задания
+и при обращении к просроченному заданию (оно отвечает 404, как удаленное).
+Задания, чей процесс завершился (перезапуск сервера), при старте помечаются
+как failed. Отмена выполняющегося задания замечается при очередном сохранении
+прогресса: строка export_jobs уже не в статусе running.
+"""
+import gzip
+import io
+import os
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import delete, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from database import engine, SessionLocal
+from models import ExportJob
+
+EXPORT_DIR = Path(os.getenv('EXPORT_DIR', 'exports'))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '2'))
+EXPORT_RETENTION_HOURS = float(os.getenv('EXPORT_RETENTION_HOURS', '24'))
+EXPORT_PURGE_INTERVAL_SECONDS = float(os.getenv('EXPORT_PURGE_INTERVAL_SECONDS', '600'))
+PROGRESS_INTERVAL_SECONDS = 1.0
+CHUNK_SIZE = 64 * 1024
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+ACTIVE_STATUSES = ('queued', 'running')
+
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+logger = logging.getLogger("registry.export_jobs")
+_purge_thread: Optional[threading.Thread] = None
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def export_filename(mode: str, labels: Optional[str], moment: datetime, compressed: bool = False) -> str:
+    prefix = "patients_full_export" if mode == "full" else "patients_export"
+    if labels == "ru":
+        prefix += "_ru"
+    return f"{prefix}_{moment.strftime('%Y%m%d_%H%M%S')}.csv" + (".gz" if compressed else "")
+
+
+def _artifact_path(job_id: str, params: dict) -> Path:
+    return EXPORT_DIR / (f"{job_id}.csv.gz" if params.get("gzip") else f"{job_id}.csv")
+
+
+def artifact_path(job: ExportJob) -> Path:
+    return _artifact_path(job.id, job.params)
+
+
+def get_job(db: Session, job_id: str, user_id: int) -> Optional[ExportJob]:
+    # id проверяется по шаблону, чтобы исключить выход за пределы каталога
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    job = db.query(ExportJob).filter(ExportJob.id == job_id, ExportJob.user_id == user_id).first()
+    if job is not None and job.expires_at is not None and job.expires_at < datetime.utcnow():
+        # Просроченное задание удаляется при первом обращении, не дожидаясь фоновой очистки
+        _purge(db, [(job.id, job.params)])
+        return None
+    return job
+
+
+def job_status(job: ExportJob) -> dict:
+    total = job.rows_total
+    return {
+        "id": job.id,
+        "status": job.status,
+        "params": job.params,
+        "rows_done": job.rows_done,
+        "rows_total": total,
+        "progress": round(job.rows_done / total * 100, 1) if total else (100.0 if job.status == 'done' else 0.0),
+        "file_name": job.file_name,
+        "size_bytes": job.size_bytes,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "expires_at": job.expires_at,
+    }
+
+
+def submit(db: Session, user_id: int, params: dict, write_csv: Callable) -> ExportJob:
+    """write_csv(db, output, progress=..., **params) пишет строки CSV в текстовый поток"""
+    purge_expired(db)
+    job = ExportJob(id=uuid.uuid4().hex, user_id=user_id, status='queued', params=params, pid=os.getpid())
+    db.add(job)
+    db.commit()
+    executor.submit(_run, job.id, write_csv)
+    return job
+
+
+def _set_state(job_id: str, expected: Optional[str] = None, **values) -> bool:
+    statement = update(ExportJob).where(ExportJob.id == job_id)
+    if expected is not None:
+        statement = statement.where(ExportJob.status == expected)
+    with engine.begin() as connection:
+        return connection.execute(statement.values(**values)).rowcount > 0
+
+
+def _run(job_id: str, write_csv: Callable):
+    if not _set_state(job_id, 'queued', status='running', started_at=datetime.utcnow()):
+        return  # задание отменено, пока стояло в очереди
+
+    db = SessionLocal()
+    part = None
+    try:
+        job = db.get(ExportJob, job_id)
+        params = dict(job.params)
+        compressed = params.pop("gzip", False)
+        path = artifact_path(job)
+        part = path.with_name(path.name + ".part")
+        EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+
+        last_saved = time.monotonic()
+
+        def progress(done: int, total: int):
+            nonlocal last_saved
+            now = time.monotonic()
+            if now - last_saved < PROGRESS_INTERVAL_SECONDS and done < total:
+                return
+            last_saved = now
+            if not _set_state(job_id, 'running', rows_done=done, rows_total=total):
+                raise ExportCancelled()
+
+        raw = gzip.open(part, 'wb', compresslevel=6) if compressed else open(part, 'wb')
+        # utf-8-sig - BOM для Excel, как в синхронной выгрузке
+        with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as output:
+            write_csv(db, output, progress=progress, **params)
+        part.replace(path)
+
+        finished = datetime.utcnow()
+        if not _set_state(job_id, 'running', status='done', finished_at=finished, size_bytes=path.stat().st_size,
+                          file_name=export_filename(params.get("mode"), params.get("labels"), job.created_at, compressed),
+                          expires_at=finished + timedelta(hours=EXPORT_RETENTION_HOURS)):
+            path.unlink(missing_ok=True)
+    except ExportCancelled:
+        pass
+    except Exception as exc:
+        finished = datetime.utcnow()
+        _set_state(job_id, 'running', status='failed', error=str(exc)[:1000], finished_at=finished,
+                   expires_at=finished + timedelta(hours=EXPORT_RETENTION_HOURS))
+    finally:
+        db.close()
+        if part is not None:
+            part.unlink(missing_ok=True)
+
+
+def cancel(db: Session, job: ExportJob) -> bool:
+    """Активное задание помечается cancelled (воркер прервет его сам), завершенное удаляется с файлом"""
+    active = job.status in ACTIVE_STATUSES
+    if active:
+        finished = datetime.utcnow()
+        job.status = 'cancelled'
+        job.finished_at = finished
+        job.expires_at = finished + timedelta(hours=EXPORT_RETENTION_HOURS)
+    else:
+        artifact_path(job).unlink(missing_ok=True)
+        db.delete(job)
+    db.commit()
+    return active
+
+
+def _purge(db: Session, jobs: list):
+    """Удаляет файлы и строки заданий [(id, params)]; строку, уже удаленную другим воркером, пропускает"""
+    for job_id, params in jobs:
+        _artifact_path(job_id, params).unlink(missing_ok=True)
+    db.execute(delete(ExportJob).where(ExportJob.id.in_([job_id for job_id, _ in jobs])))
+    db.commit()
+
+
+def purge_expired(db: Session) -> int:
+    expired = db.query(ExportJob.id, ExportJob.params).filter(ExportJob.expires_at < datetime.utcnow()).all()
+    if expired:
+        _purge(db, expired)
+    return len(expired)
+
+
+def start_purge_timer():
+    """Фоновая очистка просроченных выгрузок: файлы удаляются и без новых заданий"""
+    global _purge_thread
+    if _purge_thread is not None or EXPORT_PURGE_INTERVAL_SECONDS <= 0:
+        return
+
+    def loop():
+        while True:
+            time.sleep(EXPORT_PURGE_INTERVAL_SECONDS)
+            db = SessionLocal()
+            try:
+                purge_expired(db)
+            except (OSError, SQLAlchemyError):
+                logger.exception("Export purge failed")
+            finally:
+                db.close()
+
+    _purge_thread = threading.Thread(target=loop, name="export-purge", daemon=True)
+    _purge_thread.start()
+
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover(db: Session):
+    """Задания процессов, которых больше нет, не завершатся: помечаются failed"""
+    finished = datetime.utcnow()
+    for job in db.query(ExportJob).filter(ExportJob.status.in_(ACTIVE_STATUSES)).all():
+        if not _process_alive(job.pid):
+            job.status = 'failed'
+            job.error = 'Выгрузка прервана перезапуском сервера'
+            job.finished_at = finished
+            job.expires_at = finished + timedelta(hours=EXPORT_RETENTION_HOURS)
+            artifact_path(job).with_name(artifact_path(job).name + ".part").unlink(missing_ok=True)
+    db.commit()
+    purge_expired(db)
+
+
+def _read_range(path: Path, start: int, length: int):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(request: Request, path: Path, filename: str, media_type: str, etag: str) -> Response:
+    """Файл целиком (200) или один диапазон байт из заголовка Range (206/416)"""
+    size = path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+    start, end = 0, size - 1
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    # Несколько диапазонов, неверный синтаксис или устаревший If-Range - отдаем файл целиком
+    if match and (if_range is None or if_range == etag) and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+        if start >= size or start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        status_code = 206
+    else:
+        status_code = 200
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_read_range(path, start, end - start + 1), status_code=status_code,
+                             media_type=media_type, headers=headers)
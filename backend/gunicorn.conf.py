@@ -0,0 +1,56 @@
+"""
+Конфигурация gunicorn для запуска нескольких процессов-воркеров uvicorn
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Число воркеров - WEB_CONCURRENCY. При preload_app приложение импортируется один
+раз в мастер-процессе, и воркеры разделяют страницы памяти с кодом (copy-on-write).
+"""
+import os
+import tempfile
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Приложение читает эти переменные при импорте: число воркеров включает сверку кэшей
+# и журнал медленных запросов без встроенной ротации, каталог - сбор метрик всех воркеров
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+if workers > 1:
+    os.environ.setdefault('METRICS_MULTIPROC_DIR', os.path.join(
+        tempfile.gettempdir(), f"alectinib-registry-metrics-{os.getenv('PORT', '5000')}"))
+
+# Код приложения загружается до fork. Минус: SIGHUP перезапускает воркеры, но не
+# перечитывает код - после обновления нужен systemctl restart (или GUNICORN_PRELOAD=0)
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+# Ожидание завершения текущих запросов при перезапуске/остановке воркера
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+# Плавный перезапуск воркеров для ограничения роста памяти (0 - выключено)
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    from metrics import worker_snapshots
+    worker_snapshots.reset()
+
+
+def post_fork(server, worker):
+    # Соединения, открытые в мастере при импорте, не должны использоваться двумя процессами
+    from database import engine, slow_query_log
+    engine.dispose(close=False)
+    # Файл журнала открывается заново в каждом воркере
+    slow_query_log.reopen()
+
+
+def child_exit(server, worker):
+    # Счетчики завершившегося воркера остаются в сумме /api/metrics
+    from metrics import worker_snapshots
+    if worker_snapshots.enabled:
+        worker_snapshots.mark_dead(worker.pid)
@@ -4,18 +4,163 @@
 Создает таблицы, первого администратора и заполняет справочники
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, Column, ForeignKey, JSON, MetaData, String, Table, Text, and_, case, column, func, inspect, or_, select, table, text
 from sqlalchemy.orm import sessionmaker
-from models import Base, User, Institution, Dictionary
+from models import Base, User, Institution, Patient, ClinicalRecord, SeedChecksum, RECORD_CLASSES
 from database import engine
+from seed import seed_dictionaries
+import code_index
+import therapy_lines
 import sys
+from typing import Optional
 from datetime import datetime
 
-def init_database():
+class ForeignFieldsError(Exception):
+    """В записях заполнены поля другого регистра: при разделении таблицы они будут потеряны"""
+
+    def __init__(self, counts: dict):
+        self.counts = counts
+        details = ", ".join(f"{registry_type}.{name}: {count}" for (registry_type, name), count in sorted(counts.items()))
+        super().__init__(
+            f"{sum(counts.values())} values of other-registry fields would be discarded ({details}). "
+            f"Export them if needed and rerun with --discard-foreign-fields"
+        )
+
+
+def _has_value(legacy_column, model_column):
+    """Поле заполнено: не NULL, не пустая строка/список и не значение по умолчанию модели"""
+    condition = legacy_column.isnot(None)
+    if isinstance(model_column.type, JSON):
+        condition = and_(condition, legacy_column.notin_(['[]', 'null', '""', '']))
+    elif isinstance(model_column.type, (String, Text)):
+        condition = and_(condition, func.trim(legacy_column) != '')
+    default = model_column.default
+    if default is not None and default.is_scalar:
+        condition = and_(condition, legacy_column != default.arg)
+    return condition
+
+
+def foreign_field_values(connection, legacy, legacy_names) -> dict:
+    """Число заполненных значений полей чужого регистра: {(registry_type, поле): записей}"""
+    counts = {}
+    for registry_type in RECORD_CLASSES:
+        foreign = [
+            model_column
+            for other_type, record_class in RECORD_CLASSES.items() if other_type != registry_type
+            for model_column in record_class.__table__.columns
+            if model_column.key != 'id' and model_column.key in legacy_names
+        ]
+        if not foreign:
+            continue
+        row = connection.execute(select(*(
+            func.coalesce(func.sum(case((_has_value(legacy.c[model_column.key], model_column), 1), else_=0)), 0)
+            for model_column in foreign
+        )).where(legacy.c.registry_type == registry_type)).one()
+        for model_column, count in zip(foreign, row):
+            if count:
+                counts[(registry_type, model_column.key)] = count
+    return counts
+
+
+def split_clinical_records(connection, discard_foreign: bool = False) -> int:
+    """Переносит поля регистров из прежней широкой clinical_records в таблицы расширений.
+
+    Строки копируются в clinical_records_alk / clinical_records_ros1 по registry_type,
+    затем общая таблица пересоздается без перенесенных колонок (SQLite не умеет
+    удалять много колонок за один проход). Возвращает число перенесенных записей.
+
+    Поля другого регистра (например, поле ALK в записи ROS1) переносить некуда. Если
+    такие значения есть, перенос прерывается ForeignFieldsError до каких-либо изменений;
+    с discard_foreign=True они отбрасываются, а их число печатается.
+    """
+    core = ClinicalRecord.__table__
+    legacy_names = {info['name'] for info in inspect(connection).get_columns(core.name)}
+    if legacy_names <= set(core.columns.keys()):
+        return 0
+    legacy = table(core.name, *(column(name) for name in legacy_names))
+
+    # Запись без известного типа регистра раньше считалась ALK (значение по умолчанию)
+    connection.execute(legacy.update().where(or_(
+        legacy.c.registry_type.is_(None), legacy.c.registry_type.notin_(list(RECORD_CLASSES))
+    )).values(registry_type='ALK'))
+
+    foreign = foreign_field_values(connection, legacy, legacy_names)
+    if foreign and not discard_foreign:
+        raise ForeignFieldsError(foreign)
+    for (registry_type, name), count in sorted(foreign.items()):
+        print(f"⚠️  Discarding {count} values of {name} in {registry_type} records")
+
+    moved = 0
+    for registry_type, record_class in RECORD_CLASSES.items():
+        extension = record_class.__table__
+        names = [name for name in extension.columns.keys() if name in legacy_names]
+        moved += connection.execute(extension.insert().from_select(
+            names, select(*(legacy.c[name] for name in names)).where(legacy.c.registry_type == registry_type)
+        )).rowcount
+
+    # Новая общая таблица без индексов: они создаются после переименования
+    rebuilt = Table(f"{core.name}_split", MetaData(), *(
+        Column(col.name, col.type, *(ForeignKey(fk.column) for fk in col.foreign_keys),
+               primary_key=col.primary_key, nullable=col.nullable, unique=col.unique)
+        for col in core.columns
+    ))
+    rebuilt.create(connection)
+    names = [name for name in core.columns.keys() if name in legacy_names]
+    connection.execute(rebuilt.insert().from_select(names, select(*(legacy.c[name] for name in names))))
+    connection.execute(text(f"DROP TABLE {core.name}"))
+    connection.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {core.name}"))
+    return moved
+
+TOMBSTONE_BACKFILL = "tombstone_backfill"
+
+
+def backfill_tombstones(connection) -> Optional[int]:
+    """Однократно обновляет updated_at пациентов, удаленных до инкрементальной выгрузки.
+
+    Без этого их надгробия не попали бы в GET /api/export/patients?since=...: время
+    изменения таких строк старше курсора, а полная выгрузка неактивных не содержит.
+    Отметка о выполнении хранится в seed_checksums; возвращает число строк или None,
+    если перенос уже выполнен.
+    """
+    applied = connection.execute(
+        select(SeedChecksum.name).where(SeedChecksum.name == TOMBSTONE_BACKFILL)
+    ).first()
+    if applied is not None:
+        return None
+    now = datetime.utcnow()
+    updated = connection.execute(
+        Patient.__table__.update().where(Patient.is_active == False).values(updated_at=now)
+    ).rowcount
+    connection.execute(SeedChecksum.__table__.insert().values(name=TOMBSTONE_BACKFILL, checksum="1", applied_at=now))
+    return updated
+
+def init_database(force: bool = False, discard_foreign: bool = False):
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    try:
+        with engine.begin() as connection:
+            moved = split_clinical_records(connection, discard_foreign)
+    except ForeignFieldsError as e:
+        # Транзакция откатана: таблица осталась прежней
+        print(f"\n✗ Clinical records were not split: {e}")
+        sys.exit(1)
+    if moved:
+        print(f"✓ Clinical records split into registry tables: {moved} records")
+    # create_all не добавляет новые индексы в уже существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
     print("✓ Tables created successfully")
     
+    with engine.begin() as connection:
+        tombstones = backfill_tombstones(connection)
+        if tombstones:
+            print(f"✓ Deleted patients queued for the next delta export: {tombstones}")
+        if code_index.needs_rebuild(connection):
+            print(f"✓ Code index rebuilt: {code_index.rebuild(connection)} entries")
+        if therapy_lines.needs_rebuild(connection):
+            print(f"✓ Therapy lines rebuilt: {therapy_lines.rebuild(connection)} lines")
+    
     SessionLocal = sessionmaker(bind=engine)
     db = SessionLocal()
     
@@ -434,34 +579,14 @@ def init_database():
             },
         ]
         
-        total_inserted = 0
-        for dict_cat in dictionaries:
-            category = dict_cat["category"]
-            for item in dict_cat["items"]:
-                if len(item) == 4:
-                    code, value_ru, sort_order, parent = item
-                else:
-                    code, value_ru, sort_order = item
-                    parent = None
-
-                existing = db.query(Dictionary).filter_by(category=category, code=code).first()
-                
-                if not existing:
-                    dict_entry = Dictionary(
-                        category=category, code=code, value_ru=value_ru,
-                        sort_order=sort_order, parent=parent
-                    )
-                    db.add(dict_entry)
-                    total_inserted += 1
-                else:
-                    # Update if exists
-                    existing.value_ru = value_ru
-                    existing.sort_order = sort_order
-                    if parent is not None:
-                        existing.parent = parent
-        
+        # Существующие записи (названия и порядок могли изменить через интерфейс
+        # справочников) обновляются только с --force; обычный запуск добавляет новые коды
+        result = seed_dictionaries(db, "init_db.dictionaries", dictionaries, force=force, insert_only=not force)
         db.commit()
-        print(f"✓ Dictionaries populated: {total_inserted} entries added")
+        if result is None:
+            print("✓ Dictionaries up to date (checksum matches)")
+        else:
+            print(f"✓ Dictionaries populated: {result.inserted} entries added, {result.updated} updated")
         
     except Exception as e:
         print(f"\n✗ Error during initialization: {e}")
@@ -471,4 +596,6 @@ def init_database():
         db.close()
 
 if __name__ == "__main__":
-    init_database()
\ No newline at end of file
+    # --force: применить справочники, даже если контрольная сумма не изменилась
+    # --discard-foreign-fields: при разделении clinical_records отбросить поля другого регистра
+    init_database(force="--force" in sys.argv, discard_foreign="--discard-foreign-fields" in sys.argv)
\ No newline at end of file
@@ -1,32 +1,58 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func, or_
-from sqlalchemy.inspection import inspect
-from typing import List, Optional
-from datetime import date, datetime, timedelta
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse
+from sqlalchemy.orm import Session, joinedload, contains_eager
+from sqlalchemy import JSON, String, and_, case, func, or_, type_coerce
+from typing import Dict, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import itertools
+import time
 import json
 import io
+import os
 import csv
+import anyio
 
-from database import get_db
-from models import User, Institution, Patient, ClinicalRecord, Dictionary, AuditLog
+from database import get_db, engine, ensure_table, slow_query_log, SessionLocal
+from models import User, Institution, Patient, ClinicalRecord, Dictionary, AuditLog, CacheGeneration, ExportJob, ChangeEvent, RECORD_CLASSES, clinical_record_columns, record_with_extensions, load_record_extension, join_record_extensions
 from schemas import (
     UserLogin, UserResponse, TokenResponse, UserCreate, UserUpdate,
     InstitutionCreate, InstitutionResponse,
     PatientCreate, PatientUpdate, PatientResponse,
     ClinicalRecordCreate, ClinicalRecordUpdate, ClinicalRecordResponse,
     DictionaryCreate, DictionaryUpdate, DictionaryResponse,
-    AuditLogResponse, AnalyticsResponse, PatientSearch, CompletionResponse
+    AuditLogResponse, AnalyticsResponse, PatientSearch, CompletionResponse,
+    CohortQuery, CohortQueryResponse, ExportJobCreate, ExportJobResponse
 )
-from auth import create_access_token, get_current_user, require_admin
+from auth import (
+    create_access_token, create_stream_ticket, get_current_user, get_stream_user,
+    require_admin, require_admin_or_local, STREAM_TICKET_EXPIRE_SECONDS
+)
+from cache import caches, institution_names, dictionary_index, patient_records, PatientEntry
+import metrics
+import survival
+import timeseries
+import distributions
+import completion_heatmap
+import export_jobs
+import delta_export
+import events
+import audit_archive
+from cohorts import run_cohort_query, CohortFilterError
+import code_index  # синхронизация clinical_record_codes при каждом flush
+import therapy_lines  # синхронизация therapy_lines при каждом flush
+from query_budget import query_budget, install_budget_hooks, check_budget
+from profiling import ProfiledRoute, profiler, requested_mode
 
 app = FastAPI(
     title="Alectinib Registry API",
     description="API для регистра клинических случаев лечения алектинибом",
     version="1.0.0"
 )
+# Обработчики оборачиваются для профилирования по требованию (X-Profile)
+app.router.route_class = ProfiledRoute
 
 # CORS settings
 app.add_middleware(
@@ -37,6 +63,98 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Число потоков для синхронных обработчиков (по умолчанию в AnyIO - 40)
+THREADPOOL_SIZE = int(os.getenv('THREADPOOL_SIZE', '40'))
+
+@app.on_event("startup")
+async def configure_threadpool():
+    # Лимитер привязан к event loop, поэтому настраивается из async-обработчика
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = THREADPOOL_SIZE
+    metrics.threadpool.attach(limiter)
+
+@app.on_event("startup")
+def start_metrics_flush():
+    # Снимок метрик воркера для суммирования в /api/metrics (несколько воркеров)
+    metrics.worker_snapshots.start()
+
+@app.on_event("shutdown")
+def flush_metrics():
+    # Последние счетчики воркера попадают в архив при его завершении (child_exit)
+    if metrics.worker_snapshots.enabled:
+        metrics.worker_snapshots.flush()
+
+@app.on_event("startup")
+def prepare_cache_coordination():
+    if not caches.enabled:
+        return
+    ensure_table(CacheGeneration.__table__)
+    db = SessionLocal()
+    try:
+        caches.ensure_rows(db)
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_event_broker():
+    ensure_table(ChangeEvent.__table__)
+    events.broker.start()
+
+@app.on_event("shutdown")
+async def stop_event_broker():
+    await events.broker.stop()
+
+@app.on_event("startup")
+def recover_export_jobs():
+    # Задания, прерванные перезапуском, помечаются failed; просроченные файлы удаляются
+    ensure_table(ExportJob.__table__)
+    db = SessionLocal()
+    try:
+        export_jobs.recover(db)
+    finally:
+        db.close()
+    export_jobs.start_purge_timer()
+
+metrics.install_sql_hooks(engine)
+install_budget_hooks(engine)
+
+@app.middleware("http")
+async def collect_request_metrics(request: Request, call_next):
+    stats = metrics.RequestStats(request.method, request.scope)
+    stats.profile_mode = requested_mode(request)
+    token = metrics.current_request.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.current_request.reset(token)
+    
+    check_budget(stats)
+    if stats.profile_result == "rate-limited":
+        response.headers["X-Profile-Status"] = "rate-limited"
+    elif stats.profile_result:
+        response.headers["X-Profile-Id"] = stats.profile_result
+    status_code = response.status_code
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        # Длительность подписки на ленту - время жизни соединения, а не задержка ответа
+        metrics.registry.record(stats, status_code, None, None)
+        return response
+
+    # call_next возвращается до отправки тела: замер заканчивается, когда тело отправлено
+    # целиком (выгрузки CSV и файлы заданий отдаются потоком)
+    body = response.body_iterator
+
+    async def measured_body():
+        size = 0
+        try:
+            async for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            metrics.registry.record(stats, status_code, time.perf_counter() - stats.started, size)
+
+    response.body_iterator = measured_body()
+    return response
+
 # Вспомогательная функция для логирования
 def log_action(db: Session, user_id: int, action: str, record_type: str = None, 
                record_id: int = None, details: dict = None):
@@ -57,6 +175,44 @@ def calculate_age(birth_date: datetime, diagnosis_date: datetime) -> int:
         age -= 1
     return age
 
+# Версия схемы PatientResponse: входит в ETag, увеличивать при изменении формата ответа
+PATIENT_SCHEMA_VERSION = "1"
+
+# Валидаторы условного GET для карточки пациента
+def patient_cache_headers(patient_id: int, updated_at: Optional[datetime]) -> dict:
+    stamp = updated_at.isoformat() if updated_at else ""
+    digest = hashlib.sha1(f"{patient_id}:{stamp}:{PATIENT_SCHEMA_VERSION}".encode()).hexdigest()
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "private, no-cache"}
+    if updated_at:
+        headers["Last-Modified"] = format_datetime(updated_at.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+def is_not_modified(request: Request, etag: str, updated_at: Optional[datetime]) -> bool:
+    # If-None-Match имеет приоритет над If-Modified-Since (RFC 9110, 13.1.3)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and updated_at:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # Last-Modified передается с точностью до секунды
+        return updated_at.replace(microsecond=0) <= since
+    return False
+
+def is_record_field(record_class, field: str) -> bool:
+    """Поле хранится у записи этого класса (общая таблица или таблица расширения регистра).
+
+    Тип регистра после создания не меняется: он определяет таблицу расширения.
+    """
+    return field != 'registry_type' and hasattr(record_class, field)
+
 # Вспомогательная функция для расчета процента заполнения
 def calculate_completion_percentage(clinical_record) -> CompletionResponse:
     if not clinical_record:
@@ -275,7 +431,7 @@ def login(user_login: UserLogin, db: Session = Depends(get_db)):
     # Create access token
     access_token = create_access_token(data={"sub": user.username})
     
-    institution_name = user.institution.name if user.institution else ""
+    institution_name = institution_names.get(db, user.institution_id)
     
     return {
         "access_token": access_token,
@@ -296,13 +452,13 @@ def logout(current_user: User = Depends(get_current_user), db: Session = Depends
     return {"message": "Logged out successfully"}
 
 @app.get("/api/auth/me", response_model=UserResponse)
-def get_me(current_user: User = Depends(get_current_user)):
+def get_me(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     return {
         "id": current_user.id,
         "username": current_user.username,
         "role": current_user.role,
         "institution_id": current_user.institution_id,
-        "institution_name": current_user.institution.name,
+        "institution_name": institution_names.get(db, current_user.institution_id),
         "is_active": current_user.is_active
     }
 
@@ -338,11 +494,12 @@ def create_user(
         "username": new_user.username,
         "role": new_user.role,
         "institution_id": new_user.institution_id,
-        "institution_name": new_user.institution.name,
+        "institution_name": institution_names.get(db, new_user.institution_id),
         "is_active": new_user.is_active
     }
 
 @app.get("/api/users", response_model=List[UserResponse])
+@query_budget(3)
 def list_users(
     db: Session = Depends(get_db),
     current_user: User = Depends(require_admin)
@@ -354,7 +511,7 @@ def list_users(
             "username": u.username,
             "role": u.role,
             "institution_id": u.institution_id,
-            "institution_name": u.institution.name,
+            "institution_name": institution_names.get(db, u.institution_id),
             "is_active": u.is_active,
             "last_login": u.last_login
         }
@@ -393,7 +550,7 @@ def update_user(
         "username": user.username,
         "role": user.role,
         "institution_id": user.institution_id,
-        "institution_name": user.institution.name,
+        "institution_name": institution_names.get(db, user.institution_id),
         "is_active": user.is_active,
         "last_login": user.last_login
     }
@@ -428,12 +585,14 @@ def create_institution(
     db.add(new_institution)
     db.commit()
     db.refresh(new_institution)
+    caches.invalidate("institutions", db)
     
     log_action(db, current_user.id, "create_institution", "institution", new_institution.id)
     
     return new_institution
 
 @app.get("/api/institutions", response_model=List[InstitutionResponse])
+@query_budget(3)
 def list_institutions(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     institutions = db.query(Institution).filter(Institution.is_active == True).all()
     return institutions
@@ -454,6 +613,7 @@ def update_institution(
     
     db.commit()
     db.refresh(institution)
+    caches.invalidate("institutions", db)
     
     log_action(db, current_user.id, "update_institution", "institution", institution.id)
     
@@ -472,6 +632,7 @@ def delete_institution(
     # Soft delete
     institution.is_active = False
     db.commit()
+    caches.invalidate("institutions", db)
     
     log_action(db, current_user.id, "delete_institution", "institution", institution.id)
     
@@ -498,8 +659,9 @@ def auto_save_patient(
     
     # Update clinical record fields
     clinical_record = patient.clinical_record
+    applied = [field for field in field_updates if is_record_field(type(clinical_record), field)]
     for field, value in field_updates.items():
-        if hasattr(clinical_record, field):
+        if is_record_field(type(clinical_record), field):
             if field.endswith('_date'):
                 if isinstance(value, str):
                     if value == '':
@@ -513,6 +675,11 @@ def auto_save_patient(
         
         patient.updated_at = datetime.utcnow()
         db.commit()
+    if applied:
+        events.patient_event(db, "auto_saved", patient, applied)
+        db.commit()
+    patient_records.invalidate(patient_id)
+    caches.invalidate("patients", db)
     
     return {"status": "saved", "fields": list(field_updates.keys())}
 
@@ -524,6 +691,10 @@ def create_patient(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
+    record_class = RECORD_CLASSES.get(patient_data.clinical_record.registry_type)
+    if record_class is None:
+        raise HTTPException(status_code=400, detail=f"Unknown registry type: {patient_data.clinical_record.registry_type}")
+
     # Create patient
     new_patient = Patient(
         institution_id=current_user.institution_id,
@@ -550,18 +721,23 @@ def create_patient(
             clinical_data['initial_diagnosis_date']
         )
     
-    clinical_record = ClinicalRecord(patient_id=new_patient.id, **clinical_data)
+    # Поля другого регистра (значения формы по умолчанию) не хранятся
+    clinical_record = record_class(patient_id=new_patient.id, **{
+        key: value for key, value in clinical_data.items() if is_record_field(record_class, key)
+    })
     db.add(clinical_record)
+    events.patient_event(db, "created", new_patient)
     
     db.commit()
     db.refresh(new_patient)
+    caches.invalidate("patients", db)
     
     log_action(db, current_user.id, "create_patient", "patient", new_patient.id)
     
     return {
         "id": new_patient.id,
         "institution_id": new_patient.institution_id,
-        "institution_name": new_patient.institution.name,
+        "institution_name": institution_names.get(db, new_patient.institution_id),
         "created_by": new_patient.created_by,
         "is_active": new_patient.is_active,
         "created_at": new_patient.created_at,
@@ -570,6 +746,7 @@ def create_patient(
     }
 
 @app.get("/api/patients", response_model=List[PatientResponse])
+@query_budget(3)
 def list_patients(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
@@ -581,16 +758,15 @@ def list_patients(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    # Optimize query with joinedload for clinical_record
-    query = db.query(Patient).options(joinedload(Patient.clinical_record)).filter(Patient.is_active == True)
+    # clinical_record (с таблицей расширения) загружается тем же JOIN, который используется для фильтрации
+    record = record_with_extensions(registry_type)
+    query = db.query(Patient).join(Patient.clinical_record.of_type(record)) \
+        .options(contains_eager(Patient.clinical_record.of_type(record))).filter(Patient.is_active == True)
     
     if current_user.role != 'admin':
         query = query.filter(Patient.institution_id == current_user.institution_id)
     elif institution_id:
         query = query.filter(Patient.institution_id == institution_id)
-    
-    # Join with ClinicalRecord to filter by registry_type and search fields
-    query = query.join(ClinicalRecord)
 
     if registry_type:
         query = query.filter(ClinicalRecord.registry_type == registry_type)
@@ -617,7 +793,7 @@ def list_patients(
         {
             "id": p.id,
             "institution_id": p.institution_id,
-            "institution_name": p.institution.name,
+            "institution_name": institution_names.get(db, p.institution_id),
             "created_by": p.created_by,
             "is_active": p.is_active,
             "created_at": p.created_at,
@@ -629,30 +805,66 @@ def list_patients(
     ]
 
 @app.get("/api/patients/{patient_id}", response_model=PatientResponse)
+@query_budget(5)
 def get_patient(
     patient_id: int,
+    request: Request,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    patient = db.query(Patient).filter(Patient.id == patient_id, Patient.is_active == True).first()
-    
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    
-    # Check access rights
-    if current_user.role != 'admin' and patient.institution_id != current_user.institution_id:
+    # Повторное открытие карточки отдается из кэша готовым JSON. Тело не читается из БД,
+    # но запрос остается не бесплатным: пользователь токена (get_current_user), сверка
+    # поколений кэшей в get_db при нескольких воркерах и сверка элемента после чужой записи
+    entry, stale = patient_records.get(patient_id)
+    if stale:
+        # Другой воркер менял пациентов: элемент сверяется с версией строки одним запросом по ключу
+        epoch = patient_records.epoch()
+        current = db.query(Patient.institution_id, Patient.updated_at) \
+            .filter(Patient.id == patient_id, Patient.is_active == True).first()
+        if current is not None and tuple(current) == (entry.institution_id, entry.updated_at):
+            patient_records.confirm(patient_id, epoch)
+        else:
+            patient_records.invalidate(patient_id)
+            entry = None
+    if entry is None:
+        token = patient_records.token()
+        epoch = patient_records.epoch()
+        # Строка пациента по первичному ключу, без клинической записи: ее достаточно для 404/403/304
+        patient = db.query(Patient).filter(Patient.id == patient_id, Patient.is_active == True).first()
+        
+        if not patient:
+            raise HTTPException(status_code=404, detail="Patient not found")
+        
+        # Check access rights
+        if current_user.role != 'admin' and patient.institution_id != current_user.institution_id:
+            raise HTTPException(status_code=403, detail="Access denied")
+        
+        cache_headers = patient_cache_headers(patient.id, patient.updated_at)
+        if is_not_modified(request, cache_headers["ETag"], patient.updated_at):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+        
+        # Запись по индексу patient_id, затем строка расширения только из таблицы ее регистра
+        clinical_record = db.query(ClinicalRecord).options(load_record_extension()) \
+            .filter(ClinicalRecord.patient_id == patient_id).first()
+        body = PatientResponse.model_validate({
+            "id": patient.id,
+            "institution_id": patient.institution_id,
+            "institution_name": institution_names.get(db, patient.institution_id),
+            "created_by": patient.created_by,
+            "is_active": patient.is_active,
+            "created_at": patient.created_at,
+            "updated_at": patient.updated_at,
+            "clinical_record": clinical_record
+        }).model_dump_json().encode()
+        entry = PatientEntry(patient.institution_id, patient.updated_at, body)
+        patient_records.put(patient_id, token, entry, epoch)
+    elif current_user.role != 'admin' and entry.institution_id != current_user.institution_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    return {
-        "id": patient.id,
-        "institution_id": patient.institution_id,
-        "institution_name": patient.institution.name,
-        "created_by": patient.created_by,
-        "is_active": patient.is_active,
-        "created_at": patient.created_at,
-        "updated_at": patient.updated_at,
-        "clinical_record": patient.clinical_record
-    }
+    cache_headers = patient_cache_headers(patient_id, entry.updated_at)
+    if is_not_modified(request, cache_headers["ETag"], entry.updated_at):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    return Response(content=entry.body, media_type="application/json", headers=cache_headers)
 
 @app.put("/api/patients/{patient_id}", response_model=PatientResponse)
 def update_patient(
@@ -674,6 +886,8 @@ def update_patient(
     if patient_update.clinical_record:
         clinical_record = patient.clinical_record
         update_data = patient_update.clinical_record.dict(exclude_unset=True)
+        if update_data.get('registry_type', clinical_record.registry_type) != clinical_record.registry_type:
+            raise HTTPException(status_code=400, detail="Registry type cannot be changed")
         
         # Преобразование пустых строк в None для полей с датами
         for key, value in update_data.items():
@@ -694,19 +908,25 @@ def update_patient(
             if birth_date and diagnosis_date:
                 update_data['age_at_diagnosis'] = calculate_age(birth_date, diagnosis_date)
         
-        for key, value in update_data.items():
-            setattr(clinical_record, key, value)
+        changed_fields = [key for key in update_data if is_record_field(type(clinical_record), key)]
+        for key in changed_fields:
+            setattr(clinical_record, key, update_data[key])
+    else:
+        changed_fields = []
     
     patient.updated_at = datetime.utcnow()
+    events.patient_event(db, "updated", patient, changed_fields)
     db.commit()
     db.refresh(patient)
+    patient_records.invalidate(patient_id)
+    caches.invalidate("patients", db)
     
     log_action(db, current_user.id, "update_patient", "patient", patient.id)
     
     return {
         "id": patient.id,
         "institution_id": patient.institution_id,
-        "institution_name": patient.institution.name,
+        "institution_name": institution_names.get(db, patient.institution_id),
         "created_by": patient.created_by,
         "is_active": patient.is_active,
         "created_at": patient.created_at,
@@ -731,7 +951,11 @@ def delete_patient(
     
     # Soft delete
     patient.is_active = False
+    patient.updated_at = datetime.utcnow()
+    events.patient_event(db, "deleted", patient)
     db.commit()
+    patient_records.invalidate(patient_id)
+    caches.invalidate("patients", db)
     
     log_action(db, current_user.id, "delete_patient", "patient", patient.id)
     
@@ -740,6 +964,7 @@ def delete_patient(
 # ==================== COMPLETION PERCENTAGE ====================
 
 @app.get("/api/patients/{patient_id}/completion", response_model=CompletionResponse)
+@query_budget(4)
 def get_patient_completion(
     patient_id: int,
     db: Session = Depends(get_db),
@@ -758,16 +983,91 @@ def get_patient_completion(
 
 # ==================== EXCEL EXPORT ====================
 
-@app.get("/api/export/patients")
-def export_patients_excel(
+# Поле клинической записи -> категория справочника (как в форме пациента)
+EXPORT_DICTIONARY_FIELDS = {
+    'comorbidities': 'comorbidities',
+    'smoking_status': 'smoking_status',
+    'tnm_stage': 'tnm_stage',
+    'histology': 'histology',
+    'alk_methods': 'alk_methods',
+    'alk_fusion_variant': 'alk_fusion_variant',
+    'ros1_fusion_variant': 'ros1_fusion_variant',
+    'tp53_comutation': 'yes_no_unknown',
+    'ttf1_expression': 'yes_no_unknown',
+    'pdl1_status': 'pdl1_status',
+    'previous_therapy_types': 'previous_therapy_types',
+    'previous_therapy_response': 'response',
+    'previous_therapy_stop_reason': 'previous_therapy_stop_reason',
+    'alectinib_therapy_status': 'alectinib_therapy_status',
+    'stage_at_alectinib_start': 'stage_at_alectinib_start',
+    'metastases_sites': 'metastases_sites',
+    'cns_measurable': 'cns_measurable',
+    'cns_symptomatic': 'cns_symptomatic',
+    'cns_radiotherapy': 'cns_radiotherapy',
+    'maximum_response': 'response',
+    'intracranial_response': 'intracranial_response',
+    'progression_during_alectinib': 'progression_type',
+    'local_treatment_at_progression': 'local_treatment_at_progression',
+    'progression_sites': 'progression_sites',
+    'alectinib_stop_reason': 'alectinib_stop_reason',
+    'after_alectinib_progression_type': 'progression_type',
+    'after_alectinib_progression_sites': 'progression_sites',
+    'interruption_reason': 'interruption_reason',
+    'next_line_treatments': 'next_line_treatments',
+    'next_line_progression_type': 'progression_type',
+    'next_line_progression_sites': 'progression_sites',
+    'current_status': 'current_status',
+    'radical_surgery_type': 'surgery_types',
+    'radical_crt_consolidation_drug': 'chemo_drugs',
+    'radical_treatment_outcome': 'radical_treatment_outcome',
+}
+
+def load_dictionary_labels(db: Session) -> Dict[str, Dict[str, str]]:
+    """Все справочники одним запросом: категория -> код -> value_ru (включая неактивные коды старых записей)"""
+    labels: Dict[str, Dict[str, str]] = {}
+    for category, code, value_ru in db.query(Dictionary.category, Dictionary.code, Dictionary.value_ru):
+        labels.setdefault(category, {})[code] = value_ru
+    return labels
+
+def dictionary_labeler(labels: Optional[Dict[str, Dict[str, str]]], field: str):
+    """Преобразователь значений колонки: код или список кодов -> названия; None, если колонка не кодирована"""
+    category = EXPORT_DICTIONARY_FIELDS.get(field)
+    if labels is None or category is None:
+        return None
+    lookup = labels.get(category, {}).get
+
+    def label(value):
+        if isinstance(value, list):
+            return ', '.join(str(lookup(item, item)) for item in value if not isinstance(item, (dict, list)))
+        return lookup(value, value)
+    return label
+
+def write_patients_csv(
+    db: Session,
+    output,
     institution_id: Optional[int] = None,
     registry_type: Optional[str] = None,
-    mode: str = Query("standard", enum=["standard", "full"]), # Новый параметр режима
-    db: Session = Depends(get_db),
-    current_user: User = Depends(require_admin)
+    mode: str = "standard",
+    labels: Optional[str] = None,
+    progress=None,
+    since: Optional[delta_export.Key] = None,
+    until: Optional[datetime] = None,
+    limit: Optional[int] = None
 ):
-    # Строим запрос с join к ClinicalRecord для фильтрации
-    query = db.query(Patient).join(ClinicalRecord).filter(Patient.is_active == True)
+    """Пишет выгрузку пациентов в текстовый поток output; progress(done, total) - после каждой строки.
+
+    С since - только изменившиеся после курсора (delta_export.py), с надгробиями удаленных и
+    колонками времени изменения и признака удаления; возвращает ключ последней строки, если
+    limit обрезал выборку, иначе None.
+    """
+    # Строим запрос с join к ClinicalRecord для фильтрации; клиническая запись грузится тем же JOIN
+    record = record_with_extensions(registry_type)
+    query = db.query(Patient).join(Patient.clinical_record.of_type(record)) \
+        .options(contains_eager(Patient.clinical_record.of_type(record)))
+    if since is None:
+        query = query.filter(Patient.is_active == True)
+    else:
+        query = delta_export.changed_since(query, since, until)
     
     if institution_id:
         query = query.filter(Patient.institution_id == institution_id)
@@ -775,11 +1075,26 @@ def export_patients_excel(
     if registry_type:
         query = query.filter(ClinicalRecord.registry_type == registry_type)
     
-    patients = query.all()
+    if since is not None and limit:
+        patients = query.limit(limit + 1).all()
+        more = len(patients) > limit
+        patients = patients[:limit]
+    else:
+        patients = query.all()
+        more = False
+    
+    def delta_columns(patient):
+        if since is None:
+            return []
+        return [patient.updated_at.isoformat(), "Да" if not patient.is_active else "Нет"]
+    
+    # Справочники загружаются один раз на выгрузку; преобразователи строятся по колонкам
+    dictionary_labels = load_dictionary_labels(db) if labels == "ru" else None
     
-    # Create CSV content
-    output = io.StringIO()
     writer = csv.writer(output)
+    total = len(patients)
+    if progress:
+        progress(0, total)
     
     if mode == "standard":
         # Header for standard export
@@ -792,51 +1107,66 @@ def export_patients_excel(
             'Максимальный ответ', 'Прогрессирование', 'Текущий статус',
             'Дата последнего контакта', 'Дата заполнения', 'Заполненность'
         ]
+        if since is not None:
+            header += ['Время изменения', 'Удален']
         writer.writerow(header)
         
+        identity = lambda value: value
+        coded = {
+            field: dictionary_labeler(dictionary_labels, field) or identity
+            for field in ('smoking_status', 'tnm_stage', 'histology', 'alk_methods', 'alk_fusion_variant',
+                          'tp53_comutation', 'ttf1_expression', 'stage_at_alectinib_start', 'maximum_response',
+                          'progression_during_alectinib', 'current_status')
+        }
+        
         # Data rows for standard export
-        for patient in patients:
+        for done, patient in enumerate(patients, start=1):
             cr = patient.clinical_record
-            if cr:
+            if not patient.is_active:
+                # Надгробие удаленного пациента: только идентификатор и признак удаления
+                row = [patient.id] + [''] * 25
+            elif cr:
                 completion = calculate_completion_percentage(cr)
                 completion_str = f"{completion.filled_fields}/{completion.total_fields}"
                 
                 row = [
                     patient.id,
                     cr.patient_code or f"ID-{patient.id}",
-                    patient.institution.name,
+                    institution_names.get(db, patient.institution_id),
                     cr.gender or '',
                     cr.birth_date.strftime('%d-%m-%Y') if cr.birth_date else '',
                     cr.age_at_diagnosis or '',
                     cr.height or '',
                     cr.weight or '',
-                    cr.smoking_status or '',
+                    coded['smoking_status'](cr.smoking_status) if cr.smoking_status else '',
                     cr.initial_diagnosis_date.strftime('%d-%m-%Y') if cr.initial_diagnosis_date else '',
-                    cr.tnm_stage or '',
-                    cr.histology or '',
+                    coded['tnm_stage'](cr.tnm_stage) if cr.tnm_stage else '',
+                    coded['histology'](cr.histology) if cr.histology else '',
                     cr.alk_diagnosis_date.strftime('%d-%m-%Y') if cr.alk_diagnosis_date else '',
-                    ', '.join(cr.alk_methods) if cr.alk_methods else '',
-                    cr.alk_fusion_variant or '',
-                    cr.tp53_comutation or '',
-                    cr.ttf1_expression or '',
+                    (coded['alk_methods'](cr.alk_methods) if dictionary_labels else ', '.join(cr.alk_methods)) if cr.alk_methods else '',
+                    coded['alk_fusion_variant'](cr.alk_fusion_variant) if cr.alk_fusion_variant else '',
+                    coded['tp53_comutation'](cr.tp53_comutation) if cr.tp53_comutation else '',
+                    coded['ttf1_expression'](cr.ttf1_expression) if cr.ttf1_expression else '',
                     cr.alectinib_start_date.strftime('%d-%m-%Y') if cr.alectinib_start_date else '',
-                    cr.stage_at_alectinib_start or '',
+                    coded['stage_at_alectinib_start'](cr.stage_at_alectinib_start) if cr.stage_at_alectinib_start else '',
                     cr.ecog_at_start or '',
-                    cr.maximum_response or '',
-                    cr.progression_during_alectinib or '',
-                    cr.current_status or '',
+                    coded['maximum_response'](cr.maximum_response) if cr.maximum_response else '',
+                    coded['progression_during_alectinib'](cr.progression_during_alectinib) if cr.progression_during_alectinib else '',
+                    coded['current_status'](cr.current_status) if cr.current_status else '',
                     cr.last_contact_date.strftime('%d-%m-%Y') if cr.last_contact_date else '',
                     cr.date_filled.strftime('%d-%m-%Y') if cr.date_filled else '',
                     completion_str
                 ]
             else:
-                row = [patient.id, f"ID-{patient.id}", patient.institution.name] + [''] * 23
+                row = [patient.id, f"ID-{patient.id}", institution_names.get(db, patient.institution_id)] + [''] * 23
             
-            writer.writerow(row)
+            writer.writerow(row + delta_columns(patient))
+            if progress:
+                progress(done, total)
             
     elif mode == "full":
-        # Интроспекция колонок модели ClinicalRecord
-        columns = [c.key for c in inspect(ClinicalRecord).c]
+        # Колонки общей таблицы и таблиц расширений ALK/ROS1
+        columns = [c.key for c in clinical_record_columns()]
         
         # Исключаем служебные поля, которые дублируются или не нужны
         exclude_cols = ['id', 'patient_id']
@@ -844,23 +1174,31 @@ def export_patients_excel(
         
         # Формируем заголовок: поля пациента + поля клинической записи
         header = ['patient_id', 'institution_name', 'created_at'] + columns
+        if since is not None:
+            header += ['updated_at', 'deleted']
         writer.writerow(header)
+        converters = [(col, dictionary_labeler(dictionary_labels, col)) for col in columns]
         
-        for patient in patients:
+        for done, patient in enumerate(patients, start=1):
             cr = patient.clinical_record
-            if cr:
+            if not patient.is_active:
+                # Надгробие удаленного пациента: только идентификатор и признак удаления
+                writer.writerow([patient.id] + [''] * (len(columns) + 2) + delta_columns(patient))
+            elif cr:
                 row = [
                     patient.id,
-                    patient.institution.name,
+                    institution_names.get(db, patient.institution_id),
                     patient.created_at.strftime('%d-%m-%Y %H:%M:%S')
                 ]
                 
                 # Динамическое заполнение полей
-                for col in columns:
+                for col, label in converters:
                     val = getattr(cr, col, None)
                     
                     # Обработка типов данных
-                    if isinstance(val, (list, dict)):
+                    if label is not None and val is not None and val != '':
+                        val = label(val)
+                    elif isinstance(val, (list, dict)):
                         # Сериализация JSON в строку
                         val = json.dumps(val, ensure_ascii=False)
                     elif isinstance(val, datetime):
@@ -871,33 +1209,113 @@ def export_patients_excel(
                         val = ""
                         
                     row.append(val)
-                writer.writerow(row)
+                writer.writerow(row + delta_columns(patient))
             else:
                 # Если записи нет, заполняем пустые поля
                 row = [
                     patient.id,
-                    patient.institution.name,
+                    institution_names.get(db, patient.institution_id),
                     patient.created_at.strftime('%d-%m-%Y %H:%M:%S')
                 ] + [''] * len(columns)
-                writer.writerow(row)
+                writer.writerow(row + delta_columns(patient))
+            if progress:
+                progress(done, total)
+    return (patients[-1].updated_at, patients[-1].id) if more else None
+
+@app.get("/api/export/patients")
+@query_budget(4)
+def export_patients_excel(
+    institution_id: Optional[int] = None,
+    registry_type: Optional[str] = None,
+    mode: str = Query("standard", enum=["standard", "full"]), # Новый параметр режима
+    labels: Optional[str] = Query(None, enum=["ru"]), # ru - названия из справочников вместо кодов
+    since: Optional[str] = None, # курсор X-Export-Cursor или время ISO 8601 (UTC) - только изменения
+    limit: Optional[int] = Query(None, ge=1), # размер порции инкрементальной выгрузки
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    try:
+        since_key = delta_export.parse_since(since) if since else None
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    until = delta_export.upper_bound()
     
-    # Prepare response
-    output.seek(0)
+    output = io.StringIO()
+    more = write_patients_csv(db, output, institution_id, registry_type, mode, labels,
+                              since=since_key, until=until, limit=limit)
     
     # Convert to bytes
     csv_content = output.getvalue().encode('utf-8-sig')  # UTF-8 with BOM for Excel
-    
-    filename_prefix = "patients_full_export" if mode == "full" else "patients_export"
-    filename = f"{filename_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    filename = export_jobs.export_filename(mode, labels, datetime.now())
     
     return StreamingResponse(
         io.BytesIO(csv_content),
         media_type='text/csv',
         headers={
-            'Content-Disposition': f'attachment; filename="{filename}"'
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            # Курсор для следующей выгрузки: после последней строки порции или до границы until
+            'X-Export-Cursor': delta_export.encode_cursor(more or (until, 0)),
+            'X-Export-Has-More': 'true' if more else 'false'
         }
     )
 
+@app.post("/api/export/jobs", response_model=ExportJobResponse, status_code=202)
+@query_budget(4)
+def create_export_job(
+    job_request: ExportJobCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    job = export_jobs.submit(db, current_user.id, job_request.model_dump(), write_patients_csv)
+    return export_jobs.job_status(job)
+
+@app.get("/api/export/jobs", response_model=List[ExportJobResponse])
+@query_budget(2)
+def list_export_jobs(db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
+    # Просроченные задания скрываются до фоновой очистки
+    jobs = db.query(ExportJob).filter(
+        ExportJob.user_id == current_user.id,
+        or_(ExportJob.expires_at.is_(None), ExportJob.expires_at >= datetime.utcnow())
+    ).order_by(ExportJob.created_at.desc()).all()
+    return [export_jobs.job_status(job) for job in jobs]
+
+@app.get("/api/export/jobs/{job_id}", response_model=ExportJobResponse)
+@query_budget(3)
+def get_export_job(job_id: str, db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
+    job = export_jobs.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return export_jobs.job_status(job)
+
+@app.get("/api/export/jobs/{job_id}/download")
+@query_budget(3)
+def download_export_job(
+    job_id: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    job = export_jobs.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Export job is {job.status}")
+    path = export_jobs.artifact_path(job)
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Export file has expired")
+    media_type = 'application/gzip' if job.params.get("gzip") else 'text/csv'
+    return export_jobs.ranged_file_response(request, path, job.file_name, media_type, f'"{job.id}-{job.size_bytes}"')
+
+@app.delete("/api/export/jobs/{job_id}")
+@query_budget(3)
+def delete_export_job(job_id: str, db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
+    job = export_jobs.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if export_jobs.cancel(db, job):
+        return {"message": "Export job cancelled"}
+    return {"message": "Export job deleted"}
+
 # ==================== DICTIONARIES ====================
 
 @app.post("/api/dictionaries", response_model=DictionaryResponse)
@@ -908,14 +1326,18 @@ def create_dictionary(
 ):
     new_dict = Dictionary(**dictionary.dict())
     db.add(new_dict)
+    db.flush()
+    events.dictionary_event(db, "created", new_dict)
     db.commit()
     db.refresh(new_dict)
+    caches.invalidate("dictionaries", db)
     
     log_action(db, current_user.id, "create_dictionary", "dictionary", new_dict.id)
     
     return new_dict
 
 @app.get("/api/dictionaries", response_model=List[DictionaryResponse])
+@query_budget(3)
 def list_dictionaries(
     category: Optional[str] = None,
     db: Session = Depends(get_db),
@@ -937,6 +1359,18 @@ def list_dictionary_categories(
     categories = db.query(Dictionary.category).distinct().all()
     return [cat[0] for cat in categories]
 
+@app.get("/api/dictionaries/{category}/search", response_model=List[DictionaryResponse])
+@query_budget(3)
+def search_dictionary(
+    category: str,
+    q: str = "",
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Поиск по коду и названию: сначала совпадения по префиксу, затем по подстроке"""
+    return dictionary_index.search(db, category, q, limit)
+
 @app.put("/api/dictionaries/{dictionary_id}", response_model=DictionaryResponse)
 def update_dictionary(
     dictionary_id: int,
@@ -951,9 +1385,11 @@ def update_dictionary(
     update_data = dictionary_update.dict(exclude_unset=True)
     for key, value in update_data.items():
         setattr(dictionary, key, value)
+    events.dictionary_event(db, "updated", dictionary, update_data)
     
     db.commit()
     db.refresh(dictionary)
+    caches.invalidate("dictionaries", db)
     
     log_action(db, current_user.id, "update_dictionary", "dictionary", dictionary.id)
     
@@ -971,7 +1407,9 @@ def delete_dictionary(
     
     # Soft delete
     dictionary.is_active = False
+    events.dictionary_event(db, "deleted", dictionary)
     db.commit()
+    caches.invalidate("dictionaries", db)
     
     log_action(db, current_user.id, "delete_dictionary", "dictionary", dictionary.id)
     
@@ -979,7 +1417,34 @@ def delete_dictionary(
 
 # ==================== ANALYTICS ====================
 
+ANALYTICS_FIELDS = {
+    'ROS1': [
+        'gender', 'birth_date', 'height', 'weight',
+        'initial_diagnosis_date', 'tnm_stage', 'histology',
+        'ros1_fusion_variant', 'pdl1_status',
+        'radical_treatment_conducted',
+        'metastatic_diagnosis_date',
+        'current_status', 'last_contact_date'
+    ],
+    # ALK (по умолчанию, в том числе без фильтра по регистру)
+    'ALK': [
+        'gender', 'birth_date', 'height', 'weight',
+        'initial_diagnosis_date', 'tnm_stage', 'histology',
+        'alk_diagnosis_date', 'alk_methods',
+        'alectinib_start_date', 'ecog_at_start',
+        'current_status', 'last_contact_date'
+    ],
+}
+RECORD_COLUMNS = {column.key: column for column in clinical_record_columns()}
+
+def is_set(column):
+    """Значение не None, как у атрибута ORM: JSON null тоже считается пустым"""
+    if isinstance(column.type, JSON):
+        return and_(column.isnot(None), type_coerce(column, String) != 'null')
+    return column.isnot(None)
+
 @app.get("/api/analytics", response_model=List[AnalyticsResponse])
+@query_budget(4)
 def get_analytics(
     registry_type: Optional[str] = None, 
     db: Session = Depends(get_db),
@@ -987,94 +1452,179 @@ def get_analytics(
 ):
     # Get all institutions
     institutions = db.query(Institution).filter(Institution.is_active == True).all()
-    
+
+    # Число пациентов и заполненность полей - по одному агрегатному запросу на все учреждения
+    patient_query = db.query(Patient.institution_id, func.count(Patient.id)).filter(Patient.is_active == True)
+    if registry_type:
+        patient_query = patient_query.join(ClinicalRecord).filter(ClinicalRecord.registry_type == registry_type)
+    patient_counts = dict(patient_query.group_by(Patient.institution_id).all())
+
+    columns = [RECORD_COLUMNS[field] for field in ANALYTICS_FIELDS.get(registry_type, ANALYTICS_FIELDS['ALK'])]
+    record_query = db.query(
+        Patient.institution_id,
+        func.count(ClinicalRecord.id),
+        *(func.sum(case((is_set(column), 1), else_=0)) for column in columns)
+    ).select_from(ClinicalRecord).join(Patient).filter(Patient.is_active == True)
+    if registry_type:
+        record_query = record_query.filter(ClinicalRecord.registry_type == registry_type)
+    record_query = join_record_extensions(record_query, *columns)
+    record_stats = {row[0]: row[1:] for row in record_query.group_by(Patient.institution_id).all()}
+
     analytics_data = []
     
     for inst in institutions:
-        # Build queries for patients
-        patient_query = db.query(Patient).filter(
-            Patient.institution_id == inst.id,
-            Patient.is_active == True
-        )
-        
-        # Build query for clinical records
-        record_query = db.query(ClinicalRecord).join(Patient).filter(
-            Patient.institution_id == inst.id,
-            Patient.is_active == True
-        )
-
-        # Фильтрация по типу регистра
-        if registry_type:
-            patient_query = patient_query.join(ClinicalRecord).filter(ClinicalRecord.registry_type == registry_type)
-            record_query = record_query.filter(ClinicalRecord.registry_type == registry_type)
-        
-        patient_count = patient_query.count()
-        records = record_query.all()
-        
         # Calculate field completion rates
-        if records:
-            total_records = len(records)
-            field_completion = {}
-            
-            # Выбор полей в зависимости от регистра
-            if registry_type == 'ROS1':
-                important_fields = [
-                    'gender', 'birth_date', 'height', 'weight',
-                    'initial_diagnosis_date', 'tnm_stage', 'histology',
-                    'ros1_fusion_variant', 'pdl1_status',
-                    'radical_treatment_conducted',
-                    'metastatic_diagnosis_date',
-                    'current_status', 'last_contact_date'
-                ]
-            else: # ALK (default)
-                important_fields = [
-                    'gender', 'birth_date', 'height', 'weight',
-                    'initial_diagnosis_date', 'tnm_stage', 'histology',
-                    'alk_diagnosis_date', 'alk_methods',
-                    'alectinib_start_date', 'ecog_at_start',
-                    'current_status', 'last_contact_date'
-                ]
-            
-            for field in important_fields:
-                filled_count = sum(1 for r in records if getattr(r, field) is not None)
-                field_completion[field] = round((filled_count / total_records) * 100, 1)
-        else:
-            field_completion = {}
+        field_completion = {}
+        total_records, *filled_counts = record_stats.get(inst.id, (0,))
+        if total_records:
+            for column, filled_count in zip(columns, filled_counts):
+                field_completion[column.key] = round((filled_count / total_records) * 100, 1)
         
         analytics_data.append({
             "institution_id": inst.id,
             "institution_name": inst.name,
-            "total_patients": patient_count,
+            "total_patients": patient_counts.get(inst.id, 0),
             "field_completion_rates": field_completion,
             "last_updated": inst.updated_at
         })
     
     return analytics_data
 
+@app.get("/api/analytics/survival")
+@query_budget(3)
+def get_survival_analytics(
+    registry_type: Optional[str] = None,
+    institution_id: Optional[int] = None,
+    stage: Optional[str] = None,
+    cns_metastases: Optional[bool] = None,
+    group_by: Optional[str] = Query(None, enum=list(survival.GROUP_BY_FIELDS)),
+    confidence: float = Query(0.95, gt=0, lt=1),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Кривые Каплана-Мейера (PFS, OS, время на терапии) по когорте или группам когорты"""
+    return survival.compute_survival(db, registry_type, institution_id, stage, cns_metastases, group_by, confidence)
+
+@app.get("/api/analytics/therapy-lines")
+@query_budget(3)
+def get_therapy_line_analytics(
+    kind: str = Query('metastatic', enum=list(therapy_lines.LINE_FIELDS.values())),
+    line_no: Optional[int] = Query(None, ge=1),
+    drug: Optional[str] = None,
+    institution_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Статистика линий терапии ROS1 по номеру линии и препарату (комбинация - коды через '+')"""
+    return therapy_lines.line_statistics(db, kind, line_no, drug, institution_id)
+
+@app.get("/api/analytics/timeseries")
+@query_budget(3)
+def get_timeseries_analytics(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    institution_id: Optional[int] = None,
+    registry_type: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Новые пациенты по месяцам (учреждение, регистр) и измененные записи по неделям"""
+    start = datetime.combine(date_from, datetime.min.time()) if date_from else None
+    # date_to включительно: граница - начало следующего дня
+    end = datetime.combine(date_to + timedelta(days=1), datetime.min.time()) if date_to else None
+    return timeseries.compute_timeseries(db, start, end, institution_id, registry_type)
+
+@app.get("/api/analytics/distributions")
+@query_budget(3)
+def get_distribution_analytics(
+    filter: Optional[str] = Query(None, description="Дерево фильтров конструктора когорт (JSON)"),
+    registry_type: Optional[str] = None,
+    institution_id: Optional[int] = None,
+    group_by: Optional[str] = Query(None, enum=list(distributions.GROUP_BY_FIELDS)),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Гистограммы, квартили и частоты кодов по когорте или группам когорты"""
+    try:
+        tree = json.loads(filter) if filter else None
+        return distributions.compute_distributions(db, tree, registry_type, institution_id, group_by)
+    except ValueError as e:
+        # CohortFilterError и ошибки разбора JSON - подклассы ValueError
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analytics/completion-heatmap")
+@query_budget(3)
+def get_completion_heatmap(
+    registry_type: Optional[str] = None,
+    institution_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Заполненность каждого поля клинической записи по учреждениям и регистрам"""
+    return completion_heatmap.compute_heatmap(db, registry_type, institution_id)
+
+# ==================== COHORTS ====================
+
+@app.post("/api/cohorts/query", response_model=CohortQueryResponse)
+@query_budget(3)
+def query_cohort(
+    cohort_query: CohortQuery,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Число пациентов (и при include_ids - страница id) по дереву фильтров"""
+    # Не администраторы видят только пациентов своего учреждения
+    institution_id = None if current_user.role == 'admin' else current_user.institution_id
+    try:
+        return run_cohort_query(
+            db, cohort_query.filter, institution_id,
+            cohort_query.include_ids, cohort_query.offset, cohort_query.limit
+        )
+    except CohortFilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # ==================== AUDIT LOG ====================
 
 @app.get("/api/audit-logs", response_model=List[AuditLogResponse])
+@query_budget(3)
 def get_audit_logs(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
+    include_archived: bool = False, # дочитывать записи из архивных сегментов (audit_archive.py)
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(require_admin)
 ):
-    logs = db.query(AuditLog).order_by(AuditLog.timestamp.desc()).offset(skip).limit(limit).all()
-    
-    return [
-        {
-            "id": log.id,
-            "user_id": log.user_id,
-            "username": log.user.username,
-            "action": log.action,
-            "timestamp": log.timestamp,
-            "record_type": log.record_type,
-            "record_id": log.record_id,
-            "details": log.details
-        }
-        for log in logs
-    ]
+    start = datetime.combine(date_from, datetime.min.time()) if date_from else None
+    # date_to включительно: граница - начало следующего дня
+    end = datetime.combine(date_to + timedelta(days=1), datetime.min.time()) if date_to else None
+    
+    query = db.query(AuditLog)
+    if start:
+        query = query.filter(AuditLog.timestamp >= start)
+    if end:
+        query = query.filter(AuditLog.timestamp < end)
+    logs = query.options(joinedload(AuditLog.user)).order_by(AuditLog.timestamp.desc()).offset(skip).limit(limit).all()
+    result = [audit_archive.log_record(log) for log in logs]
+    
+    # Архивные записи старше оперативных: читаются, только если таблицы не хватило на страницу
+    if include_archived and len(result) < limit:
+        # Неполная непустая страница означает, что оперативные записи кончились на ней
+        archive_skip = skip - query.count() if skip and not result else 0
+        result.extend(itertools.islice(audit_archive.iter_archived(start, end, archive_skip), limit - len(result)))
+    
+    return result
+
+@app.post("/api/audit-logs/archive")
+def archive_audit_logs(db: Session = Depends(get_db), current_user: User = Depends(require_admin)):
+    """Переносит записи старше AUDIT_RETENTION_DAYS в архивные сегменты (обычно запускается по расписанию)"""
+    if audit_archive.AUDIT_RETENTION_DAYS <= 0:
+        raise HTTPException(status_code=400, detail="Audit log archival is disabled")
+    try:
+        return audit_archive.archive(db)
+    except audit_archive.ArchiveBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 # ==================== HEALTH CHECK ====================
 
@@ -1082,6 +1632,68 @@ def get_audit_logs(
 def health_check():
     return {"status": "healthy", "version": "1.0.0"}
 
+@app.get("/api/slow-queries")
+def get_slow_queries(
+    limit: int = Query(100, ge=1, le=500),
+    current_user: User = Depends(require_admin)
+):
+    return {
+        "threshold_ms": slow_query_log.threshold * 1000,
+        "entries": slow_query_log.recent(limit)
+    }
+
+# ==================== CHANGE FEED ====================
+
+@app.post("/api/events/ticket")
+def create_events_ticket(current_user: User = Depends(get_current_user)):
+    """Билет для EventSource: браузер не может передать заголовок Authorization"""
+    return {"ticket": create_stream_ticket(current_user), "expires_in": STREAM_TICKET_EXPIRE_SECONDS}
+
+@app.get("/api/events")
+async def stream_events(
+    request: Request,
+    last_event_id: Optional[int] = None,
+    current_user: User = Depends(get_stream_user)
+):
+    """Лента изменений (text/event-stream); пользователь видит события своего учреждения.
+
+    Авторизация проверяется при подключении: открытый поток не обрывается, когда билет истекает.
+    """
+    header = request.headers.get("last-event-id")
+    if header and header.isdigit():
+        last_event_id = int(header)
+    institution_id = None if current_user.role == 'admin' else current_user.institution_id
+    subscriber = await events.broker.subscribe(institution_id, last_event_id)
+    return StreamingResponse(
+        events.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ==================== PROFILING ====================
+
+@app.get("/api/profiles")
+def list_profiles(current_user: User = Depends(require_admin)):
+    return profiler.list()
+
+@app.get("/api/profiles/{profile_id}")
+def get_profile(profile_id: str, current_user: User = Depends(require_admin)):
+    profile = profiler.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+@app.get("/api/profiles/{profile_id}/download")
+def download_profile(profile_id: str, current_user: User = Depends(require_admin)):
+    path = profiler.prof_path(profile_id)
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.name)
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics(current_user: Optional[User] = Depends(require_admin_or_local)):
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
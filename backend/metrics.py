@@ -0,0 +1,445 @@
+"""
+Метрики производительности: задержка по эндпоинтам, число и время SQL-запросов
+
+Состояние текущего запроса хранится в ContextVar. Синхронные обработчики
+выполняются в пуле потоков с копией контекста, поэтому в ContextVar лежит
+изменяемый объект RequestStats, который видят и middleware, и SQL-хуки.
+
+При нескольких воркерах gunicorn (METRICS_MULTIPROC_DIR) каждый процесс
+периодически сохраняет свои метрики в файл каталога, а /api/metrics отдает их
+сумму по всем воркерам - scrape попадает в случайный воркер, но видит весь трафик.
+"""
+import fcntl
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+SQL_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+# Каталог файлов метрик воркеров (gunicorn.conf.py задает его сам); пусто - один процесс
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+
+
+class RequestStats:
+    """Счетчики одного HTTP-запроса"""
+
+    __slots__ = (
+        "method", "scope", "user_id", "query_count", "sql_time", "started",
+        "threadpool_wait", "statements", "budget_violation", "profile_mode", "profile_result",
+    )
+
+    def __init__(self, method: str, scope: dict):
+        self.method = method
+        self.scope = scope
+        self.user_id: Optional[int] = None
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.started = time.perf_counter()
+        # Время от входа в middleware до первой синхронной зависимости (ожидание потока)
+        self.threadpool_wait: Optional[float] = None
+        # Заполняются только при включенном query_budget
+        self.statements = {}
+        self.budget_violation = None
+        # Профилирование по требованию (profiling.py)
+        self.profile_mode: Optional[str] = None
+        self.profile_result: Optional[str] = None
+
+    @property
+    def route(self) -> str:
+        # Шаблон пути (/api/patients/{patient_id}) появляется в scope после роутинга
+        route = self.scope.get("route")
+        return getattr(route, "path", UNMATCHED_ROUTE)
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.histograms: Dict[str, Dict[Tuple[str, str], Histogram]] = {
+            "duration": {},
+            "sql_queries": {},
+            "sql_seconds": {},
+            "threadpool_wait": {},
+            "response_size": {},
+        }
+        self.buckets = {
+            "duration": LATENCY_BUCKETS,
+            "sql_queries": QUERY_COUNT_BUCKETS,
+            "sql_seconds": SQL_TIME_BUCKETS,
+            "threadpool_wait": POOL_WAIT_BUCKETS,
+            "response_size": SIZE_BUCKETS,
+        }
+        self.gauge_sources = []
+
+    def _observe(self, name: str, labels: Tuple[str, str], value: float):
+        series = self.histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(self.buckets[name])
+        histogram.observe(value)
+
+    def record(self, stats: RequestStats, status_code: int, duration: Optional[float], response_size: Optional[int]):
+        """duration None - запрос без задержки ответа (подписка на поток событий)"""
+        labels = (stats.method, stats.route)
+        with self._lock:
+            key = labels + (str(status_code),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if duration is not None:
+                self._observe("duration", labels, duration)
+            self._observe("sql_queries", labels, stats.query_count)
+            self._observe("sql_seconds", labels, stats.sql_time)
+            if stats.threadpool_wait is not None:
+                self._observe("threadpool_wait", labels, stats.threadpool_wait)
+            if response_size is not None:
+                self._observe("response_size", labels, response_size)
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (exposition format 0.0.4)"""
+        lines = [
+            "# HELP registry_http_requests_total Total HTTP requests by route and status.",
+            "# TYPE registry_http_requests_total counter",
+        ]
+        with self._lock:
+            for (method, route, status_code), value in sorted(self.requests.items()):
+                lines.append(f'registry_http_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {value}')
+
+            described = [
+                ("duration", "registry_http_request_duration_seconds", "Request latency in seconds."),
+                ("sql_queries", "registry_http_request_sql_queries", "SQL statements executed per request."),
+                ("sql_seconds", "registry_http_request_sql_seconds", "Cumulative SQL execution time per request."),
+                ("threadpool_wait", "registry_http_request_threadpool_wait_seconds", "Time spent waiting for a worker thread."),
+                ("response_size", "registry_http_response_size_bytes", "Response body size in bytes."),
+            ]
+            for key, metric, help_text in described:
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (method, route), histogram in sorted(self.histograms[key].items()):
+                    labels = f'method="{method}",route="{route}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.total}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+
+        for source in self.gauge_sources:
+            lines.extend(source())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def render_histogram(metric: str, histogram: Histogram) -> list:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+    lines.append(f"{metric}_sum {histogram.total}")
+    lines.append(f"{metric}_count {histogram.count}")
+    return lines
+
+
+# ==================== THREAD POOL / CONNECTION POOL ====================
+
+class ThreadPoolGauges:
+    """Лимитер AnyIO, через который FastAPI запускает синхронные обработчики"""
+
+    def __init__(self):
+        self.limiter = None
+
+    def attach(self, limiter):
+        self.limiter = limiter
+
+    def render(self) -> list:
+        if self.limiter is None:
+            return []
+        statistics = self.limiter.statistics()
+        return [
+            "# HELP registry_threadpool_threads_total Worker thread limit for sync handlers.",
+            "# TYPE registry_threadpool_threads_total gauge",
+            f"registry_threadpool_threads_total {self.limiter.total_tokens}",
+            "# HELP registry_threadpool_threads_in_use Worker threads currently running handlers.",
+            "# TYPE registry_threadpool_threads_in_use gauge",
+            f"registry_threadpool_threads_in_use {statistics.borrowed_tokens}",
+            "# HELP registry_threadpool_tasks_waiting Calls queued for a free worker thread.",
+            "# TYPE registry_threadpool_tasks_waiting gauge",
+            f"registry_threadpool_tasks_waiting {statistics.tasks_waiting}",
+        ]
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait = Histogram(POOL_WAIT_BUCKETS)
+
+    def record_checkout(self, wait: float, in_overflow: bool):
+        with self._lock:
+            self.checkouts += 1
+            if in_overflow:
+                self.overflow_checkouts += 1
+            self.wait.observe(wait)
+
+    def record_timeout(self, wait: float):
+        with self._lock:
+            self.timeouts += 1
+            self.wait.observe(wait)
+
+    def render(self) -> list:
+        if self.pool is None:
+            return []
+        with self._lock:
+            lines = [
+                "# HELP registry_db_pool_size Configured connection pool size.",
+                "# TYPE registry_db_pool_size gauge",
+                f"registry_db_pool_size {self.pool.size()}",
+                "# HELP registry_db_pool_checked_out Connections currently checked out.",
+                "# TYPE registry_db_pool_checked_out gauge",
+                f"registry_db_pool_checked_out {self.pool.checkedout()}",
+                "# HELP registry_db_pool_overflow Overflow connections currently open (negative: unused pool slots).",
+                "# TYPE registry_db_pool_overflow gauge",
+                f"registry_db_pool_overflow {self.pool.overflow()}",
+                "# HELP registry_db_pool_checkouts_total Connection checkouts.",
+                "# TYPE registry_db_pool_checkouts_total counter",
+                f"registry_db_pool_checkouts_total {self.checkouts}",
+                "# HELP registry_db_pool_overflow_checkouts_total Checkouts served while the pool was in overflow.",
+                "# TYPE registry_db_pool_overflow_checkouts_total counter",
+                f"registry_db_pool_overflow_checkouts_total {self.overflow_checkouts}",
+                "# HELP registry_db_pool_timeouts_total Checkouts that hit pool_timeout.",
+                "# TYPE registry_db_pool_timeouts_total counter",
+                f"registry_db_pool_timeouts_total {self.timeouts}",
+                "# HELP registry_db_pool_checkout_wait_seconds Time spent waiting for a pooled connection.",
+                "# TYPE registry_db_pool_checkout_wait_seconds histogram",
+            ]
+            lines.extend(render_histogram("registry_db_pool_checkout_wait_seconds", self.wait))
+        return lines
+
+
+threadpool = ThreadPoolGauges()
+pool_stats = PoolStats()
+registry.gauge_sources.extend([threadpool.render, pool_stats.render])
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool с замером ожидания соединения"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_stats.pool = self
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.record_timeout(time.perf_counter() - started)
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started, self.overflow() > 0)
+        return connection
+
+
+def install_sql_hooks(engine):
+    """Подсчет запросов и времени SQL для текущего HTTP-запроса"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        stats = current_request.get()
+        if stats is not None:
+            stats.query_count += 1
+            stats.sql_time += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute не вызывается при ошибке: убираем зависшую отметку времени
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            conn.info["query_start_time"].pop()
+
+
+# ==================== НЕСКОЛЬКО ВОРКЕРОВ ====================
+
+SAMPLE_SUFFIXES = ("_bucket", "_sum", "_count")
+ARCHIVE_FILE = "archive.prom"
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _parse(text: str):
+    """Текст Prometheus -> (HELP и TYPE семейств, значения по строкам "имя{метки}")"""
+    families, samples = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# HELP ") or line.startswith("# TYPE "):
+            kind, name, rest = line[2:].split(" ", 2)
+            families.setdefault(name, {})[kind] = rest
+        elif line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            samples[series] = float(value)
+    return families, samples
+
+
+def _family(series: str, families: dict) -> str:
+    name = series.split("{", 1)[0]
+    if name not in families:
+        for suffix in SAMPLE_SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in families:
+                return name[:-len(suffix)]
+    return name
+
+
+def merge_exposition(texts, live) -> str:
+    """Суммирует метрики воркеров; gauge берутся только у живых (live[i] == True)"""
+    families, grouped = {}, {}
+    for text, alive in zip(texts, live):
+        parsed_families, samples = _parse(text)
+        for name, meta in parsed_families.items():
+            families.setdefault(name, {}).update(meta)
+        for series, value in samples.items():
+            family = _family(series, families)
+            if not alive and families.get(family, {}).get("TYPE") == "gauge":
+                continue
+            bucket = grouped.setdefault(family, {})
+            bucket[series] = bucket.get(series, 0) + value
+
+    lines = []
+    for family, samples in grouped.items():
+        meta = families.get(family, {})
+        if "HELP" in meta:
+            lines.append(f"# HELP {family} {meta['HELP']}")
+        if "TYPE" in meta:
+            lines.append(f"# TYPE {family} {meta['TYPE']}")
+        lines.extend(f"{series} {int(value) if value.is_integer() else value!r}" for series, value in samples.items())
+    return "\n".join(lines) + "\n"
+
+
+class WorkerSnapshots:
+    """Файлы <pid>.prom с метриками воркеров; счетчики завершившихся воркеров копятся в archive.prom"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory) if directory else None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _write(self, path: Path, text: str):
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+
+    def flush(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._write(self.directory / f"{os.getpid()}.prom", registry.render())
+
+    def start(self):
+        """Фоновая запись снимка этого воркера; вызывается в воркере после fork"""
+        if not self.enabled or self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+        self._thread = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    def _locked(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lock = open(self.directory / ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def render(self) -> str:
+        self.flush()
+        texts, live = [], []
+        with self._locked():
+            for path in sorted(self.directory.glob("*.prom")):
+                try:
+                    text = path.read_text(encoding="utf-8")
+                except FileNotFoundError:
+                    continue
+                texts.append(text)
+                live.append(path.stem.isdigit() and _process_alive(int(path.stem)))
+        return merge_exposition(texts, live)
+
+    def mark_dead(self, pid: int):
+        """Вызывается мастером gunicorn: счетчики воркера переносятся в архив, gauge отбрасываются"""
+        path = self.directory / f"{pid}.prom"
+        with self._locked():
+            if not path.exists():
+                return
+            archive = self.directory / ARCHIVE_FILE
+            texts = [path.read_text(encoding="utf-8")]
+            if archive.exists():
+                texts.append(archive.read_text(encoding="utf-8"))
+            self._write(archive, merge_exposition(texts, [False] * len(texts)))
+            path.unlink()
+
+    def reset(self):
+        """Вызывается мастером при старте: файлы прошлого запуска удаляются"""
+        if self.directory is not None and self.directory.exists():
+            for path in self.directory.glob("*.prom*"):
+                path.unlink(missing_ok=True)
+
+
+worker_snapshots = WorkerSnapshots(METRICS_MULTIPROC_DIR)
+
+
+def render() -> str:
+    """Метрики для /api/metrics: этого процесса или сумма по всем воркерам"""
+    return worker_snapshots.render() if worker_snapshots.enabled else registry.render()
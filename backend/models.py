@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, Text, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, selectin_polymorphic, with_polymorphic
+from sqlalchemy.sql.util import find_tables
 from datetime import datetime
+from typing import Optional
 import bcrypt
 
 Base = declarative_base()
@@ -46,17 +48,25 @@ class Patient(Base):
     __tablename__ = 'patients'
     
     id = Column(Integer, primary_key=True, index=True)
-    institution_id = Column(Integer, ForeignKey('institutions.id'), nullable=False)
+    institution_id = Column(Integer, ForeignKey('institutions.id'), nullable=False, index=True)
     created_by = Column(Integer, ForeignKey('users.id'), nullable=False)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     institution = relationship("Institution", back_populates="patients")
     created_by_user = relationship("User", back_populates="patients")
     clinical_record = relationship("ClinicalRecord", back_populates="patient", uselist=False)
 
 class ClinicalRecord(Base):
+    """Общая часть клинической записи; поля регистров - в таблицах расширений.
+
+    Запись всегда создается как AlkClinicalRecord или Ros1ClinicalRecord (по registry_type).
+    По умолчанию запрос читает только clinical_records, а строка расширения подгружается
+    при обращении к ее полю - только из таблицы регистра этой записи. Списки и выгрузки
+    берут расширения тем же запросом (record_with_extensions), запросы по колонкам всех
+    регистров присоединяют таблицы явно (join_record_extensions).
+    """
     __tablename__ = 'clinical_records'
     
     id = Column(Integer, primary_key=True, index=True)
@@ -79,16 +89,40 @@ class ClinicalRecord(Base):
     # Диагноз
     initial_diagnosis_date = Column(DateTime)
     tnm_stage = Column(String(50))
-    metastatic_disease_date = Column(DateTime)
     histology = Column(String(100))
     histology_other = Column(Text)
     
+    # Биомаркеры (заполняются в обоих регистрах)
+    tp53_comutation = Column(String(20))
+    ttf1_expression = Column(String(20))
+
+    # Статус
+    current_status = Column(String(50))
+    last_contact_date = Column(DateTime)
+    age_at_diagnosis = Column(Integer)
+    
+    patient = relationship("Patient", back_populates="clinical_record")
+
+    __mapper_args__ = {'polymorphic_on': registry_type}
+
+    def __getattr__(self, name):
+        # Поля другого регистра читаются как пустые, как и до разделения таблицы
+        if name in EXTENSION_FIELDS:
+            return None
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+class AlkClinicalRecord(ClinicalRecord):
+    """Поля регистра ALK (терапия алектинибом)"""
+    __tablename__ = 'clinical_records_alk'
+
+    id = Column(Integer, ForeignKey('clinical_records.id', ondelete='CASCADE'), primary_key=True)
+
+    metastatic_disease_date = Column(DateTime)
+
     # ALK
     alk_diagnosis_date = Column(DateTime)
     alk_methods = Column(JSON)
     alk_fusion_variant = Column(String(50))
-    tp53_comutation = Column(String(20))
-    ttf1_expression = Column(String(20))
     
     # Предыдущая терапия
     had_previous_therapy = Column(Boolean)
@@ -102,7 +136,7 @@ class ClinicalRecord(Base):
     previous_therapy_stop_reason_other = Column(Text)
     
     # Алектиниб
-    alectinib_start_date = Column(DateTime)
+    alectinib_start_date = Column(DateTime, index=True)
     stage_at_alectinib_start = Column(String(50))
     ecog_at_start = Column(Integer)
     metastases_sites = Column(JSON)
@@ -152,8 +186,15 @@ class ClinicalRecord(Base):
     next_line_treatments_other_text = Column(Text)
     next_line_end_date = Column(DateTime)
     total_lines_after_alectinib = Column(Integer)
-    
-    # ROS1
+
+    __mapper_args__ = {'polymorphic_identity': 'ALK'}
+
+class Ros1ClinicalRecord(ClinicalRecord):
+    """Поля регистра ROS1 (радикальное лечение и линии терапии метастатической стадии)"""
+    __tablename__ = 'clinical_records_ros1'
+
+    id = Column(Integer, ForeignKey('clinical_records.id', ondelete='CASCADE'), primary_key=True)
+
     ros1_fusion_variant = Column(String(50))
     pdl1_status = Column(String(20))
     pdl1_tps = Column(Float)
@@ -174,12 +215,87 @@ class ClinicalRecord(Base):
     metastatic_diagnosis_date = Column(DateTime)
     metastatic_therapy_lines = Column(JSON)
 
-    # Статус
-    current_status = Column(String(50))
-    last_contact_date = Column(DateTime)
-    age_at_diagnosis = Column(Integer)
-    
-    patient = relationship("Patient", back_populates="clinical_record")
+    __mapper_args__ = {'polymorphic_identity': 'ROS1'}
+
+# Тип регистра -> класс клинической записи
+RECORD_CLASSES = {'ALK': AlkClinicalRecord, 'ROS1': Ros1ClinicalRecord}
+
+# Поля таблиц расширений (у записи другого регистра равны None)
+EXTENSION_FIELDS = frozenset(
+    column.key for record_class in RECORD_CLASSES.values()
+    for column in record_class.__table__.columns if column.key != 'id'
+)
+
+def record_with_extensions(registry_type: Optional[str] = None):
+    """Сущность для запросов списков: clinical_records с LEFT JOIN таблиц расширений по ключу.
+
+    С registry_type присоединяется только таблица этого регистра.
+    """
+    if registry_type in RECORD_CLASSES:
+        return with_polymorphic(ClinicalRecord, [RECORD_CLASSES[registry_type]])
+    return with_polymorphic(ClinicalRecord, list(RECORD_CLASSES.values()))
+
+def load_record_extension():
+    """Опция запроса записей по одной: строка расширения читается отдельным запросом
+    по первичному ключу и только из таблицы регистра загруженной записи"""
+    return selectin_polymorphic(ClinicalRecord, list(RECORD_CLASSES.values()))
+
+def join_record_extensions(query, *expressions):
+    """LEFT JOIN таблиц расширений к clinical_records для запросов по их колонкам.
+
+    Без expressions присоединяются все таблицы расширений, иначе - только те, на
+    колонки которых ссылаются переданные выражения (выбранные поля, условие фильтра).
+    """
+    needed = None
+    if expressions:
+        needed = set()
+        for expression in expressions:
+            needed.update(find_tables(expression, check_columns=True))
+    for record_class in RECORD_CLASSES.values():
+        extension = record_class.__table__
+        if needed is None or extension in needed:
+            query = query.outerjoin(extension, extension.c.id == ClinicalRecord.id)
+    return query
+
+def clinical_record_columns() -> list:
+    """Колонки всех таблиц клинической записи: общие, затем ALK и ROS1 (без ключей расширений)"""
+    columns = list(ClinicalRecord.__table__.columns)
+    for record_class in RECORD_CLASSES.values():
+        columns += [column for column in record_class.__table__.columns if column.key != 'id']
+    return columns
+
+class ClinicalRecordCode(Base):
+    """Коды из JSON-списков клинической записи: индекс для фильтров по мультивыбору (code_index.py)"""
+    __tablename__ = 'clinical_record_codes'
+    record_id = Column(Integer, ForeignKey('clinical_records.id', ondelete='CASCADE'), primary_key=True)
+    field = Column(String(50), primary_key=True)
+    code = Column(String(100), primary_key=True)
+    __table_args__ = (
+        Index('ix_clinical_record_codes_field_code', 'field', 'code', 'record_id'),
+    )
+
+class TherapyLine(Base):
+    """Линии терапии ROS1 из JSON metastatic_therapy_lines / radical_perioperative_therapy (therapy_lines.py)"""
+    __tablename__ = 'therapy_lines'
+    id = Column(Integer, primary_key=True)
+    record_id = Column(Integer, ForeignKey('clinical_records.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = Column(String(20), nullable=False)  # metastatic | perioperative
+    line_no = Column(Integer, nullable=False)
+    line_type = Column(String(20))  # NEOADJUVANT / ADJUVANT для периоперационной терапии
+    drug = Column(String(200))  # коды препаратов через "+" в алфавитном порядке
+    therapy_class = Column(String(50))
+    regimen_code = Column(String(50))
+    start_date = Column(DateTime)
+    end_date = Column(DateTime)
+    progression_date = Column(DateTime)
+    progression_type = Column(String(50))
+    response = Column(String(50))
+    stop_reason = Column(String(100))
+    ecog = Column(Integer)
+    __table_args__ = (
+        Index('ix_therapy_lines_drug_line', 'drug', 'line_no'),
+        Index('ix_therapy_lines_kind_line', 'kind', 'line_no'),
+    )
 
 class Dictionary(Base):
     __tablename__ = 'dictionaries'
@@ -197,8 +313,49 @@ class AuditLog(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     action = Column(String(100), nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     record_type = Column(String(50))
     record_id = Column(Integer)
     details = Column(JSON)
-    user = relationship("User", back_populates="audit_logs")
\ No newline at end of file
+    user = relationship("User", back_populates="audit_logs")
+
+class CacheGeneration(Base):
+    """Счетчики поколений внутрипроцессных кэшей для согласования между воркерами"""
+    __tablename__ = 'cache_generations'
+    name = Column(String(50), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+class SeedChecksum(Base):
+    """Контрольные суммы применённых наборов начальных данных (справочников) и отметки однократных переносов данных"""
+    __tablename__ = 'seed_checksums'
+    name = Column(String(100), primary_key=True)
+    checksum = Column(String(64), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ExportJob(Base):
+    """Фоновая выгрузка пациентов в CSV (export_jobs.py)"""
+    __tablename__ = 'export_jobs'
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    status = Column(String(20), nullable=False, default='queued', index=True)
+    params = Column(JSON, nullable=False)
+    rows_done = Column(Integer, nullable=False, default=0)
+    rows_total = Column(Integer)
+    file_name = Column(String(200))
+    size_bytes = Column(Integer)
+    error = Column(Text)
+    pid = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
+
+class ChangeEvent(Base):
+    """Уведомления об изменениях для ленты GET /api/events (events.py); id - версия ленты"""
+    __tablename__ = 'change_events'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    kind = Column(String(20), nullable=False)
+    action = Column(String(20), nullable=False)
+    institution_id = Column(Integer)  # None - событие видно всем пользователям
+    payload = Column(JSON, nullable=False)
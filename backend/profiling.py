@@ -0,0 +1,179 @@
+"""
+Профилирование отдельного запроса по требованию администратора
+
+Запрос с заголовком X-Profile: cpu|memory (или параметром ?_profile=cpu|memory)
+выполняется под cProfile; в режиме memory дополнительно собирается статистика
+аллокаций tracemalloc. Профилируется тело обработчика в рабочем потоке
+(зависимости, включая аутентификацию, не входят).
+
+Результат сохраняется в PROFILE_DIR: <id>.prof (формат pstats, открывается
+snakeviz/pstats) и <id>.json с маршрутом, пользователем, временем и сводкой.
+Профилирование доступно только администраторам и не чаще одного раза в
+PROFILE_MIN_INTERVAL_SECONDS; без заголовка обертка стоит одну проверку ContextVar.
+"""
+import asyncio
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+
+from metrics import current_request
+
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', 'profiles'))
+PROFILE_MIN_INTERVAL_SECONDS = float(os.getenv('PROFILE_MIN_INTERVAL_SECONDS', '10'))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))
+PROFILE_MODES = {"cpu", "memory"}
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$")
+
+
+def requested_mode(request: Request) -> Optional[str]:
+    mode = request.headers.get("x-profile") or request.query_params.get("_profile")
+    if mode in ("1", "true"):
+        mode = "cpu"
+    return mode if mode in PROFILE_MODES else None
+
+
+class Profiler:
+    def __init__(self, directory: Path, min_interval: float, max_files: int):
+        self.directory = directory
+        self.min_interval = min_interval
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._busy = False
+        self._last_started = float("-inf")
+
+    def _acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._busy or now - self._last_started < self.min_interval:
+                return False
+            self._busy = True
+            self._last_started = now
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._busy = False
+
+    def run(self, stats, mode: str, endpoint, args, kwargs):
+        if not self._acquire():
+            stats.profile_result = "rate-limited"
+            return endpoint(*args, **kwargs)
+
+        trace_memory = mode == "memory" and not tracemalloc.is_tracing()
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            if trace_memory:
+                tracemalloc.start(10)
+            profile.enable()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                profile.disable()
+                duration = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot() if trace_memory else None
+                if trace_memory:
+                    tracemalloc.stop()
+                stats.profile_result = self._save(stats, mode, profile, snapshot, duration)
+        finally:
+            self._release()
+
+    def _save(self, stats, mode, profile, snapshot, duration) -> str:
+        profile_id = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(str(self.directory / f"{profile_id}.prof"))
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(40)
+        meta = {
+            "id": profile_id,
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+            "mode": mode,
+            "method": stats.method,
+            "route": stats.route,
+            "path": stats.scope.get("path"),
+            "query_string": stats.scope.get("query_string", b"").decode("latin-1"),
+            "user_id": stats.user_id,
+            "duration_ms": round(duration * 1000, 2),
+            "sql_queries": stats.query_count,
+            "sql_ms": round(stats.sql_time * 1000, 2),
+            "summary": summary.getvalue(),
+        }
+        if snapshot is not None:
+            meta["allocations"] = [
+                {"location": str(stat.traceback), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:30]
+            ]
+        (self.directory / f"{profile_id}.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+        self._enforce_retention()
+        return profile_id
+
+    def _enforce_retention(self):
+        metas = sorted(self.directory.glob("*.json"))
+        for old in metas[:-self.max_files] if len(metas) > self.max_files else []:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".prof").unlink(missing_ok=True)
+
+    def list(self) -> list:
+        if not self.directory.exists():
+            return []
+        result = []
+        for path in sorted(self.directory.glob("*.json"), reverse=True):
+            meta = json.loads(path.read_text(encoding="utf-8"))
+            meta.pop("summary", None)
+            meta.pop("allocations", None)
+            result.append(meta)
+        return result
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        path = self.prof_path(profile_id)
+        if path is None or not path.with_suffix(".json").exists():
+            return None
+        return json.loads(path.with_suffix(".json").read_text(encoding="utf-8"))
+
+    def prof_path(self, profile_id: str) -> Optional[Path]:
+        # id проверяется по шаблону, чтобы исключить выход за пределы каталога
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        return self.directory / f"{profile_id}.prof"
+
+
+profiler = Profiler(PROFILE_DIR, PROFILE_MIN_INTERVAL_SECONDS, PROFILE_MAX_FILES)
+
+
+def wrap_endpoint(endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+        # async-обработчики выполняются в event loop, cProfile там исказил бы картину
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def profiled_endpoint(*args, **kwargs):
+        stats = current_request.get()
+        if stats is None or stats.profile_mode is None:
+            return endpoint(*args, **kwargs)
+        if getattr(kwargs.get("current_user"), "role", None) != "admin":
+            return endpoint(*args, **kwargs)
+        return profiler.run(stats, stats.profile_mode, endpoint, args, kwargs)
+
+    return profiled_endpoint
+
+
+class ProfiledRoute(APIRoute):
+    """Маршрут, обработчик которого можно выполнить под профилировщиком"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, wrap_endpoint(endpoint), **kwargs)
@@ -0,0 +1,95 @@
+"""
+Бюджет SQL-запросов на эндпоинт: обнаружение N+1
+
+Бюджет объявляется декоратором рядом с эндпоинтом:
+
+    @app.get("/api/patients")
+    @query_budget(4)
+    def list_patients(...): ...
+
+Режим задается QUERY_BUDGET_MODE:
+    off   - проверки выключены (по умолчанию)
+    warn  - предупреждение в лог со стеком места превышения (staging)
+    raise - исключение QueryBudgetExceeded (тесты)
+
+Помимо общего числа запросов проверяется повтор одного и того же SQL
+(одинаковый текст с разными параметрами) больше max_repeats раз - типичный
+след ленивой загрузки связи в цикле.
+"""
+import logging
+import os
+import traceback
+from typing import Optional
+
+from sqlalchemy import event
+
+from cache import caches
+from metrics import RequestStats, current_request
+
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'off')
+DEFAULT_MAX_REPEATS = int(os.getenv('QUERY_BUDGET_MAX_REPEATS', '10'))
+STACK_SAMPLE_DEPTH = 25
+
+logger = logging.getLogger("registry.query_budget")
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class QueryBudget:
+    def __init__(self, max_queries: Optional[int], max_repeats: int):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+
+
+DEFAULT_BUDGET = QueryBudget(None, DEFAULT_MAX_REPEATS)
+
+
+def query_budget(max_queries: Optional[int] = None, max_repeats: int = DEFAULT_MAX_REPEATS):
+    """Объявляет бюджет запросов эндпоинта (включая запрос пользователя в get_current_user)"""
+    def decorator(endpoint):
+        endpoint.query_budget = QueryBudget(max_queries, max_repeats)
+        return endpoint
+    return decorator
+
+
+def budget_for(stats: RequestStats) -> QueryBudget:
+    endpoint = stats.scope.get("endpoint")
+    return getattr(endpoint, "query_budget", DEFAULT_BUDGET)
+
+
+def install_budget_hooks(engine):
+    if QUERY_BUDGET_MODE == 'off':
+        return
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        stats = current_request.get()
+        if stats is None or stats.budget_violation is not None:
+            return
+
+        repeats = stats.statements[statement] = stats.statements.get(statement, 0) + 1
+        budget = budget_for(stats)
+        # Сверка поколений кэшей в get_db (несколько воркеров) не входит в бюджет эндпоинта
+        max_queries = budget.max_queries + 1 if budget.max_queries is not None and caches.enabled else budget.max_queries
+        if max_queries is not None and stats.query_count > max_queries:
+            reason = f"{stats.query_count} queries, budget {max_queries}"
+        elif repeats > budget.max_repeats:
+            reason = f"statement repeated {repeats} times, limit {budget.max_repeats}: {statement[:200]}"
+        else:
+            return
+        # Стек снимается в момент превышения: он указывает на цикл с ленивой загрузкой
+        stack = "".join(traceback.format_stack(limit=STACK_SAMPLE_DEPTH)[:-1])
+        stats.budget_violation = (reason, stack)
+
+
+def check_budget(stats: RequestStats):
+    """Вызывается middleware после обработки запроса"""
+    if stats.budget_violation is None:
+        return
+    reason, stack = stats.budget_violation
+    message = f"Query budget exceeded on {stats.method} {stats.route}: {reason}"
+    if QUERY_BUDGET_MODE == 'raise':
+        raise QueryBudgetExceeded(f"{message}\n{stack}")
+    logger.warning("%s\n%s", message, stack)
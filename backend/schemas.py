@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, validator, field_validator, model_validator
 from datetime import datetime
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Literal
 from enum import Enum
 
 class Gender(str, Enum):
@@ -337,4 +337,39 @@ class AnalyticsResponse(BaseModel):
 class PatientSearch(BaseModel):
     patient_code: Optional[str] = None
     birth_date: Optional[str] = None
-    institution_id: Optional[int] = None
\ No newline at end of file
+    institution_id: Optional[int] = None
+
+class CohortQuery(BaseModel):
+    filter: dict
+    include_ids: bool = False
+    offset: int = Field(0, ge=0)
+    limit: int = Field(100, ge=1, le=1000)
+
+class CohortQueryResponse(BaseModel):
+    filter_hash: str
+    count: int
+    ids: Optional[List[int]] = None
+    offset: Optional[int] = None
+    limit: Optional[int] = None
+
+class ExportJobCreate(BaseModel):
+    institution_id: Optional[int] = None
+    registry_type: Optional[str] = None
+    mode: Literal["standard", "full"] = "standard"
+    labels: Optional[Literal["ru"]] = None
+    gzip: bool = False
+
+class ExportJobResponse(BaseModel):
+    id: str
+    status: str
+    params: dict
+    rows_done: int
+    rows_total: Optional[int] = None
+    progress: float
+    file_name: Optional[str] = None
+    size_bytes: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
@@ -0,0 +1,109 @@
+"""
+Идемпотентное заполнение справочников
+
+Набор справочников описывается списком {"category": ..., "items": [(code, value_ru,
+sort_order[, parent]), ...]}. Контрольная сумма набора сохраняется в seed_checksums:
+если набор не менялся, повторный запуск при деплое - один SELECT. Иначе существующие
+ключи (category, code) читаются одним запросом, недостающие записи вставляются одним
+executemany, измененные обновляются пакетно по id.
+"""
+import hashlib
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from models import Dictionary, SeedChecksum
+
+SeedResult = namedtuple("SeedResult", ["inserted", "updated", "deactivated"])
+
+
+def seed_checksum(dictionaries: list, sync_active: bool = False) -> str:
+    payload = json.dumps([dictionaries, sync_active], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def seed_dictionaries(db: Session, name: str, dictionaries: list, sync_active: bool = False, force: bool = False,
+                      insert_only: bool = False):
+    """Заполняет справочники набором name; возвращает SeedResult или None, если набор уже применен.
+
+    sync_active: список кодов категории считается полным - перечисленные коды
+    активируются, остальные коды категории деактивируются.
+    insert_only: добавляются только недостающие коды, у существующих записей (в том
+    числе измененных администратором) название, порядок и родитель не трогаются;
+    вместе с sync_active у них меняется только is_active.
+    Коммит выполняет вызывающий код.
+    """
+    checksum = seed_checksum(dictionaries, sync_active)
+    applied = db.get(SeedChecksum, name)
+    if applied is not None and applied.checksum == checksum and not force:
+        return None
+
+    categories = [dict_cat["category"] for dict_cat in dictionaries]
+    existing = {
+        (row.category, row.code): row
+        for row in db.query(
+            Dictionary.id, Dictionary.category, Dictionary.code, Dictionary.value_ru,
+            Dictionary.sort_order, Dictionary.parent, Dictionary.is_active,
+        ).filter(Dictionary.category.in_(categories))
+    }
+
+    to_insert, to_update, to_activate, seeded_keys = [], [], [], set()
+    for dict_cat in dictionaries:
+        category = dict_cat["category"]
+        for item in dict_cat["items"]:
+            if len(item) == 4:
+                code, value_ru, sort_order, parent = item
+            else:
+                code, value_ru, sort_order = item
+                parent = None
+            seeded_keys.add((category, code))
+
+            row = existing.get((category, code))
+            if row is None:
+                to_insert.append({
+                    "category": category, "code": code, "value_ru": value_ru,
+                    "sort_order": sort_order, "parent": parent, "is_active": True,
+                })
+                continue
+            if insert_only:
+                if sync_active and not row.is_active:
+                    to_activate.append(row.id)
+                continue
+
+            # parent не сбрасывается, если в наборе он не указан
+            target = {
+                "value_ru": value_ru,
+                "sort_order": sort_order,
+                "parent": parent if parent is not None else row.parent,
+                "is_active": True if sync_active else row.is_active,
+            }
+            if any(getattr(row, key) != value for key, value in target.items()):
+                to_update.append({"id": row.id, **target})
+
+    to_deactivate = []
+    if sync_active:
+        to_deactivate = [
+            row.id for key, row in existing.items()
+            if key not in seeded_keys and row.is_active
+        ]
+
+    if to_insert:
+        db.execute(insert(Dictionary), to_insert)
+    if to_update:
+        db.execute(update(Dictionary), to_update)
+    for ids, is_active in ((to_activate, True), (to_deactivate, False)):
+        if ids:
+            db.query(Dictionary).filter(Dictionary.id.in_(ids)).update(
+                {Dictionary.is_active: is_active}, synchronize_session=False
+            )
+
+    if applied is None:
+        db.add(SeedChecksum(name=name, checksum=checksum))
+    else:
+        applied.checksum = checksum
+        applied.applied_at = datetime.utcnow()
+    db.flush()
+    return SeedResult(len(to_insert), len(to_update) + len(to_activate), len(to_deactivate))
@@ -0,0 +1,191 @@
+"""
+Анализ времени до события: кривые Каплана-Мейера для PFS, OS и времени на терапии
+
+Отсчет ведется от alectinib_start_date (только записи ALK, поэтому группировки по
+регистру нет, а фильтр registry_type=ROS1 дает пустую когорту). Определения:
+    OS  - событие: current_status = DEAD (дата - last_contact_date), иначе цензура
+          на last_contact_date
+    PFS - событие: progression_date или смерть, иначе цензура на last_contact_date
+    TTD - время на терапии; событие: alectinib_end_date или смерть, иначе цензура
+          на last_contact_date
+
+Нужные колонки выбираются одним запросом (даты - как julianday SQLite) в массивы
+NumPy; оценка, доверительные интервалы (формула Гринвуда, log(-log)) и медианы
+считаются векторно. Результаты кэшируются по когорте и версии данных пациентов.
+"""
+from statistics import NormalDist
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from cache import VersionedResultCache, patient_data_version, institution_names
+from models import Patient, AlkClinicalRecord
+
+DAYS_PER_MONTH = 365.25 / 12
+ENDPOINTS = ("pfs", "os", "ttd")
+GROUP_BY_FIELDS = ("institution", "stage", "cns_metastases")
+
+survival_cache = VersionedResultCache(patient_data_version, maxsize=64)
+
+
+def kaplan_meier(durations: np.ndarray, events: np.ndarray, confidence: float = 0.95) -> dict:
+    """Оценка Каплана-Мейера; durations - в месяцах, events - bool"""
+    n = int(durations.size)
+    if n == 0:
+        return {"n": 0, "events": 0, "median": None, "median_ci": [None, None], "curve": []}
+
+    times, inverse = np.unique(durations, return_inverse=True)
+    deaths = np.bincount(inverse, weights=events.astype(float), minlength=times.size)
+    removed = np.bincount(inverse, minlength=times.size)
+    at_risk = n - np.concatenate(([0], np.cumsum(removed)[:-1]))
+
+    # Ступени кривой - только моменты событий
+    mask = deaths > 0
+    t, d, r = times[mask], deaths[mask], at_risk[mask].astype(float)
+    survival = np.cumprod(1.0 - d / r)
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        greenwood = np.cumsum(d / (r * (r - d)))
+        log_survival = np.log(survival)
+        se = np.sqrt(greenwood) / np.abs(log_survival)
+        lower = survival ** np.exp(z * se)
+        upper = survival ** np.exp(-z * se)
+    # При S = 0 интервал вырождается
+    lower = np.where(survival > 0, lower, 0.0)
+    upper = np.where(survival > 0, upper, 0.0)
+    lower = np.nan_to_num(lower, nan=0.0)
+    upper = np.nan_to_num(upper, nan=1.0)
+
+    def first_below_half(values: np.ndarray) -> Optional[float]:
+        index = np.flatnonzero(values <= 0.5)
+        return round(float(t[index[0]]), 2) if index.size else None
+
+    return {
+        "n": n,
+        "events": int(d.sum()),
+        "median": first_below_half(survival),
+        # Граница медианы по нижней/верхней доверительной кривой
+        "median_ci": [first_below_half(lower), first_below_half(upper)],
+        "curve": [
+            {"time": 0.0, "survival": 1.0, "lower": 1.0, "upper": 1.0, "at_risk": n},
+        ] + [
+            {"time": round(float(ti), 2), "survival": round(float(si), 4), "lower": round(float(li), 4),
+             "upper": round(float(ui), 4), "at_risk": int(ri)}
+            for ti, si, li, ui, ri in zip(t, survival, lower, upper, r)
+        ],
+    }
+
+
+def extract_columns(db: Session, registry_type: Optional[str], institution_id: Optional[int],
+                    stage: Optional[str], cns_metastases: Optional[bool]) -> Dict[str, np.ndarray]:
+    """Один запрос по когорте: даты в днях (julianday), признаки событий и поля группировки"""
+    query = db.query(
+        func.julianday(AlkClinicalRecord.alectinib_start_date),
+        func.julianday(AlkClinicalRecord.progression_date),
+        func.julianday(AlkClinicalRecord.alectinib_end_date),
+        func.julianday(AlkClinicalRecord.last_contact_date),
+        AlkClinicalRecord.current_status == 'DEAD',
+        Patient.institution_id,
+        AlkClinicalRecord.stage_at_alectinib_start,
+        AlkClinicalRecord.cns_metastases,
+    ).join(Patient).filter(Patient.is_active == True, AlkClinicalRecord.alectinib_start_date.isnot(None))
+
+    if registry_type:
+        query = query.filter(AlkClinicalRecord.registry_type == registry_type)
+    if institution_id:
+        query = query.filter(Patient.institution_id == institution_id)
+    if stage:
+        query = query.filter(AlkClinicalRecord.stage_at_alectinib_start == stage)
+    if cns_metastases is not None:
+        query = query.filter(AlkClinicalRecord.cns_metastases == cns_metastases)
+
+    rows = query.all()
+    start, progression, end, last_contact, dead, institution, stage_col, cns = zip(*rows) if rows else [()] * 8
+    return {
+        "start": np.array(start, dtype=float),
+        "progression": np.array(progression, dtype=float),
+        "end": np.array(end, dtype=float),
+        "last_contact": np.array(last_contact, dtype=float),
+        "dead": np.array(dead, dtype=object) == 1 if rows else np.zeros(0, dtype=bool),
+        "institution": np.array(institution, dtype=object),
+        "stage": np.array(stage_col, dtype=object),
+        "cns_metastases": np.array(cns, dtype=object),
+    }
+
+
+def endpoint_data(columns: Dict[str, np.ndarray], endpoint: str):
+    """Длительности (месяцы) и признаки события; строки без даты наблюдения исключаются"""
+    start, last_contact, dead = columns["start"], columns["last_contact"], columns["dead"]
+    has_contact = ~np.isnan(last_contact)
+    dead = dead & has_contact
+
+    if endpoint == "os":
+        stop, event = last_contact, dead
+    else:
+        marker = columns["progression"] if endpoint == "pfs" else columns["end"]
+        has_marker = ~np.isnan(marker)
+        stop = np.where(has_marker, marker, last_contact)
+        event = has_marker | dead
+
+    durations = (stop - start) / DAYS_PER_MONTH
+    valid = ~np.isnan(durations) & (durations >= 0)
+    return durations[valid], event[valid], int((~valid).sum())
+
+
+def group_label(db: Session, group_by: str, value) -> str:
+    if value is None:
+        return "Не указано"
+    if group_by == "institution":
+        return institution_names.get(db, value)
+    if group_by == "cns_metastases":
+        return "Да" if value else "Нет"
+    return str(value)
+
+
+def compute_survival(db: Session, registry_type: Optional[str] = None, institution_id: Optional[int] = None,
+                     stage: Optional[str] = None, cns_metastases: Optional[bool] = None,
+                     group_by: Optional[str] = None, confidence: float = 0.95) -> dict:
+    key = (registry_type, institution_id, stage, cns_metastases, group_by, confidence)
+
+    def compute():
+        columns = extract_columns(db, registry_type, institution_id, stage, cns_metastases)
+        if group_by:
+            values = columns[group_by]
+            # Группа без значения - последней
+            groups = sorted(set(values.tolist()), key=lambda value: (value is None, value if value is not None else 0))
+            masks = [(value, values == value) for value in groups]
+        else:
+            masks = [(None, np.ones(columns["start"].size, dtype=bool))]
+
+        cohorts: List[dict] = []
+        for value, mask in masks:
+            subset = {name: column[mask] for name, column in columns.items()}
+            curves, excluded = {}, {}
+            for endpoint in ENDPOINTS:
+                durations, events, excluded[endpoint] = endpoint_data(subset, endpoint)
+                curves[endpoint] = kaplan_meier(durations, events, confidence)
+            cohorts.append({
+                "group": group_label(db, group_by, value) if group_by else "Все пациенты",
+                "group_value": value,
+                "patients": int(mask.sum()),
+                "excluded": excluded,
+                "curves": curves,
+            })
+
+        return {
+            "filters": {
+                "registry_type": registry_type,
+                "institution_id": institution_id,
+                "stage": stage,
+                "cns_metastases": cns_metastases,
+            },
+            "group_by": group_by,
+            "time_unit": "months",
+            "confidence": confidence,
+            "cohorts": cohorts,
+        }
+
+    return survival_cache.get_or_compute(key, compute)
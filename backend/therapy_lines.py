@@ -0,0 +1,213 @@
+"""
+Линии терапии ROS1 в отдельной таблице
+
+История терапии хранится в JSON metastatic_therapy_lines и radical_perioperative_therapy
+(формат API не меняется). Для вопросов уровня линии ("медиана длительности 2-й линии
+кризотиниба") каждая линия дублируется строкой therapy_lines с индексами по препарату
+и номеру линии, и такие вопросы решаются SQL-агрегатами. Таблица обновляется в
+after_flush любой сессии ORM, как и clinical_record_codes (code_index.py).
+"""
+import json
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from cache import VersionedResultCache, patient_data_version
+from models import Patient, ClinicalRecord, Ros1ClinicalRecord, TherapyLine
+
+# Поле JSON -> вид линии
+LINE_FIELDS = {
+    'metastatic_therapy_lines': 'metastatic',
+    'radical_perioperative_therapy': 'perioperative',
+}
+REBUILD_CHUNK_SIZE = 5000
+
+line_statistics_cache = VersionedResultCache(patient_data_version, maxsize=128)
+
+
+def _parse_date(value) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', ''))
+    except ValueError:
+        return None
+
+
+def _parse_int(value) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def _text(value) -> Optional[str]:
+    return value if isinstance(value, str) and value else None
+
+
+def line_rows(record_id: int, field: str, value) -> list:
+    """Строки therapy_lines из JSON-значения поля (фронтенд присылает массив строкой JSON)"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return []
+    if not isinstance(value, list):
+        return []
+
+    rows = []
+    for index, line in enumerate(value, start=1):
+        if not isinstance(line, dict):
+            continue
+        therapy = line.get('therapy') if isinstance(line.get('therapy'), dict) else {}
+        drugs = sorted({code for code in therapy.get('custom_drugs') or [] if isinstance(code, str) and code})
+        rows.append({
+            "record_id": record_id,
+            "kind": LINE_FIELDS[field],
+            "line_no": _parse_int(line.get('line_number')) or index,
+            "line_type": _text(line.get('type')),
+            "drug": "+".join(drugs)[:200] or None,
+            "therapy_class": _text(therapy.get('therapy_class')),
+            "regimen_code": _text(therapy.get('regimen_code')),
+            "start_date": _parse_date(line.get('start_date')),
+            "end_date": _parse_date(line.get('end_date')),
+            "progression_date": _parse_date(line.get('progression_date')),
+            "progression_type": _text(line.get('progression_type')),
+            "response": _text(line.get('response')),
+            "stop_reason": _text(line.get('stop_reason')),
+            "ecog": _parse_int(line.get('ecog_status')),
+        })
+    return rows
+
+
+@event.listens_for(Session, "after_flush")
+def _sync_therapy_lines(session, flush_context):
+    rows, stale = [], []
+    for obj in session.new:
+        if isinstance(obj, Ros1ClinicalRecord):
+            for field in LINE_FIELDS:
+                rows.extend(line_rows(obj.id, field, getattr(obj, field)))
+    for obj in session.dirty:
+        if isinstance(obj, Ros1ClinicalRecord):
+            for field, kind in LINE_FIELDS.items():
+                if get_history(obj, field).has_changes():
+                    stale.append((obj.id, kind))
+                    rows.extend(line_rows(obj.id, field, getattr(obj, field)))
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, ClinicalRecord)]
+
+    if not (rows or stale or deleted):
+        return
+    connection = session.connection()
+    for record_id, kind in stale:
+        connection.execute(delete(TherapyLine).where(TherapyLine.record_id == record_id, TherapyLine.kind == kind))
+    if deleted:
+        connection.execute(delete(TherapyLine).where(TherapyLine.record_id.in_(deleted)))
+    if rows:
+        connection.execute(insert(TherapyLine), rows)
+
+
+def rebuild(connection):
+    """Полностью перестраивает therapy_lines по JSON клинических записей"""
+    connection.execute(delete(TherapyLine))
+    table = Ros1ClinicalRecord.__table__
+    columns = [table.c.id] + [table.c[field] for field in LINE_FIELDS]
+    rows, total = [], 0
+    for record in connection.execute(select(*columns)).all():
+        for field, value in zip(LINE_FIELDS, record[1:]):
+            rows.extend(line_rows(record[0], field, value))
+        if len(rows) >= REBUILD_CHUNK_SIZE:
+            connection.execute(insert(TherapyLine), rows)
+            total += len(rows)
+            rows = []
+    if rows:
+        connection.execute(insert(TherapyLine), rows)
+        total += len(rows)
+    return total
+
+
+def needs_rebuild(connection) -> bool:
+    has_lines = connection.execute(select(TherapyLine.id).limit(1)).first() is not None
+    has_records = connection.execute(select(Ros1ClinicalRecord.__table__.c.id).limit(1)).first() is not None
+    return has_records and not has_lines
+
+
+def line_statistics(db: Session, kind: str = 'metastatic', line_no: Optional[int] = None,
+                    drug: Optional[str] = None, institution_id: Optional[int] = None) -> list:
+    """Агрегаты по (номер линии, препарат): число линий, длительность, прогрессирование, ECOG"""
+    key = (kind, line_no, drug, institution_id)
+    return line_statistics_cache.get_or_compute(
+        key, lambda: _line_statistics(db, kind, line_no, drug, institution_id)
+    )
+
+
+def _line_statistics(db: Session, kind: str, line_no: Optional[int],
+                     drug: Optional[str], institution_id: Optional[int]) -> list:
+    duration = func.julianday(TherapyLine.end_date) - func.julianday(TherapyLine.start_date)
+    query = db.query(
+        TherapyLine.line_no,
+        TherapyLine.drug,
+        func.count(TherapyLine.id).label('lines'),
+        func.count(duration).label('completed'),
+        func.avg(duration).label('mean_duration_days'),
+        func.min(duration).label('min_duration_days'),
+        func.max(duration).label('max_duration_days'),
+        func.count(TherapyLine.progression_date).label('progressions'),
+        func.avg(TherapyLine.ecog).label('mean_ecog'),
+    ).join(ClinicalRecord, ClinicalRecord.id == TherapyLine.record_id) \
+     .join(Patient, Patient.id == ClinicalRecord.patient_id) \
+     .filter(Patient.is_active == True, TherapyLine.kind == kind)
+
+    if line_no is not None:
+        query = query.filter(TherapyLine.line_no == line_no)
+    if drug:
+        query = query.filter(TherapyLine.drug == drug)
+    if institution_id is not None:
+        query = query.filter(Patient.institution_id == institution_id)
+
+    rows = query.group_by(TherapyLine.line_no, TherapyLine.drug) \
+        .order_by(TherapyLine.line_no, func.count(TherapyLine.id).desc()).all()
+
+    # Медиана длительности завершенных линий - оконными функциями в том же SQL
+    filtered = query.with_entities(
+        TherapyLine.line_no.label('line_no'),
+        TherapyLine.drug.label('drug'),
+        duration.label('duration'),
+    ).filter(TherapyLine.start_date.isnot(None), TherapyLine.end_date.isnot(None)).subquery()
+    partition = (filtered.c.line_no, filtered.c.drug)
+    ranked = select(
+        filtered.c.line_no, filtered.c.drug, filtered.c.duration,
+        func.row_number().over(partition_by=partition, order_by=filtered.c.duration).label('position'),
+        func.count().over(partition_by=partition).label('total'),
+    ).subquery()
+    medians = {
+        (row.line_no, row.drug): row.median
+        for row in db.execute(
+            select(ranked.c.line_no, ranked.c.drug, func.avg(ranked.c.duration).label('median'))
+            .where(ranked.c.position.in_([(ranked.c.total + 1) / 2, (ranked.c.total + 2) / 2]))
+            .group_by(ranked.c.line_no, ranked.c.drug)
+        )
+    }
+
+    return [
+        {
+            "line_no": row.line_no,
+            "drug": row.drug,
+            "lines": row.lines,
+            "completed": row.completed,
+            "median_duration_days": round(medians[(row.line_no, row.drug)], 1) if (row.line_no, row.drug) in medians else None,
+            "mean_duration_days": round(row.mean_duration_days, 1) if row.mean_duration_days is not None else None,
+            "min_duration_days": round(row.min_duration_days, 1) if row.min_duration_days is not None else None,
+            "max_duration_days": round(row.max_duration_days, 1) if row.max_duration_days is not None else None,
+            "progressions": row.progressions,
+            "mean_ecog": round(row.mean_ecog, 2) if row.mean_ecog is not None else None,
+        }
+        for row in rows
+    ]
@@ -0,0 +1,98 @@
+"""
+Временные ряды активности регистра
+
+    enrollment - новые пациенты по месяцам (Patient.created_at) в разрезе учреждения
+                 и типа регистра
+    activity   - пациенты, чья запись последний раз изменялась на данной неделе
+                 (Patient.updated_at); неделя обозначается датой понедельника
+
+Ряды считаются группировкой по периоду в SQL (strftime/date SQLite), поэтому в Python
+попадают только агрегаты. Периоды без данных в ответ не входят. Результаты
+кэшируются до следующего изменения данных пациентов.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from cache import VersionedResultCache, patient_data_version, institution_names
+from models import Patient, ClinicalRecord
+
+timeseries_cache = VersionedResultCache(patient_data_version, maxsize=64)
+
+
+def month_bucket(column):
+    return func.strftime('%Y-%m', column)
+
+
+def week_bucket(column):
+    # weekday 0 - ближайшее воскресенье (или тот же день), минус 6 дней - понедельник недели
+    return func.date(column, 'weekday 0', '-6 days')
+
+
+def _scoped(query, column, date_from: Optional[datetime], date_to: Optional[datetime],
+            institution_id: Optional[int], registry_type: Optional[str]):
+    query = query.filter(Patient.is_active == True, column.isnot(None))
+    if date_from:
+        query = query.filter(column >= date_from)
+    if date_to:
+        query = query.filter(column < date_to)
+    if institution_id is not None:
+        query = query.filter(Patient.institution_id == institution_id)
+    if registry_type:
+        query = query.join(ClinicalRecord, ClinicalRecord.patient_id == Patient.id) \
+            .filter(ClinicalRecord.registry_type == registry_type)
+    return query
+
+
+def compute_timeseries(db: Session, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                       institution_id: Optional[int] = None, registry_type: Optional[str] = None) -> dict:
+    """Граница date_to не включается в интервал"""
+    key = (date_from, date_to, institution_id, registry_type)
+
+    def compute():
+        period = month_bucket(Patient.created_at).label('period')
+        enrollment = _scoped(
+            db.query(period, Patient.institution_id, ClinicalRecord.registry_type, func.count(Patient.id))
+            .outerjoin(ClinicalRecord, ClinicalRecord.patient_id == Patient.id),
+            Patient.created_at, date_from, date_to, institution_id, None,
+        )
+        if registry_type:
+            enrollment = enrollment.filter(ClinicalRecord.registry_type == registry_type)
+        enrollment = enrollment.group_by(period, Patient.institution_id, ClinicalRecord.registry_type) \
+            .order_by(period, Patient.institution_id, ClinicalRecord.registry_type)
+
+        week = week_bucket(Patient.updated_at).label('period')
+        activity = _scoped(
+            db.query(week, func.count(Patient.id)),
+            Patient.updated_at, date_from, date_to, institution_id, registry_type,
+        ).group_by(week).order_by(week)
+
+        return {
+            "filters": {
+                "date_from": date_from,
+                "date_to": date_to,
+                "institution_id": institution_id,
+                "registry_type": registry_type,
+            },
+            "enrollment": {
+                "interval": "month",
+                "points": [
+                    {
+                        "period": month,
+                        "institution_id": inst_id,
+                        "institution_name": institution_names.get(db, inst_id),
+                        "registry_type": registry,
+                        "patients": count,
+                    }
+                    for month, inst_id, registry, count in enrollment
+                ],
+            },
+            "activity": {
+                "interval": "week",
+                "points": [{"period": monday, "records_updated": count} for monday, count in activity],
+            },
+        }
+
+    return timeseries_cache.get_or_compute(key, compute)
@@ -0,0 +1,33 @@
+"""
+Нагрузочные бенчмарки регистра на синтетических данных
+
+Использование (из корня репозитория):
+
+    python -m benchmarks --size 1k
+    python -m benchmarks --size 100k --repeat 10 --scenarios list_patients get_patient
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+
+База генерируется детерминированно (размер + seed) в benchmarks/data/ и
+переиспользуется между запусками. Результаты сохраняются в benchmarks/results/.
+"""
+import os
+import sys
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCHMARKS_DIR.parent / "backend"
+DATA_DIR = BENCHMARKS_DIR / "data"
+RESULTS_DIR = BENCHMARKS_DIR / "results"
+
+SIZES = {
+    "1k": 1_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+
+
+def bootstrap(db_path: Path):
+    """Направляет backend на файл бенчмарка. Вызывать до импорта database/main."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{Path(db_path).resolve()}"
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
@@ -0,0 +1,94 @@
+"""
+CLI бенчмарков: python -m benchmarks --help
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import SIZES, DATA_DIR, RESULTS_DIR, BENCHMARKS_DIR, bootstrap
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Бенчмарки регистра на синтетических данных")
+    parser.add_argument("--size", choices=sorted(SIZES), default="1k", help="Размер синтетического регистра")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=20, help="Число замеров на сценарий")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--scenarios", nargs="*", help="Подмножество сценариев (по умолчанию все)")
+    parser.add_argument("--db", help="Путь к файлу SQLite (по умолчанию benchmarks/data/registry_<size>_s<seed>.db)")
+    parser.add_argument("--regenerate", action="store_true", help="Пересоздать базу даже если файл существует")
+    parser.add_argument("--generate-only", action="store_true")
+    parser.add_argument("--output", help="Файл результатов JSON (по умолчанию benchmarks/results/<время>_<коммит>_<size>.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    size = SIZES[args.size]
+    db_path = Path(args.db) if args.db else DATA_DIR / f"registry_{args.size}_s{args.seed}.db"
+
+    if args.regenerate and db_path.exists():
+        db_path.unlink()
+    bootstrap(db_path)
+
+    if not db_path.exists():
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Generating {args.size} registry into {db_path}...")
+        from database import engine
+        from benchmarks.generator import generate
+        started = time.perf_counter()
+        generate(engine, size, args.seed)
+        print(f"✓ Generated in {time.perf_counter() - started:.1f}s")
+    if args.generate_only:
+        return 0
+
+    from benchmarks import scenarios
+    names = args.scenarios or list(scenarios.SCENARIOS)
+    unknown = [n for n in names if n not in scenarios.SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    print(f"Running {len(names)} scenarios on {args.size} registry...")
+    results = scenarios.run(names, repeat=args.repeat, warmup=args.warmup, seed=args.seed)
+
+    import sqlalchemy
+    revision = git_revision()
+    report = {
+        "meta": {
+            "revision": revision,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "size": args.size,
+            "patients": size,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+        },
+        "scenarios": results,
+    }
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{datetime.now():%Y%m%d_%H%M%S}_{revision}_{args.size}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"✓ Results saved to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
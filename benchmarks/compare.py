@@ -0,0 +1,59 @@
+"""
+Сравнение двух файлов результатов бенчмарков
+
+    python -m benchmarks.compare base.json new.json [--metric median_ms] [--threshold 0.15]
+
+Код возврата 1, если хотя бы один сценарий замедлился больше порога.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(base, new, metric="median_ms", threshold=0.15):
+    rows, regressions = [], []
+    for name in sorted(set(base["scenarios"]) | set(new["scenarios"])):
+        old_value = base["scenarios"].get(name, {}).get(metric)
+        new_value = new["scenarios"].get(name, {}).get(metric)
+        if old_value is None or new_value is None:
+            rows.append((name, old_value, new_value, None))
+            continue
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        rows.append((name, old_value, new_value, change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--metric", default="median_ms", choices=["min_ms", "median_ms", "mean_ms", "p95_ms", "max_ms"])
+    parser.add_argument("--threshold", type=float, default=0.15, help="Допустимое относительное замедление")
+    args = parser.parse_args(argv)
+
+    base, new = load(args.base), load(args.new)
+    if base["meta"].get("size") != new["meta"].get("size"):
+        print(f"⚠️  Different dataset sizes: {base['meta'].get('size')} vs {new['meta'].get('size')}")
+
+    rows, regressions = compare(base, new, args.metric, args.threshold)
+    print(f"{'scenario':<40} {base['meta'].get('revision', 'base'):>12} {new['meta'].get('revision', 'new'):>12} {'change':>9}")
+    for name, old_value, new_value, change in rows:
+        change_str = f"{change:+.1%}" if change is not None else "n/a"
+        marker = " ✗" if name in regressions else ""
+        print(f"{name:<40} {old_value if old_value is not None else '-':>12} {new_value if new_value is not None else '-':>12} {change_str:>9}{marker}")
+
+    if regressions:
+        print(f"\n✗ Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+Детерминированный генератор синтетического регистра
+
+Создает учреждения, пользователей и пациентов ALK/ROS1 с реалистичной
+заполненностью полей и JSON-линиями терапии. Одинаковые size и seed дают
+одинаковые синтетические данные.
+"""
+import random
+from datetime import datetime, timedelta
+
+import bcrypt
+
+import code_index
+import therapy_lines
+from models import Institution, User, Patient, ClinicalRecord, RECORD_CLASSES
+
+BASE_DATE = datetime(2015, 1, 1)
+CHUNK_SIZE = 5000
+
+# Доля ROS1 среди пациентов
+ROS1_SHARE = 0.25
+
+COMORBIDITIES = ["CV_HYPERTENSION", "DIABETES", "HYPERLIPIDEMIA", "CV_ATHEROSCLEROSIS", "CEREBROVASCULAR", "OTHER"]
+METASTASES_SITES = ["BONES", "LIVER", "LUNG", "PLEURA", "CNS", "OTHER"]
+PROGRESSION_SITES = ["CNS", "BONES", "LIVER", "LUNG", "PLEURA", "LYMPH_NODE", "ADRENAL", "OTHER"]
+ALK_METHODS = ["IHC", "FISH", "PCR", "NGS"]
+NEXT_LINE_TREATMENTS = ["CRIZOTINIB", "CERITINIB", "LORLATINIB", "CHEMOTHERAPY", "IMMUNOTHERAPY", "OTHER"]
+TNM_STAGES = [
+    f"{t}{n}{m}"
+    for m in ["M0", "M1a", "M1b", "M1c"]
+    for n in ["N0", "N1", "N2", "N3"]
+    for t in ["T1a", "T1b", "T1c", "T2a", "T2b", "T3", "T4"]
+]
+RESPONSES = ["CR", "PR", "SD", "PD"]
+TARGETED_DRUGS = ["CRIZOTINIB", "ENTRECTINIB", "REPOTRECTINIB", "LORLATINIB"]
+CHEMO_DRUGS = ["CARBOPLATIN", "CISPLATIN", "PEMETREXED", "PACLITAXEL"]
+
+
+def institution_count(size: int) -> int:
+    return min(200, max(5, size // 5000))
+
+
+class RegistryGenerator:
+    def __init__(self, size: int, seed: int = 42):
+        self.size = size
+        self.rng = random.Random(seed)
+
+    # --- Примитивы ---
+
+    def maybe(self, probability, value_fn):
+        return value_fn() if self.rng.random() < probability else None
+
+    def date_between(self, start: datetime, max_days: int) -> datetime:
+        return start + timedelta(days=self.rng.randint(0, max_days))
+
+    def pick_many(self, choices, max_count=3):
+        return sorted(self.rng.sample(choices, self.rng.randint(1, max_count)))
+
+    # --- Сущности ---
+
+    def institutions(self):
+        return [
+            {
+                "id": i,
+                "name": f"Учреждение {i:03d}",
+                "code": f"INST{i:03d}",
+                "city": self.rng.choice(["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург"]),
+                "is_active": True,
+                "created_at": BASE_DATE,
+                "updated_at": BASE_DATE,
+            }
+            for i in range(2, institution_count(self.size) + 2)
+        ]
+
+    def users(self, institution_ids, password_hash):
+        rows = []
+        for inst_id in institution_ids:
+            for n in range(3):
+                rows.append({
+                    "username": f"user_{inst_id}_{n}",
+                    "password_hash": password_hash,
+                    "role": "user",
+                    "institution_id": inst_id,
+                    "is_active": True,
+                    "created_at": BASE_DATE,
+                })
+        return rows
+
+    def therapy_line(self, line_number, start):
+        targeted = self.rng.random() < 0.7
+        end = self.maybe(0.6, lambda: self.date_between(start, 900))
+        progression = self.maybe(0.4, lambda: self.date_between(start, 900))
+        return {
+            "line_number": line_number,
+            "therapy": {
+                "therapy_class": "TARGETED" if targeted else "CHEMOTHERAPY",
+                "regimen_code": "MONOTHERAPY" if targeted else "PLATINUM_DOUBLET",
+                "custom_drugs": [self.rng.choice(TARGETED_DRUGS)] if targeted else self.rng.sample(CHEMO_DRUGS, 2),
+            },
+            "ecog_status": str(self.rng.randint(0, 3)) if self.rng.random() < 0.85 else "",
+            "start_date": start.strftime("%Y-%m-%d"),
+            "end_date": end.strftime("%Y-%m-%d") if end else "",
+            "response": self.rng.choice(RESPONSES) if self.rng.random() < 0.8 else "",
+            "stop_reason": "",
+            "progression_date": progression.strftime("%Y-%m-%d") if progression else "",
+            "progression_type": self.rng.choice(["OLIGO", "SYSTEMIC"]) if progression else "",
+            "progression_sites": self.pick_many(PROGRESSION_SITES, 2) if progression else [],
+            "progression_sites_other": "",
+            "local_treatment_at_progression": "",
+            "local_treatment_response": "",
+        }
+
+    def common_fields(self, patient_code):
+        rng = self.rng
+        birth = self.date_between(datetime(1940, 1, 1), 365 * 50)
+        diagnosis = self.date_between(max(BASE_DATE, birth + timedelta(days=365 * 25)), 365 * 9)
+        comorbidities = self.maybe(0.7, lambda: self.pick_many(COMORBIDITIES))
+        status = rng.choices(["ALIVE", "DEAD", "LOST_TO_FOLLOWUP"], [0.65, 0.25, 0.1])[0]
+        age = diagnosis.year - birth.year - ((diagnosis.month, diagnosis.day) < (birth.month, birth.day))
+        return birth, diagnosis, {
+            "patient_code": patient_code,
+            "date_filled": diagnosis + timedelta(days=30),
+            "gender": rng.choice(["м", "ж"]) if rng.random() < 0.97 else None,
+            "birth_date": birth if rng.random() < 0.95 else None,
+            "height": self.maybe(0.8, lambda: float(rng.randint(150, 195))),
+            "weight": self.maybe(0.8, lambda: float(rng.randint(45, 110))),
+            "comorbidities": comorbidities,
+            "comorbidities_other_text": "Хронический гастрит" if comorbidities and "OTHER" in comorbidities else None,
+            "smoking_status": self.maybe(0.75, lambda: rng.choice(["SMOKER_15", "NON_SMOKER_15"])),
+            "initial_diagnosis_date": diagnosis,
+            "tnm_stage": self.maybe(0.9, lambda: rng.choice(TNM_STAGES)),
+            "histology": self.maybe(0.95, lambda: rng.choices(["ADENOCARCINOMA", "SQUAMOUS_CELL", "DIMORPHIC"], [0.9, 0.05, 0.05])[0]),
+            "tp53_comutation": self.maybe(0.5, lambda: rng.choice(["YES", "NO", "UNKNOWN"])),
+            "ttf1_expression": self.maybe(0.5, lambda: rng.choice(["YES", "NO", "UNKNOWN"])),
+            "current_status": self.maybe(0.9, lambda: status),
+            "last_contact_date": self.maybe(0.85, lambda: self.date_between(diagnosis, 365 * 5)),
+            "age_at_diagnosis": age,
+        }
+
+    def alk_fields(self, diagnosis):
+        rng = self.rng
+        start = self.date_between(diagnosis, 120)
+        stopped = rng.random() < 0.45
+        progressed = rng.random() < 0.4
+        cns = self.maybe(0.85, lambda: rng.random() < 0.3)
+        end = self.date_between(start, 365 * 4) if stopped else None
+        fields = {
+            "alk_diagnosis_date": self.maybe(0.9, lambda: self.date_between(diagnosis, 60)),
+            "alk_methods": self.maybe(0.9, lambda: self.pick_many(ALK_METHODS, 2)),
+            "alk_fusion_variant": self.maybe(0.6, lambda: rng.choice(["V1", "V2", "V3", "UNKNOWN"])),
+            "had_previous_therapy": self.maybe(0.9, lambda: rng.random() < 0.2),
+            "alectinib_start_date": start,
+            "stage_at_alectinib_start": self.maybe(0.9, lambda: rng.choice(["LOCALLY_ADVANCED", "METASTATIC"])),
+            "ecog_at_start": self.maybe(0.85, lambda: rng.randint(0, 3)),
+            "metastases_sites": self.maybe(0.8, lambda: self.pick_many(METASTASES_SITES)),
+            "cns_metastases": cns,
+            "alectinib_therapy_status": "STOPPED" if stopped else "ONGOING",
+            "maximum_response": self.maybe(0.8, lambda: rng.choice(RESPONSES)),
+            "earliest_response_date": self.maybe(0.6, lambda: self.date_between(start, 180)),
+            "progression_during_alectinib": rng.choice(["OLIGO", "SYSTEMIC"]) if progressed else "NONE",
+            "alectinib_end_date": end,
+        }
+        if cns:
+            fields.update({
+                "cns_measurable": self.maybe(0.8, lambda: rng.choice(["MEASURABLE", "NON_MEASURABLE"])),
+                "cns_symptomatic": self.maybe(0.8, lambda: rng.choice(["SYMPTOMATIC", "ASYMPTOMATIC"])),
+                "cns_radiotherapy": self.maybe(0.8, lambda: rng.choice(["DONE", "NOT_DONE"])),
+                "intracranial_response": self.maybe(0.6, lambda: rng.choice(RESPONSES)),
+            })
+        if progressed:
+            fields.update({
+                "progression_date": self.date_between(start, 365 * 3),
+                "progression_sites": self.maybe(0.8, lambda: self.pick_many(PROGRESSION_SITES, 2)),
+                "local_treatment_at_progression": self.maybe(0.7, lambda: rng.choice(["RADIOTHERAPY", "SURGERY", "NONE"])),
+                "continued_after_progression": self.maybe(0.8, lambda: rng.random() < 0.5),
+            })
+        if stopped:
+            next_line = self.maybe(0.6, lambda: self.pick_many(NEXT_LINE_TREATMENTS, 1))
+            fields.update({
+                "alectinib_stop_reason": self.maybe(0.9, lambda: rng.choice(["INTOLERANCE", "LOSS_OF_BENEFIT", "PATIENT_REFUSAL"])),
+                "had_treatment_interruption": self.maybe(0.8, lambda: rng.random() < 0.15),
+                "had_dose_reduction": self.maybe(0.8, lambda: rng.random() < 0.2),
+                "next_line_treatments": next_line,
+                "next_line_start_date": end + timedelta(days=rng.randint(7, 60)) if next_line else None,
+            })
+        return fields
+
+    def ros1_fields(self, diagnosis):
+        rng = self.rng
+        radical = self.maybe(0.9, lambda: rng.random() < 0.35)
+        pdl1 = self.maybe(0.8, lambda: rng.choice(["TPS_LESS_1", "TPS_1_49", "TPS_MORE_50", "NOT_DONE"]))
+        metastatic_date = self.date_between(diagnosis, 365 * 2)
+        fields = {
+            "ros1_fusion_variant": self.maybe(0.7, lambda: rng.choice(["CD74", "EZR", "SDC4", "SLC34A2", "UNKNOWN"])),
+            "pdl1_status": pdl1,
+            "pdl1_tps": float(rng.randint(0, 100)) if pdl1 and pdl1 != "NOT_DONE" and rng.random() < 0.8 else None,
+            "radical_treatment_conducted": radical,
+            "metastatic_diagnosis_date": self.maybe(0.85, lambda: metastatic_date),
+        }
+        if radical:
+            surgery = rng.random() < 0.6
+            fields.update({
+                "radical_surgery_conducted": surgery,
+                "radical_surgery_date": self.date_between(diagnosis, 60) if surgery else None,
+                "radical_surgery_type": rng.choice(["LOBECTOMY_LN", "PNEUMONECTOMY_LN", "ATYPICAL_RESECTION"]) if surgery else None,
+                "radical_crt_conducted": not surgery,
+                "radical_perioperative_therapy": [
+                    {
+                        "type": rng.choice(["NEOADJUVANT", "ADJUVANT"]),
+                        "therapy": {"therapy_class": "CHEMOTHERAPY", "regimen_code": "PLATINUM_DOUBLET", "custom_drugs": rng.sample(CHEMO_DRUGS, 2)},
+                        "start_date": self.date_between(diagnosis, 90).strftime("%Y-%m-%d"),
+                        "end_date": self.date_between(diagnosis + timedelta(days=90), 120).strftime("%Y-%m-%d"),
+                    }
+                ] if rng.random() < 0.5 else [],
+                "radical_treatment_outcome": self.maybe(0.8, lambda: rng.choice(["REMISSION", "RELAPSE", "UNKNOWN"])),
+            })
+        lines = []
+        line_start = metastatic_date
+        for n in range(1, rng.choices([1, 2, 3, 4], [0.5, 0.3, 0.15, 0.05])[0] + 1):
+            line_start = self.date_between(line_start, 300)
+            lines.append(self.therapy_line(n, line_start))
+        fields["metastatic_therapy_lines"] = lines
+        return fields
+
+    def patients(self, institution_ids, users_by_institution):
+        """Порождает пары (patient, clinical_record) чанками по CHUNK_SIZE."""
+        rng = self.rng
+        patients, records = [], []
+        for patient_id in range(1, self.size + 1):
+            inst_id = rng.choice(institution_ids)
+            registry_type = "ROS1" if rng.random() < ROS1_SHARE else "ALK"
+            created = self.date_between(BASE_DATE, 365 * 10)
+            updated = created + timedelta(seconds=rng.randint(0, 86400 * 365))
+            patients.append({
+                "id": patient_id,
+                "institution_id": inst_id,
+                "created_by": rng.choice(users_by_institution[inst_id]),
+                "is_active": rng.random() > 0.01,
+                "created_at": created,
+                "updated_at": updated,
+            })
+
+            birth, diagnosis, record = self.common_fields(f"{registry_type}-{inst_id:03d}-{patient_id:07d}")
+            record.update(self.alk_fields(diagnosis) if registry_type == "ALK" else self.ros1_fields(diagnosis))
+            record.update({"id": patient_id, "patient_id": patient_id, "registry_type": registry_type})
+            records.append(record)
+
+            if len(patients) == CHUNK_SIZE:
+                yield patients, records
+                patients, records = [], []
+        if patients:
+            yield patients, records
+
+
+def normalize_rows(rows, columns):
+    """executemany требует одинакового набора ключей во всех строках"""
+    return [{col: row.get(col) for col in columns} for row in rows]
+
+
+def generate(engine, size: int, seed: int = 42, progress=print):
+    """Заполняет пустую БД: справочники и админ через init_db, затем синтетические данные."""
+    from init_db import init_database
+
+    init_database()
+    generator = RegistryGenerator(size, seed)
+    # Один дешевый хеш на всех синтетических пользователей вместо bcrypt на каждого
+    password_hash = bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4)).decode("utf-8")
+
+    institutions = generator.institutions()
+    institution_ids = [row["id"] for row in institutions]
+    users = generator.users(institution_ids, password_hash)
+
+    # Общая часть записи и таблица расширения ее регистра
+    record_tables = [(ClinicalRecord.__table__, None)] + [
+        (record_class.__table__, registry_type) for registry_type, record_class in RECORD_CLASSES.items()
+    ]
+    with engine.begin() as conn:
+        conn.execute(Institution.__table__.insert(), institutions)
+        conn.execute(User.__table__.insert(), users)
+        user_rows = conn.execute(User.__table__.select().where(User.role == "user")).mappings().all()
+
+    users_by_institution = {}
+    for row in user_rows:
+        users_by_institution.setdefault(row["institution_id"], []).append(row["id"])
+
+    inserted = 0
+    for patients, records in generator.patients(institution_ids, users_by_institution):
+        with engine.begin() as conn:
+            conn.execute(Patient.__table__.insert(), patients)
+            for record_table, registry_type in record_tables:
+                rows = [row for row in records if registry_type in (None, row["registry_type"])]
+                if rows:
+                    conn.execute(record_table.insert(), normalize_rows(rows, record_table.columns.keys()))
+        inserted += len(patients)
+        progress(f"  generated {inserted}/{size} patients")
+
+    # Записи вставлены в обход ORM: индекс кодов мультивыборов и линии терапии строятся отдельно
+    with engine.begin() as conn:
+        code_index.rebuild(conn)
+        therapy_lines.rebuild(conn)
+
+    return {"institutions": len(institutions) + 1, "users": len(users) + 1, "patients": size}
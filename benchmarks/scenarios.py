@@ -0,0 +1,204 @@
+"""
+Сценарии бенчмарков: вызовы обработчиков FastAPI напрямую, без HTTP-слоя
+
+Каждый сценарий получает свежую сессию, как при обычном запросе через get_db.
+"""
+import asyncio
+import inspect
+import random
+import statistics
+import time
+
+from fastapi import Request, Response
+from fastapi.params import Depends
+from pydantic.fields import FieldInfo
+from pydantic_core import PydanticUndefined
+
+import main
+from database import SessionLocal
+from models import User, Patient, ClinicalRecord, load_record_extension
+
+
+def make_request(headers=None) -> Request:
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw_headers, "query_string": b""})
+
+
+def invoke(endpoint, **kwargs):
+    """Вызывает обработчик, подставляя значения по умолчанию для Query-параметров."""
+    for name, param in inspect.signature(endpoint).parameters.items():
+        if name in kwargs:
+            continue
+        if param.annotation is Request:
+            kwargs[name] = make_request()
+        elif param.annotation is Response:
+            kwargs[name] = Response()
+        elif isinstance(param.default, Depends):
+            raise TypeError(f"{endpoint.__name__}: dependency '{name}' must be passed explicitly")
+        elif isinstance(param.default, FieldInfo):
+            default = param.default.default
+            kwargs[name] = None if default is PydanticUndefined else default
+        elif param.default is not inspect.Parameter.empty:
+            kwargs[name] = param.default
+    return endpoint(**kwargs)
+
+
+def drain(response) -> int:
+    """Вычитывает тело StreamingResponse, чтобы учесть время генерации файла."""
+    async def consume():
+        size = 0
+        async for chunk in response.body_iterator:
+            size += len(chunk)
+        return size
+    return asyncio.run(consume())
+
+
+class Context:
+    def __init__(self, seed: int = 42):
+        self.rng = random.Random(seed)
+        db = SessionLocal()
+        try:
+            self.admin_id = db.query(User.id).filter(User.role == "admin").order_by(User.id).first()[0]
+            self.user_id = db.query(User.id).filter(User.role == "user").order_by(User.id).first()[0]
+            self.patient_ids = [
+                row[0] for row in db.query(Patient.id).filter(Patient.is_active == True).order_by(Patient.id).limit(10000)
+            ]
+            self.ros1_ids = [
+                row[0] for row in db.query(ClinicalRecord.patient_id)
+                .filter(ClinicalRecord.registry_type == "ROS1").order_by(ClinicalRecord.patient_id).limit(1000)
+            ]
+        finally:
+            db.close()
+
+    def user(self, db, admin=True) -> User:
+        return db.get(User, self.admin_id if admin else self.user_id)
+
+    def random_patient(self) -> int:
+        return self.rng.choice(self.patient_ids)
+
+
+def with_session(fn):
+    def run(ctx):
+        db = SessionLocal()
+        try:
+            return fn(ctx, db)
+        finally:
+            db.close()
+    return run
+
+
+@with_session
+def list_patients(ctx, db):
+    invoke(main.list_patients, db=db, current_user=ctx.user(db))
+
+
+@with_session
+def list_patients_institution(ctx, db):
+    invoke(main.list_patients, db=db, current_user=ctx.user(db, admin=False))
+
+
+@with_session
+def list_patients_search(ctx, db):
+    invoke(main.list_patients, patient_code="ALK-00", db=db, current_user=ctx.user(db))
+
+
+@with_session
+def get_patient(ctx, db):
+    invoke(main.get_patient, patient_id=ctx.random_patient(), db=db, current_user=ctx.user(db))
+
+
+@with_session
+def auto_save_patient(ctx, db):
+    invoke(
+        main.auto_save_patient,
+        patient_id=ctx.random_patient(),
+        field_updates={"weight": float(ctx.rng.randint(45, 110)), "last_contact_date": "2024-06-01"},
+        db=db,
+        current_user=ctx.user(db),
+    )
+
+
+@with_session
+def export_standard(ctx, db):
+    drain(invoke(main.export_patients_excel, mode="standard", db=db, current_user=ctx.user(db)))
+
+
+@with_session
+def export_full(ctx, db):
+    drain(invoke(main.export_patients_excel, mode="full", db=db, current_user=ctx.user(db)))
+
+
+@with_session
+def get_analytics(ctx, db):
+    invoke(main.get_analytics, db=db, current_user=ctx.user(db))
+
+
+@with_session
+def get_analytics_ros1(ctx, db):
+    invoke(main.get_analytics, registry_type="ROS1", db=db, current_user=ctx.user(db))
+
+
+class CompletionScenario:
+    """Чистый CPU: расчет заполненности по заранее загруженным записям."""
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.records = None
+
+    def __call__(self, ctx):
+        if self.records is None:
+            db = SessionLocal()
+            try:
+                # Строки расширений загружаются до отсоединения: расчет читает поля регистра
+                self.records = db.query(ClinicalRecord).options(load_record_extension()) \
+                    .order_by(ClinicalRecord.id).limit(self.batch_size).all()
+                db.expunge_all()
+            finally:
+                db.close()
+        for record in self.records:
+            main.calculate_completion_percentage(record)
+
+
+# name -> (callable, доля от --repeat: тяжелые сценарии повторяются реже)
+SCENARIOS = {
+    "list_patients": (list_patients, 1.0),
+    "list_patients_institution": (list_patients_institution, 1.0),
+    "list_patients_search": (list_patients_search, 1.0),
+    "get_patient": (get_patient, 1.0),
+    "auto_save_patient": (auto_save_patient, 1.0),
+    "export_standard": (export_standard, 0.1),
+    "export_full": (export_full, 0.1),
+    "get_analytics": (get_analytics, 0.2),
+    "get_analytics_ros1": (get_analytics_ros1, 0.2),
+    "calculate_completion_percentage_x1000": (CompletionScenario(), 1.0),
+}
+
+
+def summarize(timings_ms):
+    ordered = sorted(timings_ms)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    return {
+        "n": len(ordered),
+        "min_ms": round(ordered[0], 3),
+        "median_ms": round(statistics.median(ordered), 3),
+        "mean_ms": round(statistics.fmean(ordered), 3),
+        "p95_ms": round(ordered[p95_index], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def run(names, repeat=20, warmup=1, seed=42, progress=print):
+    ctx = Context(seed)
+    results = {}
+    for name in names:
+        fn, share = SCENARIOS[name]
+        for _ in range(warmup):
+            fn(ctx)
+        timings = []
+        for _ in range(max(1, int(repeat * share))):
+            start = time.perf_counter()
+            fn(ctx)
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = summarize(timings)
+        progress(f"  {name}: median {results[name]['median_ms']} ms, p95 {results[name]['p95_ms']} ms")
+    return results
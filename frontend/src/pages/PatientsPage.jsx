@@ -1,6 +1,7 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { Link, useNavigate } from 'react-router-dom'
 import { patientService } from '../services/patientService'
+import { eventsService } from '../services/eventsService'
 import { useRegistry } from '../contexts/RegistryContext'
 import './PatientsPage.css'
 
@@ -28,6 +29,27 @@ function PatientsPage({ user }) {
     loadInstitutions()
   }, [])
 
+  // Список перечитывается по событиям ленты изменений вместо периодического опроса
+  const reloadRef = useRef(null)
+  reloadRef.current = () => loadPatients({}, { silent: true })
+
+  useEffect(() => {
+    let timer = null
+    const scheduleReload = () => {
+      // Серия автосохранений дает одно перечитывание
+      clearTimeout(timer)
+      timer = setTimeout(() => reloadRef.current(), 1000)
+    }
+    const unsubscribe = eventsService.subscribe({
+      patient: scheduleReload,
+      resync: scheduleReload,
+    })
+    return () => {
+      clearTimeout(timer)
+      unsubscribe()
+    }
+  }, [])
+
   useEffect(() => {
     if (registryType) {
       setSearchFilters(prev => ({ ...prev, registry_type: registryType }))
@@ -51,9 +73,9 @@ function PatientsPage({ user }) {
     }
   }
 
-  const loadPatients = async (filters = {}) => {
+  const loadPatients = async (filters = {}, { silent = false } = {}) => {
     try {
-      setLoading(true)
+      if (!silent) setLoading(true)
       const activeFilters = { ...searchFilters, ...filters, registry_type: registryType }
       const params = new URLSearchParams()
       Object.entries(activeFilters).forEach(([key, value]) => {
@@ -47,6 +47,17 @@ export const dictionaryService = {
     return results
   },
 
+  /**
+   * Поиск по справочнику на сервере (префикс, затем подстрока)
+   * @param {string} category - Категория справочника
+   * @param {string} query - Строка поиска
+   * @param {number} limit - Максимальное число результатов
+   */
+  async searchDictionary(category, query, limit = 20) {
+    const response = await api.get(`/dictionaries/${category}/search`, { params: { q: query, limit } })
+    return response.data
+  },
+
   async getCategories() {
     const response = await api.get('/dictionaries/categories')
     return response.data
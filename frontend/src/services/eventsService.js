@@ -0,0 +1,69 @@
+import api from './api'
+
+const RECONNECT_DELAY_MS = 3000
+
+// Лента изменений GET /api/events. EventSource не умеет передавать заголовок
+// Authorization, поэтому перед каждым подключением запрашивается короткоживущий билет.
+export const eventsService = {
+  async getTicket() {
+    const response = await api.post('/events/ticket')
+    return response.data.ticket
+  },
+
+  // handlers: { patient, dictionary, resync } - обработчики событий по типу.
+  // Возвращает функцию отписки.
+  subscribe(handlers = {}) {
+    let source = null
+    let timer = null
+    let closed = false
+    let lastEventId = null
+
+    const scheduleReconnect = () => {
+      if (closed || timer) return
+      timer = setTimeout(() => {
+        timer = null
+        connect()
+      }, RECONNECT_DELAY_MS)
+    }
+
+    const connect = async () => {
+      let ticket
+      try {
+        ticket = await this.getTicket()
+      } catch (error) {
+        console.error('Events ticket error:', error)
+        scheduleReconnect()
+        return
+      }
+      if (closed) return
+
+      const params = new URLSearchParams({ ticket })
+      // Новый EventSource не передает Last-Event-ID сам: пропущенные события запрашиваются параметром
+      if (lastEventId) params.append('last_event_id', lastEventId)
+      source = new EventSource(`/api/events?${params.toString()}`)
+
+      Object.entries(handlers).forEach(([kind, handler]) => {
+        source.addEventListener(kind, (event) => {
+          if (event.lastEventId) lastEventId = event.lastEventId
+          handler(event.data ? JSON.parse(event.data) : null)
+        })
+      })
+
+      source.onerror = () => {
+        // Обрыв с тем же билетом браузер переподключает сам; после отказа (билет истек) - новый билет
+        if (source.readyState === EventSource.CLOSED) {
+          source = null
+          scheduleReconnect()
+        }
+      }
+    }
+
+    connect()
+
+    return () => {
+      closed = true
+      clearTimeout(timer)
+      if (source) source.close()
+    }
+  },
+}
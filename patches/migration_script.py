@@ -9,7 +9,6 @@
 """
 
 from sqlalchemy import text, inspect
-from datetime import datetime
 
 
 def column_exists(session, table_name, column_name):
@@ -78,59 +77,28 @@ def migrate_tnm_stages(session):
         "TisNxM1c", "T1a(mi)NxM1c", "T1aNxM1c", "T1bNxM1c", "T1cNxM1c", "T2aNxM1c", "T2bNxM1c", "T3NxM1c", "T4NxM1c", "TxNxM1c"
     ]
     
+    from seed import seed_dictionaries
+
     print(f"📊 Миграция TNM стадий: обработка {len(new_tnm_stages)} вариантов...")
-    
-    # Получить существующие TNM записи
-    result = session.execute(text(
-        "SELECT id, code FROM dictionaries WHERE category = 'tnm_stage'"
-    ))
-    existing_tnm = {row[1]: row[0] for row in result}
-    
-    # Деактивировать старые записи, которых нет в новом списке
-    deactivated_count = 0
-    for code, dict_id in existing_tnm.items():
-        if code not in new_tnm_stages:
-            session.execute(text(
-                "UPDATE dictionaries SET is_active = 0 WHERE id = :id"
-            ), {"id": dict_id})
-            deactivated_count += 1
-    
-    print(f"⚠️  Деактивировано старых записей: {deactivated_count}")
-    
-    # Добавить новые записи
-    added_count = 0
-    updated_count = 0
-    
-    for idx, tnm_code in enumerate(new_tnm_stages, start=1):
-        if tnm_code in existing_tnm:
-            # Обновить существующую запись
-            session.execute(text(
-                """UPDATE dictionaries 
-                   SET is_active = 1, sort_order = :sort_order 
-                   WHERE category = 'tnm_stage' AND code = :code"""
-            ), {"code": tnm_code, "sort_order": idx})
-            updated_count += 1
-        else:
-            # Добавить новую запись
-            session.execute(text(
-                """INSERT INTO dictionaries (category, code, value_ru, is_active, sort_order, created_at)
-                   VALUES (:category, :code, :value_ru, 1, :sort_order, :created_at)"""
-            ), {
-                "category": "tnm_stage",
-                "code": tnm_code,
-                "value_ru": tnm_code,
-                "sort_order": idx,
-                "created_at": datetime.utcnow()
-            })
-            added_count += 1
-    
+
+    # Список полный: коды не из списка деактивируются, перечисленные - активируются.
+    # Недостающие коды добавляются, названия и порядок существующих (правки администратора) не меняются
+    result = seed_dictionaries(session, "migration.tnm_stage", [{
+        "category": "tnm_stage",
+        "items": [(tnm_code, tnm_code, idx) for idx, tnm_code in enumerate(new_tnm_stages, start=1)],
+    }], sync_active=True, insert_only=True)
     session.commit()
-    print(f"✅ TNM стадии: добавлено {added_count}, обновлено {updated_count}, деактивировано {deactivated_count}")
+
+    if result is None:
+        print("✅ TNM стадии уже мигрированы (контрольная сумма совпадает)")
+    else:
+        print(f"✅ TNM стадии: добавлено {result.inserted}, активировано {result.updated}, деактивировано {result.deactivated}")
 
 
 def add_progression_dictionaries(session):
     """Добавление новых справочников для прогрессирования"""
-    
+    from seed import seed_dictionaries
+
     # Справочник progression_sites
     progression_sites = [
         ('CNS', 'ЦНС', 1),
@@ -142,64 +110,35 @@ def add_progression_dictionaries(session):
         ('ADRENAL', 'Надпочечник', 7),
         ('OTHER', 'Другое', 8),
     ]
-    
-    added_count = 0
-    for code, value_ru, sort_order in progression_sites:
-        # Проверить существование
-        result = session.execute(text(
-            "SELECT id FROM dictionaries WHERE category = 'progression_sites' AND code = :code"
-        ), {"code": code})
-        
-        if result.fetchone() is None:
-            session.execute(text(
-                """INSERT INTO dictionaries (category, code, value_ru, is_active, sort_order, created_at)
-                   VALUES (:category, :code, :value_ru, 1, :sort_order, :created_at)"""
-            ), {
-                "category": "progression_sites",
-                "code": code,
-                "value_ru": value_ru,
-                "sort_order": sort_order,
-                "created_at": datetime.utcnow()
-            })
-            added_count += 1
-    
-    print(f"✅ Справочник progression_sites: добавлено {added_count} записей")
-    
+
     # Справочник alectinib_progression_type
     progression_types = [
         ('OLIGO', 'Олигопрогрессирование', 1),
         ('SYSTEMIC', 'Системное', 2),
         ('NONE', 'Нет', 3),
     ]
-    
-    added_count = 0
-    for code, value_ru, sort_order in progression_types:
-        # Проверить существование
-        result = session.execute(text(
-            "SELECT id FROM dictionaries WHERE category = 'alectinib_progression_type' AND code = :code"
-        ), {"code": code})
-        
-        if result.fetchone() is None:
-            session.execute(text(
-                """INSERT INTO dictionaries (category, code, value_ru, is_active, sort_order, created_at)
-                   VALUES (:category, :code, :value_ru, 1, :sort_order, :created_at)"""
-            ), {
-                "category": "alectinib_progression_type",
-                "code": code,
-                "value_ru": value_ru,
-                "sort_order": sort_order,
-                "created_at": datetime.utcnow()
-            })
-            added_count += 1
-    
-    print(f"✅ Справочник alectinib_progression_type: добавлено {added_count} записей")
-    
+
+    # Добавляются только недостающие коды: названия и порядок существующих записей
+    # могли быть изменены администратором через интерфейс справочников
+    result = seed_dictionaries(session, "migration.progression", [
+        {"category": "progression_sites", "items": progression_sites},
+        {"category": "alectinib_progression_type", "items": progression_types},
+    ], insert_only=True)
     session.commit()
 
+    if result is None:
+        print("✅ Справочники прогрессирования уже добавлены (контрольная сумма совпадает)")
+    else:
+        print(f"✅ Справочники прогрессирования: добавлено {result.inserted}")
+
 
 def run_migration():
     """Запуск всех миграций"""
-    from database import SessionLocal
+    from database import SessionLocal, engine
+    from models import SeedChecksum
+
+    # Таблица контрольных сумм может отсутствовать в базе, созданной старой версией
+    SeedChecksum.__table__.create(bind=engine, checkfirst=True)
     
     print("=" * 80)
     print("🚀 Начало миграции базы данных для регистра ALK (SQLite)")
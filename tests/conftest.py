@@ -0,0 +1,57 @@
+"""
+Общие фикстуры тестов
+
+Backend подключается к временной SQLite, заполненной генератором бенчмарков
+(benchmarks/generator.py). Переменные окружения задаются до импорта модулей
+backend: настройки читаются при импорте.
+"""
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+TEST_DIR = Path(tempfile.mkdtemp(prefix="registry-tests-"))
+REGISTRY_SIZE = 200
+
+os.environ.update({
+    "QUERY_BUDGET_MODE": "raise",
+    "SLOW_QUERY_LOG_PATH": str(TEST_DIR / "slow_queries.log"),
+    "EXPORT_DIR": str(TEST_DIR / "exports"),
+    "AUDIT_ARCHIVE_DIR": str(TEST_DIR / "audit_archive"),
+    "PROFILE_DIR": str(TEST_DIR / "profiles"),
+})
+
+from benchmarks import bootstrap  # noqa: E402
+
+bootstrap(TEST_DIR / "registry.db")
+
+from database import engine  # noqa: E402
+from benchmarks.generator import generate  # noqa: E402
+
+generate(engine, REGISTRY_SIZE, progress=lambda message: None)
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def auth_headers(username: str) -> dict:
+    from auth import create_access_token
+
+    return {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+
+
+@pytest.fixture(scope="session")
+def admin_headers():
+    return auth_headers("admin")
+
+
+@pytest.fixture(scope="session")
+def user_headers():
+    return auth_headers("user_2_0")
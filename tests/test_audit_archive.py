@@ -0,0 +1,42 @@
+"""
+Имена сегментов архива аудита (audit_archive.py) при повторном использовании id
+"""
+from datetime import datetime
+
+import pytest
+
+import audit_archive
+from database import SessionLocal
+from models import AuditLog
+
+OLD = datetime(2000, 1, 1)
+LATER = datetime(2000, 2, 1)
+NOW = datetime(2000, 6, 1)
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(audit_archive, "AUDIT_ARCHIVE_DIR", tmp_path)
+    return tmp_path
+
+
+def add_logs(db, ids, action, timestamp):
+    # Явные id: так SQLite выдает их заново после удаления строк с наибольшими id
+    db.add_all(AuditLog(id=log_id, user_id=1, action=action, timestamp=timestamp, record_type="test")
+               for log_id in ids)
+    db.commit()
+
+
+def test_reused_ids_get_a_new_segment(archive_dir):
+    ids = [900001, 900002]
+    with SessionLocal() as db:
+        add_logs(db, ids, "first", OLD)
+        audit_archive.archive(db, retention_days=0, now=NOW)
+        add_logs(db, ids, "second", LATER)
+        audit_archive.archive(db, retention_days=0, now=NOW)
+
+    index = audit_archive.load_index()
+    assert len(index) == 2
+    assert index[0]["file"] != index[1]["file"]
+    assert {path.name for path in archive_dir.glob("*.ndjson.gz")} == {segment["file"] for segment in index}
+    assert [record["action"] for record in audit_archive.iter_archived()] == ["second"] * 2 + ["first"] * 2
@@ -0,0 +1,12 @@
+"""
+Каждый сценарий бенчмарков (benchmarks/scenarios.py) выполняется на маленькой базе тестов
+"""
+import pytest
+
+from benchmarks.scenarios import SCENARIOS, run
+
+
+@pytest.mark.parametrize("name", sorted(SCENARIOS))
+def test_scenario_runs(name):
+    result = run([name], repeat=1, warmup=0, progress=lambda message: None)
+    assert result[name]["n"] >= 1
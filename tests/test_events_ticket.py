@@ -0,0 +1,41 @@
+"""
+Билет ленты изменений для EventSource (POST /api/events/ticket, auth.get_stream_user)
+"""
+from datetime import timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from auth import create_access_token, get_stream_user
+from database import SessionLocal
+
+
+@pytest.fixture
+def ticket(client, user_headers):
+    response = client.post("/api/events/ticket", headers=user_headers)
+    assert response.status_code == 200
+    return response.json()["ticket"]
+
+
+def test_ticket_authenticates_stream(ticket):
+    with SessionLocal() as db:
+        assert get_stream_user(ticket=ticket, credentials=None, db=db).username == "user_2_0"
+
+
+def test_ticket_is_not_an_access_token(client, ticket):
+    response = client.get("/api/patients", headers={"Authorization": f"Bearer {ticket}"})
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize("token", [
+    create_access_token({"sub": "user_2_0"}),
+    create_access_token({"sub": "user_2_0", "purpose": "events"}, expires_delta=timedelta(seconds=-1)),
+])
+def test_stream_rejects_access_token_and_expired_ticket(client, token):
+    assert client.get(f"/api/events?ticket={token}").status_code == 401
+    with SessionLocal() as db, pytest.raises(HTTPException):
+        get_stream_user(ticket=token, credentials=None, db=db)
+
+
+def test_stream_requires_credentials(client):
+    assert client.get("/api/events").status_code == 401
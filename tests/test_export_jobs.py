@@ -0,0 +1,52 @@
+"""
+Очистка просроченных фоновых выгрузок (export_jobs.py)
+"""
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+import export_jobs
+from database import SessionLocal
+from models import ExportJob
+
+
+def finished_job(client, headers) -> str:
+    job_id = client.post("/api/export/jobs", headers=headers, json={"mode": "standard"}).json()["id"]
+    deadline = time.monotonic() + 30
+    while client.get(f"/api/export/jobs/{job_id}", headers=headers).json()["status"] in ("queued", "running"):
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    return job_id
+
+
+def expire(job_id: str):
+    with SessionLocal() as db:
+        db.execute(update(ExportJob).where(ExportJob.id == job_id)
+                   .values(expires_at=datetime.utcnow() - timedelta(minutes=1)))
+        db.commit()
+
+
+def artifact(job_id: str):
+    return export_jobs.EXPORT_DIR / f"{job_id}.csv"
+
+
+def test_expired_job_is_purged_on_access(client, admin_headers):
+    job_id = finished_job(client, admin_headers)
+    assert artifact(job_id).exists()
+    expire(job_id)
+
+    assert job_id not in [job["id"] for job in client.get("/api/export/jobs", headers=admin_headers).json()]
+    assert client.get(f"/api/export/jobs/{job_id}/download", headers=admin_headers).status_code == 404
+    assert not artifact(job_id).exists()
+    with SessionLocal() as db:
+        assert db.get(ExportJob, job_id) is None
+
+
+def test_purge_expired_removes_files_without_new_jobs(client, admin_headers):
+    job_id = finished_job(client, admin_headers)
+    expire(job_id)
+    with SessionLocal() as db:
+        assert export_jobs.purge_expired(db) == 1
+        assert export_jobs.purge_expired(db) == 0
+    assert not artifact(job_id).exists()
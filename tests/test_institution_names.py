@@ -0,0 +1,29 @@
+"""
+Кэш названий учреждений (cache.InstitutionNameCache): промахи не перечитывают таблицу
+"""
+from sqlalchemy import event
+
+from cache import InstitutionNameCache
+from database import SessionLocal, engine
+
+
+def test_missing_and_none_ids_do_not_reload():
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    names = InstitutionNameCache()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        with SessionLocal() as db:
+            assert names.get(db, 1)
+            assert names.get(db, 10 ** 9) == ""
+            assert names.get(db, None) == ""
+            assert len(statements) == 1
+
+            names.invalidate()
+            names.get(db, 10 ** 9)
+            assert len(statements) == 2
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
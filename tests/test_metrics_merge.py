@@ -0,0 +1,52 @@
+"""
+Сумма метрик воркеров gunicorn (metrics.merge_exposition) и замер потоковых ответов
+"""
+from metrics import merge_exposition
+
+WORKER = """# HELP registry_http_requests_total Total HTTP requests by route and status.
+# TYPE registry_http_requests_total counter
+registry_http_requests_total{method="GET",route="/api/patients",status="200"} 3
+# HELP registry_http_request_duration_seconds Request latency in seconds.
+# TYPE registry_http_request_duration_seconds histogram
+registry_http_request_duration_seconds_bucket{method="GET",route="/api/patients",le="0.1"} 2
+registry_http_request_duration_seconds_bucket{method="GET",route="/api/patients",le="+Inf"} 3
+registry_http_request_duration_seconds_sum{method="GET",route="/api/patients"} 0.25
+registry_http_request_duration_seconds_count{method="GET",route="/api/patients"} 3
+# HELP registry_db_pool_checked_out Connections currently checked out.
+# TYPE registry_db_pool_checked_out gauge
+registry_db_pool_checked_out 1
+"""
+
+
+def sample(text: str, series: str) -> str:
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return line.rsplit(" ", 1)[1]
+    return None
+
+
+def test_counters_and_histograms_are_summed():
+    merged = merge_exposition([WORKER, WORKER], [True, True])
+    assert sample(merged, 'registry_http_requests_total{method="GET",route="/api/patients",status="200"}') == "6"
+    assert sample(merged, 'registry_http_request_duration_seconds_bucket{method="GET",route="/api/patients",le="+Inf"}') == "6"
+    assert sample(merged, 'registry_http_request_duration_seconds_sum{method="GET",route="/api/patients"}') == "0.5"
+    assert sample(merged, "registry_db_pool_checked_out") == "2"
+    assert merged.count("# TYPE registry_http_requests_total counter") == 1
+
+
+def test_gauges_of_exited_workers_are_dropped():
+    merged = merge_exposition([WORKER, WORKER], [True, False])
+    assert sample(merged, 'registry_http_requests_total{method="GET",route="/api/patients",status="200"}') == "6"
+    assert sample(merged, "registry_db_pool_checked_out") == "1"
+
+
+def test_streamed_body_is_measured(client, admin_headers):
+    from metrics import registry
+
+    labels = ("GET", "/api/export/patients")
+    before = registry.histograms["response_size"].get(labels)
+    before_total = before.total if before else 0
+    response = client.get("/api/export/patients", headers=admin_headers)
+    assert response.status_code == 200
+    # Размер - все отправленные байты потока, а не пустой content-length до отправки тела
+    assert registry.histograms["response_size"][labels].total - before_total == len(response.content)
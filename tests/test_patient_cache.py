@@ -0,0 +1,38 @@
+"""
+Кэш карточек пациентов (cache.PatientRecordCache) после записи другого воркера
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from cache import patient_records
+from database import SessionLocal
+from models import Patient
+
+
+def touch_patient(patient_id: int):
+    # Запись "другого воркера": строка меняется в БД в обход эндпоинтов этого процесса
+    with SessionLocal() as db:
+        db.execute(update(Patient).where(Patient.id == patient_id)
+                   .values(updated_at=datetime.utcnow() + timedelta(seconds=1)))
+        db.commit()
+
+
+def test_remote_write_revalidates_instead_of_clearing(client, admin_headers):
+    ids = [patient["id"] for patient in client.get("/api/patients?limit=2", headers=admin_headers).json()]
+    cards = {patient_id: client.get(f"/api/patients/{patient_id}", headers=admin_headers) for patient_id in ids}
+    unchanged, changed = ids
+
+    touch_patient(changed)
+    patient_records.mark_stale()
+    revalidations = patient_records.revalidations
+
+    response = client.get(f"/api/patients/{unchanged}", headers=admin_headers)
+    assert response.headers["ETag"] == cards[unchanged].headers["ETag"]
+    assert patient_records.revalidations == revalidations + 1
+    # Подтвержденная карточка до следующей чужой записи отдается без сверки
+    assert patient_records.get(unchanged)[1] is False
+
+    response = client.get(f"/api/patients/{changed}", headers=admin_headers)
+    assert response.headers["ETag"] != cards[changed].headers["ETag"]
+    assert response.json()["updated_at"] != cards[changed].json()["updated_at"]
@@ -0,0 +1,110 @@
+"""
+Бюджеты SQL-запросов эндпоинтов (query_budget.py) в режиме QUERY_BUDGET_MODE=raise
+
+Превышение бюджета поднимает QueryBudgetExceeded из middleware, и TestClient
+пробрасывает его в тест, поэтому успешный ответ означает, что бюджет соблюден.
+"""
+import time
+
+import pytest
+
+import main
+from query_budget import QUERY_BUDGET_MODE, QueryBudget, QueryBudgetExceeded
+
+COHORT_FILTER = {"and": [
+    {"field": "registry_type", "op": "eq", "value": "ALK"},
+    {"field": "cns_metastases", "op": "eq", "value": True},
+]}
+
+ADMIN_REQUESTS = [
+    ("GET", "/api/users", None),
+    ("GET", "/api/institutions", None),
+    ("GET", "/api/patients?limit=100", None),
+    ("GET", "/api/patients?search=SYN", None),
+    ("GET", "/api/export/patients", None),
+    ("GET", "/api/export/patients?mode=full&labels=ru", None),
+    ("GET", "/api/export/patients?since=2000-01-01T00:00:00&limit=50", None),
+    ("GET", "/api/export/jobs", None),
+    ("GET", "/api/dictionaries", None),
+    ("GET", "/api/dictionaries/histology/search?q=a", None),
+    ("GET", "/api/analytics", None),
+    ("GET", "/api/analytics?registry_type=ROS1", None),
+    ("GET", "/api/analytics/survival?group_by=stage", None),
+    ("GET", "/api/analytics/therapy-lines", None),
+    ("GET", "/api/analytics/timeseries", None),
+    ("GET", "/api/analytics/distributions?group_by=registry_type", None),
+    ("GET", "/api/analytics/completion-heatmap", None),
+    ("POST", "/api/cohorts/query", {"filter": COHORT_FILTER, "include_ids": True}),
+    ("GET", "/api/audit-logs?include_archived=true", None),
+]
+
+
+@pytest.fixture(scope="module")
+def patient_ids(client, admin_headers):
+    response = client.get("/api/patients?limit=20", headers=admin_headers)
+    assert response.status_code == 200
+    return [patient["id"] for patient in response.json()]
+
+
+def route_endpoint(path: str, method: str = "GET"):
+    # Эндпоинты обернуты profiling.wrap_endpoint: бюджет читается с обертки из маршрута
+    for route in main.app.routes:
+        if getattr(route, "path", None) == path and method in route.methods:
+            return route.endpoint
+    raise LookupError(path)
+
+
+def test_raise_mode_enabled():
+    assert QUERY_BUDGET_MODE == "raise"
+
+
+@pytest.mark.parametrize("method,url,body", ADMIN_REQUESTS)
+def test_admin_endpoints_within_budget(client, admin_headers, method, url, body):
+    response = client.request(method, url, headers=admin_headers, json=body)
+    assert response.status_code == 200, response.text
+
+
+def test_patient_endpoints_within_budget(client, admin_headers, patient_ids):
+    for patient_id in patient_ids:
+        for url in (f"/api/patients/{patient_id}", f"/api/patients/{patient_id}/completion"):
+            response = client.get(url, headers=admin_headers)
+            assert response.status_code == 200, response.text
+
+
+def test_institution_user_within_budget(client, user_headers):
+    response = client.get("/api/patients", headers=user_headers)
+    assert response.status_code == 200
+    patients = response.json()
+    assert patients and all(patient["institution_id"] == 2 for patient in patients)
+    for patient in patients[:10]:
+        assert client.get(f"/api/patients/{patient['id']}", headers=user_headers).status_code == 200
+
+
+def test_export_job_endpoints_within_budget(client, admin_headers):
+    response = client.post("/api/export/jobs", headers=admin_headers, json={"mode": "full", "gzip": True})
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+
+    deadline = time.monotonic() + 30
+    while True:
+        status = client.get(f"/api/export/jobs/{job_id}", headers=admin_headers).json()["status"]
+        if status not in ("queued", "running") or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert status == "done"
+
+    response = client.get(f"/api/export/jobs/{job_id}/download", headers={**admin_headers, "Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert client.delete(f"/api/export/jobs/{job_id}", headers=admin_headers).status_code == 200
+
+
+@pytest.mark.parametrize("budget,reason", [
+    (QueryBudget(1, 10), "budget"),
+    (QueryBudget(None, 0), "repeated"),
+])
+def test_exceeded_budget_raises(client, admin_headers, monkeypatch, budget, reason):
+    monkeypatch.setattr(route_endpoint("/api/patients"), "query_budget", budget)
+    with pytest.raises(QueryBudgetExceeded, match=reason) as exc_info:
+        client.get("/api/patients", headers=admin_headers)
+    assert "GET /api/patients" in str(exc_info.value)
+
@@ -0,0 +1,30 @@
+"""
+Заполнение справочников (seed.seed_dictionaries) без перезаписи правок администратора
+"""
+from database import SessionLocal
+from models import Dictionary
+from seed import seed_dictionaries
+
+CATEGORY = "test_seed_stage"
+
+
+def test_sync_active_insert_only_keeps_admin_edits():
+    with SessionLocal() as db:
+        db.add_all([
+            Dictionary(category=CATEGORY, code="A", value_ru="Метка администратора", sort_order=7, is_active=True),
+            Dictionary(category=CATEGORY, code="B", value_ru="B", sort_order=2, is_active=False),
+            Dictionary(category=CATEGORY, code="OLD", value_ru="OLD", sort_order=3, is_active=True),
+        ])
+        db.commit()
+
+        result = seed_dictionaries(db, "test.seed_stage", [{
+            "category": CATEGORY,
+            "items": [("A", "A", 1), ("B", "B", 2), ("C", "C", 3)],
+        }], sync_active=True, insert_only=True)
+        db.commit()
+
+        rows = {row.code: row for row in db.query(Dictionary).filter(Dictionary.category == CATEGORY)}
+        assert (result.inserted, result.updated, result.deactivated) == (1, 1, 1)
+        assert (rows["A"].value_ru, rows["A"].sort_order, rows["A"].is_active) == ("Метка администратора", 7, True)
+        assert rows["B"].is_active and rows["C"].is_active
+        assert not rows["OLD"].is_active